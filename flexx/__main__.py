@@ -96,6 +96,55 @@ class CLI:
         except FetchError:
             print('There appears to be no local server at port %i' % port)
     
+    def cmd_build(self, dirname=None, *module_names):
+        """ transpile the JS and CSS of an app ahead of time,
+        e.g. flexx build build_dir myapp
+        The given modules (and flexx.ui) are imported, and the JS and CSS of
+        all modules, the asset bundles, and a manifest are written to the
+        given directory. Serve the app with the "frozen_build" config option
+        set to this directory, to load all assets from the build.
+        """
+        if dirname is None or not module_names:
+            return self.cmd_help('build')
+        import importlib
+        from flexx import ui  # noqa - apps typically use the widgets
+        for module_name in module_names:
+            importlib.import_module(module_name)
+        from flexx.app import assets
+        assets.freeze(dirname)
+        print('built %i modules to %s' % (len(assets.modules), dirname))
+    
+    def cmd_top(self, port=None, interval='2'):
+        """ show the metrics of the flexx server process at the given port,
+        e.g. flexx top 8080
+        The metrics are fetched from /flexx/metrics every interval seconds
+        (default 2), and shown as a table of sessions per app, traffic
+        rates, and (mean) timings. Press ctrl-c to stop.
+        """
+        if port is None:
+            return self.cmd_help('top')
+        import time
+        port, interval = int(port), float(interval)
+        url = 'http://localhost:%i/flexx/metrics' % port
+        last = None
+        try:
+            while True:
+                try:
+                    metrics = parse_metrics(http_fetch(url))
+                except FetchError:
+                    print('There appears to be no local server at port %i' %
+                          port)
+                    return
+                lines = format_metrics(metrics, last, interval)
+                print('\x1b[2J\x1b[H', end='')  # clear screen
+                print('Flexx server at port %i - %s' %
+                      (port, time.strftime('%H:%M:%S')))
+                print('\n'.join(lines))
+                last = metrics
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+    
     def cmd_log(self, port=None, level='info'):
         """ Start listening to log messages from a server process - STUB
         flexx log port level
@@ -123,6 +172,123 @@ def http_fetch(url):
     return response.body.decode()
 
 
+def parse_metrics(text):
+    """ Parse metrics in the Prometheus text format into a dict that maps
+    (name, labels) to the value, where labels is a tuple of (key, value)
+    tuples.
+    """
+    metrics = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name_labels, _, value = line.rpartition(' ')
+        name, _, labels = name_labels.partition('{')
+        labels = tuple(tuple(part.split('=', 1)) for part in
+                       labels.rstrip('}').replace('"', '').split(',') if part)
+        metrics[(name, labels)] = float(value)
+    return metrics
+
+
+def format_metrics(metrics, last, interval):
+    """ Get a list of lines that summarizes the given metrics. Rates are
+    calculated using the metrics of the previous poll, and shown as a dash
+    if there is none.
+    """
+    def select(name, key=None):
+        # Get dict label-value -> value, for the given label key
+        return dict((dict(labels).get(key, ''), value) for (n, labels), value
+                    in metrics.items() if n == name)
+    def rate(name, key=None):
+        # Rates need a previous poll; the counters are cumulative
+        old = dict((dict(labels).get(key, ''), value) for (n, labels), value
+                   in (last or {}).items() if n == name)
+        return dict((k, (v - old.get(k, 0)) / interval)
+                    for k, v in select(name, key).items())
+    def fmt(value, width, precision=1):
+        # Format a rate, or a dash if it is not yet known
+        if last is None:
+            return '%*s' % (width, '-')
+        return '%*.*f' % (width, precision, value)
+    def mean_ms(name):
+        d_sum = sum(rate(name + '_sum').values())
+        d_count = sum(rate(name + '_count').values())
+        total = sum(select(name + '_count').values())
+        if last is not None and d_count:
+            return '%8.2f ms %8.1f /s' % (1000 * d_sum / d_count, d_count)
+        return '%8s    %s /s (%i total)' % ('-', fmt(d_count, 8), total)
+    
+    uptime = sum(select('flexx_uptime_seconds').values())
+    lines = ['Uptime: %1.0f s' % uptime, '']
+    # Sessions per app
+    lines.append('%-24s %9s %9s %9s %6s %9s %11s %11s' %
+                 ('app', 'pending', 'connected', 'suspended', 'pool',
+                  'queued', 'queued (B)', 'data (B)'))
+    sessions = [(dict(labels), value) for (n, labels), value in metrics.items()
+                if n == 'flexx_sessions']
+    pool = select('flexx_session_pool_ready', 'app')
+    depth = select('flexx_queue_commands', 'app')
+    nbytes = select('flexx_queue_bytes', 'app')
+    data = select('flexx_data_bytes', 'app')
+    for app in sorted(set(labels['app'] for labels, value in sessions)):
+        count = dict((labels['status'], value) for labels, value in sessions
+                     if labels['app'] == app)
+        lines.append('%-24s %9i %9i %9i %6i %9i %11i %11i' %
+                     (app, count.get('pending', 0), count.get('connected', 0),
+                      count.get('suspended', 0), pool.get(app, 0),
+                      depth.get(app, 0), nbytes.get(app, 0), data.get(app, 0)))
+    # Round-trip times of the connected sessions
+    quantiles = [(dict(labels), value) for (n, labels), value in metrics.items()
+                 if n == 'flexx_roundtrip_quantile_seconds']
+    if quantiles:
+        lines.append('')
+        lines.append('%-24s %9s %9s %9s' %
+                     ('round-trip (ms)', 'p50', 'p95', 'max'))
+        for app in sorted(set(labels['app'] for labels, value in quantiles)):
+            q = dict((labels['quantile'], value) for labels, value in quantiles
+                     if labels['app'] == app)
+            lines.append('%-24s %9.1f %9.1f %9.1f' %
+                         (app, 1000 * q.get('0.5', 0), 1000 * q.get('0.95', 0),
+                          1000 * q.get('1', 0)))
+    # Traffic
+    lines.append('')
+    lines.append('%-24s %11s %13s' % ('sent per kind', 'frames/s', 'bytes/s'))
+    frames = rate('flexx_frames_sent_total', 'kind')
+    nbytes = rate('flexx_bytes_sent_total', 'kind')
+    for kind in sorted(frames):
+        lines.append('%-24s %s %s' % (kind, fmt(frames[kind], 11),
+                                      fmt(nbytes.get(kind, 0), 13, 0)))
+    lines.append('%-24s %s %s' % ('received',
+                 fmt(sum(rate('flexx_frames_received_total').values()), 11),
+                 fmt(sum(rate('flexx_bytes_received_total').values()), 13, 0)))
+    lines.append('')
+    lines.append('%-24s %11s %13s' %
+                 ('commands per type', 'sent/s', 'received/s'))
+    sent = rate('flexx_commands_sent_total', 'command')
+    received = rate('flexx_commands_received_total', 'command')
+    for command in sorted(set(sent) | set(received)):
+        lines.append('%-24s %s %s' % (command, fmt(sent.get(command, 0), 11),
+                                      fmt(received.get(command, 0), 13)))
+    assets = rate('flexx_asset_bytes_served_total', 'kind')
+    lines.append('')
+    lines.append('Served over http: %s B/s assets, %s B/s data' %
+                 (fmt(assets.get('asset', 0), 1, 0),
+                  fmt(assets.get('data', 0), 1, 0)))
+    # Timings
+    lines.append('')
+    lines.append('Handler time:     ' + mean_ms('flexx_handler_seconds'))
+    lines.append('Round-trip time:  ' + mean_ms('flexx_roundtrip_seconds'))
+    lines.append('IOLoop lag:       ' + mean_ms('flexx_ioloop_lag_seconds'))
+    # Time spent by the clients (summed over all clients)
+    lines.append('')
+    lines.append('Client init time: ' + mean_ms('flexx_client_init_seconds'))
+    busy = [fmt(1000 * sum(rate('flexx_client_%s_seconds_total' %
+                                name).values()), 1)
+            for name in ('command', 'asset', 'handler')]
+    lines.append('Client busy (ms/s): %s commands, %s assets, '
+                 '%s handlers' % tuple(busy))
+    return lines
+
+
 # Prepare docss
 _cli_docs = CLI().get_global_help().splitlines()
 __doc__ += '\n'.join(['    ' + line for line in _cli_docs])
@@ -13,10 +13,49 @@ config = Config('flexx', '~appdata/.flexx.cfg',
                         'values to pass cross-origin checks.'),
         ws_timeout=(20, int, 'If the websocket is idle for this amount of seconds, '
                  'it is closed.'),
+        ws_high_water_mark=(2**25, int, 'The number of bytes that may be '
+                            'buffered for a client before it is congested.'),
+        ws_congestion_policy=('block', str, 'What to do when a client is '
+                              'congested: "block", "drop" or "disconnect".'),
+        session_pending_ttl=(30.0, float, 'The number of seconds that a client '
+                             'has to connect to a newly created session.'),
+        session_resume_timeout=(0.0, float, 'The number of seconds that a '
+                                'session is kept alive after losing its '
+                                'websocket, so that the client can reconnect '
+                                'and resume it. Zero disables this.'),
+        session_replay_size=(2**22, int, 'The maximum number of bytes of '
+                             'unacknowledged frames to keep per session, so '
+                             'they can be send again when it is resumed.'),
+        session_latency_window=(60, int, 'The number of recent round-trip '
+                                'times (one per second) to keep per session, '
+                                'see Session.latency_stats().'),
+        client_perf_interval=(5.0, float, 'The interval in seconds at which '
+                              'clients report how much time they spend on '
+                              'commands, assets and handlers. Zero disables this.'),
+        session_pool_size=(0, int, 'The number of sessions to keep '
+                           'pre-instantiated for each served app. Can be '
+                           'overridden per app in App.serve().'),
+        workers=(1, int, 'The number of worker processes to serve apps with. '
+                 'Connections are routed to the worker that owns the session.'),
+        link_assets=(False, bool, 'Let clients load the assets of modules over '
+                     '(cacheable) HTTP, instead of pushing them over the websocket.'),
+        frozen_build=('', str, 'The directory of a build made with "flexx build", '
+                      'to load the JS and CSS of all modules from.'),
         ssl_certfile=('', str, 'The cert file for https server.'),
         ssl_keyfile=('', str, 'The key file for https server.'),
         cookie_secret=('flexx_secret', str, 'The secret key to encode cookies.'),
         
+        # flexx.event
+        handler_warn_threshold=(0.0, float, 'Log a warning when a call to an '
+                                'event handler takes longer than this number '
+                                'of seconds. Zero disables this.'),
+        
+        # flexx.pyscript
+        pyscript_cache=(True, bool, 'Whether to cache transpiled JavaScript on '
+                        'disk (in the flexx appdata dir).'),
+        pyscript_cache_size=(64, int, 'The maximum size of the PyScript cache '
+                             'in MiB.'),
+        
         # flexx.webruntime
         webruntime=('', str, 'The default web runtime to use. '
                     'Default is "app or browser".'),
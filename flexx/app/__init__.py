@@ -222,6 +222,7 @@ _DEV_NOTES = """
 Overview of classes:
 
 * Model: the base class for creating Python-JS objects.
+* SharedModel: a Model that is mirrored to multiple sessions.
 * JSModule: represents a module in JS that corresponds to a Python module.
 * Asset: represents an asset.
 * Bundle: an Asset subclass to represent a collecton of JSModule's in one asset.
@@ -249,13 +250,15 @@ del logging
 from ._app import App, manager
 from ._asset import Asset, Bundle
 from ._model import Model, get_active_model, get_active_models
-from ._model import get_model_classes
+from ._model import SharedModel, get_model_classes
 from ._funcs import run, start, stop
 from ._funcs import init_interactive, init_notebook, serve, launch, export
 from ._server import call_later, create_server, current_server
 from ._session import Session
 from ._modules import JSModule
 from ._assetstore import assets
+from ._metrics import metrics
+from ._tracing import TraceRecorder
 from ._clientcore import serializer
 
 # Resolve cyclic dependencies, and explicit exports to help cx_Freeze
@@ -5,14 +5,17 @@ Definition of the App class and app manager.
 import os
 import time
 import weakref
+from collections import OrderedDict
 from base64 import encodestring as encodebytes
 
-from .. import event, webruntime
+from .. import event, webruntime, config
 
 from ._model import Model
-from ._server import current_server
-from ._session import Session, get_page_for_export
-from ._assetstore import assets
+from ._server import current_server, call_later
+from ._session import Session, get_page_for_export, make_batch
+from ._session import get_latency_stats
+from ._assetstore import assets, EncodedCommand
+from ._clientcore import serializer
 from . import logger
 
 
@@ -56,6 +59,7 @@ class App:
         self.kwargs = kwargs
         self._path = cls.__name__  # can be overloaded by serve()
         self._is_served = False
+        self._pool_size = 0
 
         # Handle good defaults
         if hasattr(cls, 'title') and self.kwargs.get('title', None) is None:
@@ -113,7 +117,14 @@ class App:
         """
         return self._path or '__main__'
 
-    def serve(self, name=None):
+    @property
+    def pool_size(self):
+        """ The number of sessions that are kept pre-instantiated for this
+        app. See ``serve()``.
+        """
+        return self._pool_size
+
+    def serve(self, name=None, pool_size=None):
         """ Start serving this app.
 
         This registers the given class with the internal app manager. The
@@ -122,12 +133,21 @@ class App:
         Arguments:
             name (str, optional): the relative URL path to serve the app on.
                 If this is ``''`` (the empty string), this will be the main app.
+            pool_size (int, optional): the number of sessions to keep
+                pre-instantiated, so that a page request does not have to
+                wait for the app to be created. The pool is filled in the
+                background, starting at the first request. Note that the
+                ``init()`` of a pooled app cannot use the request or
+                cookies. Default ``config.session_pool_size``.
         """
         # Note: this talks to the manager; it has nothing to do with the server
         if self._is_served:
             raise RuntimeError('This app (%s) is already served.' % self.name)
         if name is not None:
             self._path = name
+        if pool_size is None:
+            pool_size = config.session_pool_size
+        self._pool_size = max(0, int(pool_size))
         manager.register_app(self)
         self._is_served = True
 
@@ -253,9 +273,19 @@ class AppManager(event.HasEvents):
 
     def __init__(self):
         super().__init__()
-        # name -> (app, pending, connected) - lists contain Session objects
+        # name -> (app, pending, connected) - the latter two are OrderedDicts
+        # that map session id -> Session object, in order of creation.
         self._appinfo = {}
+        self._app_names = {}  # lowercase name -> name
+        # name -> list of pre-instantiated sessions, and their stats
+        self._pools = {}
+        self._pool_stats = {}
+        self._pools_filling = set()
+        # Sessions that lost their websocket, and may be resumed, by id
+        self._suspended = OrderedDict()
         self._session_map = weakref.WeakValueDictionary()
+        # The server periodically clears pending sessions that are not
+        # connected in time (see _clear_old_pending_sessions)
         self._last_check_time = time.time()
 
     def register_app(self, app):
@@ -267,12 +297,17 @@ class AppManager(event.HasEvents):
         name = app.name
         if not valid_app_name(name):
             raise ValueError('Given app does not have a valid name %r' % name)
-        pending, connected = [], []
+        pending, connected = OrderedDict(), OrderedDict()
         if name in self._appinfo:
             old_app, pending, connected = self._appinfo[name]
             if app is not old_app:
                 logger.warn('Re-registering app class %r' % name)
         self._appinfo[name] = app, pending, connected
+        self._app_names[name.lower()] = name
+        self._pools_filling.discard(name)
+        for session in self._pools.pop(name, []):
+            session.close()  # instances of the old app
+        self._pool_stats[name] = dict(hits=0, misses=0, fills=0, fill_time=0.0)
 
     def create_default_session(self, cls=None):
         """ Create a default session for interactive use (e.g. the notebook).
@@ -294,7 +329,7 @@ class AppManager(event.HasEvents):
         session = Session('__default__')
         self._session_map[session.id] = session
         _, pending, connected = self._appinfo['__default__']
-        pending.append(session)
+        pending[session.id] = session
 
         # Instantiate the model
         model_instance = app(session=session, is_app=True)
@@ -314,27 +349,47 @@ class AppManager(event.HasEvents):
             return None
         else:
             _, pending, connected = x
-            sessions = pending + connected
+            sessions = list(pending.values()) + list(connected.values())
             if sessions:
                 return sessions[-1]
 
+    def _get_check_interval(self):
+        return max(0.1, min(5.0, config.session_pending_ttl / 2))
+
     def _clear_old_pending_sessions(self):
+        # Pending sessions that are not connected within the TTL are
+        # closed, so that their models are disposed. Since sessions are
+        # ordered by creation time, we only look at the expired ones.
+        self._last_check_time = time.time()
         try:
 
             count = 0
+            max_creation_time = time.time() - config.session_pending_ttl
             for name in self._appinfo:
                 if name == '__default__':
                     continue
                 _, pending, _ = self._appinfo[name]
-                to_remove = [s for s in pending
-                             if (time.time() - s._creation_time) > 30]
-                for s in to_remove:
+                while pending:
+                    s = next(iter(pending.values()))
+                    if s._creation_time > max_creation_time:
+                        break
+                    pending.pop(s.id)
                     self._session_map.pop(s.id, None)
-                    pending.remove(s)
-                count += len(to_remove)
+                    s.close()
+                    count += 1
             if count:
                 logger.warn('Cleared %i old pending sessions' % count)
 
+            # Close suspended sessions that were not resumed in time
+            max_suspend_time = time.time() - config.session_resume_timeout
+            while self._suspended:
+                s = next(iter(self._suspended.values()))
+                if s._suspend_time > max_suspend_time:
+                    break
+                self._suspended.pop(s.id)
+                logger.info('Session %s %s was not resumed' % (s.app_name, s.id))
+                self._close_session(s)
+
         except Exception as err:
             logger.error('Error when clearing old pending sessions: %s' % str(err))
 
@@ -348,9 +403,8 @@ class AppManager(event.HasEvents):
         # Called by the server when a client connects, and from the
         # launch and export functions.
 
-        if time.time() - self._last_check_time > 5:
-            self._last_check_time = time.time()
-            self._clear_old_pending_sessions()
+        if time.time() - self._last_check_time > 2 * self._get_check_interval():
+            self._clear_old_pending_sessions()  # no server is checking
 
         if name == '__default__':
             raise RuntimeError('There can be only one __default__ session.')
@@ -359,36 +413,119 @@ class AppManager(event.HasEvents):
 
         app, pending, connected = self._appinfo[name]
 
-        # Create the session
-        session = Session(name, request=request)
-        if id is not None:
-            session._id = id  # used by app.export
+        # Get a pre-instantiated session from the pool, or create one
+        pool = self._pools.get(name, None)
+        if id is None and pool:
+            session = pool.pop(0)
+            session._set_pooled(False)
+            session._set_request(request)
+            session._creation_time = time.time()
+            self._pool_stats[name]['hits'] += 1
+        else:
+            if id is None and app.pool_size:
+                self._pool_stats[name]['misses'] += 1
+            session = self._instantiate_session(app, name, request)
+            if id is not None:
+                session._id = id  # used by app.export
         self._session_map[session.id] = session
-        # Instantiate the model
-        # This represents the "instance" of the App object (Model class + args)
-        model_instance = app(session=session, is_app=True)
-        # Session and app model need each-other, thus the _set_app()
-        session._set_app(model_instance)
+        if id is None and app.pool_size:
+            self._schedule_pool_fill(name)
 
         # Now wait for the client to connect. The client will be served
         # a page that contains the session_id. Upon connecting, the id
         # will be communicated, so it connects to the correct session.
-        pending.append(session)
+        pending[session.id] = session
 
         logger.debug('Instantiate app client %s' % session.app_name)
         return session
 
-    def connect_client(self, ws, name, session_id, cookies=None):
-        """ Connect a client to a session that was previously created.
+    def _instantiate_session(self, app, name, request=None):
+        # Create the session
+        session = Session(name, request=request)
+        # Instantiate the model
+        # This represents the "instance" of the App object (Model class + args)
+        model_instance = app(session=session, is_app=True)
+        # Session and app model need each-other, thus the _set_app()
+        session._set_app(model_instance)
+        return session
+
+    def _schedule_pool_fill(self, name):
+        if name not in self._pools_filling:
+            self._pools_filling.add(name)
+            call_later(0, self._fill_pool, name)
+
+    def _fill_pool(self, name):
+        # Add one session to the pool per event loop iteration, so that
+        # requests can be handled in between.
+        if name not in self._pools_filling:
+            return  # app was re-registered
+        app, _, _ = self._appinfo[name]
+        pool = self._pools.setdefault(name, [])
+        if len(pool) >= app.pool_size:
+            self._pools_filling.discard(name)
+            return
+        t0 = time.perf_counter()
+        try:
+            session = self._instantiate_session(app, name)
+        except Exception as err:
+            self._pools_filling.discard(name)
+            logger.error('Could not instantiate session for pool of %s: %s' %
+                         (name, err))
+            return
+        stats = self._pool_stats[name]
+        stats['fills'] += 1
+        stats['fill_time'] += time.perf_counter() - t0
+        session._set_pooled(True)
+        pool.append(session)
+        call_later(0, self._fill_pool, name)
+
+    def get_pool_stats(self, name):
+        """ Get a dict with stats for the pool of pre-instantiated sessions
+        of the app with the given name: the pool "size" and the number of
+        sessions that are "ready", the number of requests that were served
+        from the pool ("hits") and that had to wait for a session to be
+        created ("misses"), and the number of sessions created for the pool
+        ("fills") and the total time this took ("fill_time", in seconds).
+        """
+        app, _, _ = self._appinfo[name]
+        stats = dict(self._pool_stats[name])
+        stats['size'] = app.pool_size
+        stats['ready'] = len(self._pools.get(name, ()))
+        return stats
+
+    def get_latency_stats(self, name=None):
+        """ Get a dict with statistics of the recent round-trip times of
+        all connected sessions of the app with the given name (or of all
+        apps if name is None). See ``Session.latency_stats()``.
+        """
+        names = self.get_app_names() if name is None else [name]
+        roundtrips = []
+        for name in names:
+            for session in self._appinfo[name][2].values():
+                if session.status == session.STATUS.CONNECTED:  # not suspended
+                    roundtrips.extend(session._roundtrips)
+        return get_latency_stats(roundtrips)
+
+    def connect_client(self, ws, name, session_id, cookies=None, received=None):
+        """ Connect a client to a session that was previously created,
+        or resume a session that lost its connection. In the latter case,
+        received is the number of frames that the client received before.
         """
         _, pending, connected = self._appinfo[name]
 
-        # Search for the session with the specific id
-        for session in pending:
-            if session.id == session_id:
-                pending.remove(session)
-                break
-        else:
+        # Resume a suspended session
+        session = self._suspended.pop(session_id, None)
+        if session is not None:
+            if not session._resume(ws, received or 0):
+                self._close_session(session)
+                raise RuntimeError('Cannot resume session %r: missed commands '
+                                   'are no longer available.' % session_id)
+            logger.info('Resumed session %s %s' % (name, session_id))
+            return session
+
+        # Get the session with the specific id
+        session = pending.pop(session_id, None)
+        if session is None:
             raise RuntimeError('Asked for session id %r, but could not find it' %
                                session_id)
 
@@ -397,28 +534,38 @@ class AppManager(event.HasEvents):
         logger.info('New session %s %s' % (name, session_id))
         session._set_cookies(cookies)
         session._set_ws(ws)
-        connected.append(session)
+        connected[session.id] = session
         AppManager.total_sessions += 1
         self.connections_changed(session.app_name)
         return session  # For the ws
 
-    def disconnect_client(self, session):
+    def disconnect_client(self, session, resumable=False):
         """ Close a connection to a client.
 
         This is called by the websocket when the connection is closed.
         The manager will remove the session from the list of connected
-        instances.
+        instances. If resumable is True (i.e. the connection was lost,
+        rather than closed by the client) and
+        ``config.session_resume_timeout`` is nonzero, the session is kept
+        alive (and listed as a connection), so that the client can reconnect.
         """
         if session.app_name == '__default__':
             logger.info('Default session lost connection to client.')
             return  # The default session awaits a re-connect
 
-        _, pending, connected = self._appinfo[session.app_name]
-        try:
-            connected.remove(session)
-        except ValueError:
-            pass
+        if (resumable and session._resumable and session.app is not None and
+                not session._closing):
+            logger.info('Session suspended %s %s' % (session.app_name, session.id))
+            session._suspend()
+            self._suspended[session.id] = session
+            return
+
         logger.info('Session closed %s %s' %(session.app_name, session.id))
+        self._close_session(session)
+
+    def _close_session(self, session):
+        _, pending, connected = self._appinfo[session.app_name]
+        connected.pop(session.id, None)
         session.close()
         self.connections_changed(session.app_name)
 
@@ -427,12 +574,7 @@ class AppManager(event.HasEvents):
         a registered appliciation (case insensitive). Returns None if the
         given name does not match any applications.
         """
-        name = name.lower()
-        for key in self._appinfo.keys():
-            if key.lower() == name:
-                return key
-        else:
-            return None
+        return self._app_names.get(name.lower(), None)
 
     def get_app_names(self):
         """ Get a list of registered application names.
@@ -448,7 +590,24 @@ class AppManager(event.HasEvents):
         """ Given an app name, return the session connected objects.
         """
         _, pending, connected = self._appinfo[name]
-        return list(connected)
+        return list(connected.values())
+
+    def broadcast(self, name, type, info=None):
+        """ Emit an event on the JS side of the app model of all connected
+        sessions of the app with the given name. The command is serialized
+        and encoded only once, and the same bytes are send to each client;
+        the client substitutes the id of its own app model. The event is
+        not emitted on the Python side. Returns the number of sessions that
+        the event was send to.
+        """
+        _, pending, connected = self._appinfo[name]
+        if not connected:
+            return 0
+        txt = serializer.saves({} if info is None else info)
+        command = EncodedCommand(make_batch([['EMIT', '@app', type, txt]]).encode())
+        for session in connected.values():
+            session._send_command(command)
+        return len(connected)
 
     @event.emitter
     def connections_changed(self, name):
@@ -457,6 +616,13 @@ class AppManager(event.HasEvents):
         """
         return {name: str(name)}
 
+    @event.emitter
+    def congestion_changed(self, session, congested):
+        """ Emits an event when a session becomes congested, or is no
+        longer congested. See ``Session.congested``.
+        """
+        return dict(session=session, congested=congested)
+
 
 # Create global app manager object
 manager = AppManager()
@@ -214,8 +214,8 @@ class Bundle(Asset):
         self._assets = []
         self._module_name = name.rsplit('.', 1)[0].split('-')[0]
         self._modules = []
-        self._deps = set()
         self._need_sort = False
+        self._version = 0
     
     def __repr__(self):
         t = '<%s %r with %i assets and %i modules at 0x%0x>'
@@ -232,6 +232,7 @@ class Bundle(Asset):
         if isinstance(a, Bundle):
             raise TypeError('Bundles can contain assets and modules, but not bundles.')
         self._assets.append(a)
+        self._version += 1
     
     def add_module(self, m):
         """ Add a module to the bundle. This will (lazily) invoke a
@@ -239,8 +240,6 @@ class Bundle(Asset):
         bundles, so that bundles themselves can be sorted.
         """
         
-        ext = '.' + self.name.rsplit('.')[-1].lower()
-        
         # Check if module belongs here
         if not m.name.startswith(self._module_name):
             raise ValueError('Module %s does not belong in bundle %s.' %
@@ -249,21 +248,15 @@ class Bundle(Asset):
         # Add module
         self._modules.append(m)
         self._need_sort = True
-        
-        # Add deps for this module
-        deps = set()
-        for dep in m.deps:
-            while '.' in dep:
-                deps.add(dep)
-                dep = dep.rsplit('.', 1)[0]
-            deps.add(dep)
-        
-        # Clear deps that are represented by this bundle
-        for dep in deps:
-            if not (dep.startswith(self._module_name) or
-                    self._module_name.startswith(dep + '.')):
-                self._deps.add(dep + ext)
+        self._version += 1
    
+    @property
+    def version(self):
+        """ A number that increases each time an asset or module is added
+        to this bundle.
+        """
+        return self._version
+    
     @property
     def assets(self):
         """ The list of assets in this bundle (excluding modules).
@@ -282,8 +275,23 @@ class Bundle(Asset):
     @property
     def deps(self):
         """ The set of dependencies for this bundle, expressed in module names.
+        These are derived (lazily) from the dependencies of its modules.
         """
-        return self._deps
+        ext = '.' + self.name.rsplit('.')[-1].lower()
+        
+        # Collect deps of the modules
+        deps = set()
+        for m in self._modules:
+            for dep in m.deps:
+                while '.' in dep:
+                    deps.add(dep)
+                    dep = dep.rsplit('.', 1)[0]
+                deps.add(dep)
+        
+        # Clear deps that are represented by this bundle
+        return set(dep + ext for dep in deps
+                   if not (dep.startswith(self._module_name) or
+                           self._module_name.startswith(dep + '.')))
     
     def to_string(self):
         # Concatenate code strings and add TOC. Module objects do/cache the work.
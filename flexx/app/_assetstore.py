@@ -5,15 +5,25 @@ etc.) needed by the applications.
 """
 
 import os
+import re
+import gzip
+import json
+import zlib
 import shutil
+import hashlib
 
 from ..pyscript import create_js_module, get_all_std_names, get_full_std_lib
 
+from .. import config, __version__
+from ..event._js import HasEventsJS
 from ._model import Model
 from ._asset import Asset, Bundle, HEADER
-from ._modules import JSModule
+from ._modules import JSModule, FrozenModule
 from . import logger
 
+# Increase this when the layout of frozen builds changes
+FROZEN_FORMAT = 2
+
 
 INDEX = """
 <!doctype html>
@@ -160,6 +170,38 @@ td,th{padding:0}
 """.lstrip()
 
 
+HASHED_NAME = re.compile(r'^(.+)\.([0-9a-f]{12})\.(js|css)$')
+
+
+def split_hashed_name(filename):
+    """ Split an asset name that contains a content hash (as produced by
+    ``AssetStore.get_hashed_name()``) into the asset name and the hash.
+    The hash is None if the filename does not look like a hashed name.
+    """
+    m = HASHED_NAME.match(filename)
+    if m is None:
+        return filename, None
+    return m.group(1) + '.' + m.group(3), m.group(2)
+
+
+class EncodedCommand(bytes):
+    """ A command that is already UTF-8 encoded. It is send to the client
+    as a text frame, as opposed to other bytes, which are binary frames.
+    """
+    __slots__ = ()
+
+
+def get_define_suffix(asset):
+    """ Get the suffix of the DEFINE command to define the given asset in
+    the client: "JS", "JS-EVAL" or "CSS". All our sources come in bundles,
+    for which we use eval because it makes sourceURL work on FF.
+    """
+    suffix = asset.name.split('.')[-1].upper()
+    if suffix == 'JS' and isinstance(asset, Bundle):
+        suffix = 'JS-EVAL'
+    return suffix
+
+
 def export_assets_and_data(assets, data, dirname, app_id, clear=False):
     """ Export the given assets (list of Asset objects) and data (list of
     (name, value) tuples to a file system structure.
@@ -204,23 +246,35 @@ class AssetStore:
     Assets with additional JS or CSS to load can be used simply by
     creating/importing them in a module that defines the Model class
     that needs the asset.
+    
+    If ``flexx.config.frozen_build`` is set, the JS and CSS of all modules
+    is loaded from a build created with ``flexx build`` (see ``freeze()``),
+    instead of being transpiled on the fly.
     """
     
     def __init__(self):
         self._known_model_classes = set()
         self._modules = {}
+        self._bundled_modules = set()  # names of modules added to bundles
         self._assets = {}
         self._associated_assets = {}
         self._data = {}
         self._used_assets = set()  # between all sessions (for export)
+        self._asset_hashes = {}  # name -> (bundle version, content hash)
+        self._asset_bytes = {}  # (name, encoding) -> (hash, bytes)
+        self._asset_commands = {}  # name -> (hash, EncodedCommand)
         
         # Create standard assets
         asset_reset = Asset('reset.css', RESET)
         asset_loader = Asset('flexx-loader.js', LOADER)
-        func_names, method_names = get_all_std_names()
-        mod = create_js_module('pyscript-std.js', get_full_std_lib(),
-                               [], func_names + method_names, 'amd-flexx')
-        asset_pyscript = Asset('pyscript-std.js', HEADER + mod)
+        if config.frozen_build:
+            std = self._load_frozen(config.frozen_build)
+            asset_pyscript = Asset('pyscript-std.js', std)
+        else:
+            func_names, method_names = get_all_std_names()
+            mod = create_js_module('pyscript-std.js', get_full_std_lib(),
+                                   [], func_names + method_names, 'amd-flexx')
+            asset_pyscript = Asset('pyscript-std.js', HEADER + mod)
         
         # Add them
         for a in [asset_reset, asset_loader, asset_pyscript]:
@@ -230,7 +284,9 @@ class AssetStore:
             return
         
         #  Create flexx-core bootstrap bundle
-        self.update_modules()  # to collect _model and _clientcore
+        self.update_modules()  # to collect _model
+        self.modules['flexx.app._model'].deps  # noqa - resolves _clientcore
+        self.update_modules()  # to collect _clientcore
         asset_core = Bundle('flexx-core.js')
         asset_core.add_asset(asset_loader)
         asset_core.add_asset(asset_pyscript)
@@ -265,24 +321,28 @@ class AssetStore:
         by the Session object.
         """
         
-        # Dependencies can drag in more modules, therefore we store
-        # what modules we know of beforehand.
-        current_module_names = set(self._modules)
-        
         # Track all known (i.e. imported classes) Model classes. We keep track
         # of what classes we've registered, so this is pretty efficient. This
         # works also if a module got a new or renewed Model class.
         for cls in Model.CLASSES:
             if cls not in self._known_model_classes:
                 self._known_model_classes.add(cls)
+                self._clear_bundle_hashes()
                 if cls.__jsmodule__ not in self._modules:
+                    if config.frozen_build:
+                        raise RuntimeError('Module %s is not in the frozen '
+                                           'build; run "flexx build" again.' %
+                                           cls.__jsmodule__)
                     JSModule(cls.__jsmodule__, self._modules)  # auto-registers
                 self._modules[cls.__jsmodule__].add_variable(cls.__name__)
         
-        # Deal with new modules: store asset deps and bundle the modules
+        # Deal with new modules: store asset deps and bundle the modules.
+        # Note that dependencies can drag in more modules, also when
+        # they are collected (lazily) by the session.
         mcount = 0
         bcount = 0
-        for name in set(self._modules).difference(current_module_names):
+        for name in set(self._modules).difference(self._bundled_modules):
+            self._bundled_modules.add(name)
             mod = self.modules[name]
             mcount += 1
             # Get names of bundles to add this module to
@@ -303,6 +363,115 @@ class AssetStore:
         if mcount:
             logger.info('Asset store collected %i new modules.' % mcount)
     
+    def freeze(self, dirname):
+        """ Transpile all modules, and write their JS and CSS, together
+        with the asset bundles, to the given directory. The Python modules
+        of the app must have been imported. The file "manifest.json"
+        contains the dependency graph of the modules and bundles, the
+        content hashes of the bundles, and the metadata of the modules.
+        The file "hasevents.js" contains the JS of the event system.
+        
+        A server that sets ``flexx.config.frozen_build`` to this directory
+        loads the modules from the build, so that nothing needs to be
+        transpiled at runtime. This is what ``flexx build`` does.
+        """
+        if config.frozen_build:
+            raise RuntimeError('Cannot freeze an asset store that is '
+                               'loaded from a frozen build.')
+        
+        self._transpile_all_modules()
+        
+        # Collect module metadata
+        modules = {}
+        for name, mod in self._modules.items():
+            modules[name] = dict(deps=sorted(mod.deps),
+                                 variables=sorted(mod.variables),
+                                 model_classes=sorted(cls.__name__ for cls in
+                                                      mod.model_classes))
+        # Collect bundles (and the stdlib), which are also written for reference
+        assets = {}
+        for name, asset in self._assets.items():
+            if isinstance(asset, Bundle) or name == 'pyscript-std.js':
+                info = dict(hash=self.get_asset_hash(name))
+                if isinstance(asset, Bundle):
+                    info['deps'] = sorted(asset.deps)
+                    info['modules'] = [m.name for m in asset.modules]
+                assets[name] = info
+        
+        # Clear previous build
+        for subdir in ('modules', 'assets'):
+            if os.path.isdir(os.path.join(dirname, subdir)):
+                shutil.rmtree(os.path.join(dirname, subdir))
+        for subdir in ('modules', 'assets'):
+            os.makedirs(os.path.join(dirname, subdir))
+        
+        def write(text, *path):
+            with open(os.path.join(dirname, *path), 'wb') as f:
+                f.write(text.encode())
+        
+        # Write
+        for name, mod in self._modules.items():
+            write(mod.get_js(), 'modules', name + '.js')
+            write(mod.get_css(), 'modules', name + '.css')
+        for name in assets:
+            write(self._assets[name].to_string(), 'assets', name)
+        write(HasEventsJS.JSCODE, 'hasevents.js')
+        manifest = dict(format=FROZEN_FORMAT, flexx_version=__version__,
+                        modules=modules, assets=assets)
+        write(json.dumps(manifest, indent=2, sort_keys=True), 'manifest.json')
+        logger.info('Froze %i modules and %i assets to %r.' %
+                    (len(modules), len(assets), dirname))
+    
+    def warm_up(self):
+        """ Transpile all modules, and cache the content (plain and
+        compressed) and the define command of all bundles. A server with
+        multiple worker processes calls this before forking, so that the
+        workers share this memory (copy-on-write) instead of each doing
+        the work.
+        """
+        self._transpile_all_modules()
+        for name, asset in list(self._assets.items()):
+            if isinstance(asset, Bundle):
+                for encoding in (None, 'gzip', 'deflate'):
+                    self.get_asset_bytes(name, encoding)
+                self.get_define_command(name)
+    
+    def _transpile_all_modules(self):
+        # Transpile all modules. This can drag in more modules.
+        self.update_modules()
+        names = set()
+        while names != set(self._modules):
+            names = set(self._modules)
+            for name in sorted(names):
+                self._modules[name].get_js()
+            self.update_modules()
+    
+    def _load_frozen(self, dirname):
+        """ Load the modules from a build created with ``freeze()``.
+        Returns the source of the PyScript standard library. Also sets
+        the JS of the event system, so that it is not transpiled either.
+        """
+        
+        def read(*path):
+            with open(os.path.join(dirname, *path), 'rb') as f:
+                return f.read().decode()
+        
+        manifest = json.loads(read('manifest.json'))
+        if manifest.get('format', None) != FROZEN_FORMAT:
+            raise RuntimeError('Frozen build %r has an unsupported format.' %
+                               dirname)
+        if manifest['flexx_version'] != __version__:
+            raise RuntimeError('Frozen build %r was made with Flexx %s, not %s.' %
+                               (dirname, manifest['flexx_version'], __version__))
+        for name, info in manifest['modules'].items():
+            FrozenModule(name, self._modules, info,  # auto-registers
+                         read('modules', name + '.js'),
+                         read('modules', name + '.css'))
+        HasEventsJS.JSCODE = read('hasevents.js')
+        logger.info('Asset store loaded %i modules from frozen build %r.' %
+                    (len(manifest['modules']), dirname))
+        return read('assets', 'pyscript-std.js')
+    
     def get_asset(self, name):
         """ Get the asset instance corresponding to the given name or None
         if it not known.
@@ -316,6 +485,70 @@ class AssetStore:
         self._used_assets.add(asset.name)
         return asset
     
+    def get_asset_hash(self, name):
+        """ Get a hash of the content of the asset with the given name.
+        The hash changes when the content of the asset changes.
+        """
+        asset = self._assets[name]
+        version = asset.version if isinstance(asset, Bundle) else 0
+        cached_version, hash = self._asset_hashes.get(name, (None, None))
+        if cached_version != version:
+            hash = hashlib.sha1(asset.to_string().encode()).hexdigest()[:12]
+            self._asset_hashes[name] = version, hash
+        return hash
+    
+    def get_hashed_name(self, name):
+        """ Get the name of the asset with its content hash inserted before
+        the extension (e.g. "flexx-core.2b7d02ac5e3f.js"). Assets requested
+        by this name can be cached forever by the browser.
+        """
+        base, ext = name.rsplit('.', 1)
+        return '%s.%s.%s' % (base, self.get_asset_hash(name), ext)
+    
+    def get_asset_bytes(self, name, encoding=None):
+        """ Get the content of the asset with the given name as bytes,
+        optionally compressed with the given encoding ("gzip" or "deflate").
+        The result is cached until the content of the asset changes.
+        """
+        if encoding not in (None, 'gzip', 'deflate'):
+            raise ValueError('Invalid encoding for asset: %r' % encoding)
+        hash = self.get_asset_hash(name)
+        cached_hash, data = self._asset_bytes.get((name, encoding), (None, None))
+        if cached_hash != hash:
+            data = self._assets[name].to_string().encode()
+            if encoding == 'gzip':
+                data = gzip.compress(data)
+            elif encoding == 'deflate':
+                data = zlib.compress(data)
+            self._asset_bytes[(name, encoding)] = hash, data
+        return data
+    
+    def get_define_command(self, name):
+        """ Get the command to define the asset with the given name in the
+        client, as an ``EncodedCommand``. One command is kept for each
+        version of the asset, which is shared by all sessions.
+        """
+        hash = self.get_asset_hash(name)
+        cached_hash, command = self._asset_commands.get(name, (None, None))
+        if cached_hash != hash:
+            asset = self._assets[name]
+            prefix = 'DEFINE-%s %s ' % (get_define_suffix(asset), name)
+            command = EncodedCommand(prefix.encode() + self.get_asset_bytes(name))
+            self._asset_commands[name] = hash, command
+        return command
+    
+    def _clear_bundle_hashes(self):
+        # The content of bundles changes as modules get (re)defined
+        for name in list(self._asset_hashes):
+            if isinstance(self._assets[name], Bundle):
+                self._asset_hashes.pop(name)
+        for key in list(self._asset_bytes):
+            if isinstance(self._assets[key[0]], Bundle):
+                self._asset_bytes.pop(key)
+        for name in list(self._asset_commands):
+            if isinstance(self._assets[name], Bundle):
+                self._asset_commands.pop(name)
+    
     def get_data(self, name):
         """ Get the data (as bytes) corresponding to the given name or None
         if it not known.
@@ -23,6 +23,9 @@ class Flexx:
         self.app_name = ''
         self.session_id = ''
         self.ws_url = ''
+        self.page_commands = []
+        self.resume_timeout = 0
+        self.perf_interval = 0
         # Copy attributes from temporary flexx object
         if window.flexx.init:
             raise RuntimeError('Should not create Flexx object more than once.')
@@ -41,11 +44,27 @@ class Flexx:
         # Init internal variables
         self._init_time = time()
         self._pending_commands = []
+        self._outgoing = []
         self._asset_count = 0
+        self._held_commands = None
+        self._frames_received = 0  # to resume the session after a reconnect
+        self._reconnect_deadline = None
+        self._exited = False
+        # Performance stats, reported to the server in PERF commands
+        self._perf = self._new_perf_stats()
         self.ws = None
         self.last_msg = None
         self.classes = {}
         self.instances = {}
+        self._app_id = None
+        # Handlers for structured commands, see Session._send_op()
+        self._ops = {'CREATE': self._op_create,
+                     'SET_PROP': self._op_set_prop,
+                     'EMIT': self._op_emit,
+                     'DISPOSE': self.dispose_object,
+                     'CALL': self._op_call,
+                     'APP': self._op_app,
+                     }
         # Note: flexx.init() is not auto-called when Flexx is embedded
         window.addEventListener('load', self.init, False)
         window.addEventListener('unload', self.exit, False)  # not beforeunload
@@ -69,6 +88,15 @@ class Flexx:
                 self._remove_querystring()
             self.initSocket()
             self.initLogging()
+            if self.perf_interval > 0:
+                window.setInterval(self._send_perf, self.perf_interval * 1000)
+            # Run the commands that are embedded in the page, so that the
+            # app can render while the websocket is connecting
+            if len(self.page_commands):
+                self.spin(None)
+                commands, self.page_commands = self.page_commands, []
+                for msg in commands:
+                    self.command(msg)
     
     def _remove_querystring(self):
         # remove querystring ?session=x
@@ -80,8 +108,9 @@ class Flexx:
     
     def exit(self):
         """ Called when runtime is about to quit. """
+        self._exited = True
         if self.ws:  # is not null or undefined
-            self.ws.close()
+            self.ws.close(1000)  # a normal close means we're not coming back
             self.ws = None
     
     def get(self, id):  # todo: rename this to get_instance()?
@@ -130,17 +159,23 @@ class Flexx:
             if window.location.port:
                 address += ':' + window.location.port
             self.ws_url = '%s://%s/flexx/ws/%s' % (proto, address, self.app_name)
+            # The session id lets the server route to the worker that owns it
+            self.ws_url += '?session_id=' + self.session_id
         # Resolve public hostname
         self.ws_url = self.ws_url.replace('0.0.0.0', window.location.hostname)
-        # Open web socket in binary mode
+        # Open web socket. Commands are send as text, data as binary frames
         self.ws = ws = WebSocket(self.ws_url)
-        #ws.binaryType = "arraybuffer"  # would need utf-decoding -> slow
+        ws.binaryType = "arraybuffer"
         
         def on_ws_open(evt):
             window.console.info('Socket opened with session id ' + self.session_id)
-            ws.send('hiflexx ' + self.session_id)
+            ws.send('hiflexx ' + self.session_id + ' ' + str(self._frames_received))
+            self._flush_outgoing()  # messages produced before the socket opened
         def on_ws_message(evt):
             self.last_msg = msg = evt.data or evt
+            self._reconnect_deadline = None
+            if not (isinstance(msg, str) and msg.startswith('PING ')):
+                self._frames_received += 1  # pings are not send by the session
             if self._pending_commands is None:
                 # Direct mode
                 self.command(msg)
@@ -148,9 +183,23 @@ class Flexx:
                 # Indirect mode, to give browser draw-time during loading
                 if len(self._pending_commands) == 0:
                     window.setTimeout(self._process_commands, 0)
-                self._pending_commands.push(msg)
+                if isinstance(msg, str) and msg.startswith('BATCH '):
+                    self._pending_commands.extend(JSON.parse(msg[6:]))
+                else:
+                    self._pending_commands.push(msg)
         def on_ws_close(evt):
             self.ws = None
+            # Try to resume the session if the connection was lost (1006)
+            # or the server went away (1001), but not if it was closed by
+            # the server (e.g. because the client cannot keep up)
+            if self.resume_timeout > 0 and not self._exited:
+                if evt.code == 1001 or evt.code == 1006:
+                    if self._reconnect_deadline is None:
+                        self._reconnect_deadline = time() + self.resume_timeout
+                    if time() < self._reconnect_deadline:
+                        window.console.info('Lost connection, reconnecting ...')
+                        window.setTimeout(self.initSocket, 1000)
+                        return
             msg = 'Lost connection with server'
             if evt and evt.reason:
                 msg += ': %s (%i)' % (evt.reason, evt.code)
@@ -173,7 +222,8 @@ class Flexx:
         """
         if window.console.ori_log:
             return  # already initialized the loggers
-        # Keep originals
+        # Keep originals. Messages are sent via send(), so that they do
+        # not overtake messages that are waiting to be sent.
         window.console.ori_log = window.console.log
         window.console.ori_info = window.console.info or window.console.log
         window.console.ori_warn = window.console.warn or window.console.log
@@ -181,16 +231,13 @@ class Flexx:
         
         def log(msg):
             window.console.ori_log(msg)
-            if self.ws is not None:
-                self.ws.send("PRINT " + msg)
+            self.send("PRINT " + msg)
         def info(msg):
             window.console.ori_info(msg)
-            if self.ws is not None:
-                self.ws.send("INFO " + msg)
+            self.send("INFO " + msg)
         def warn(msg):
             window.console.ori_warn(msg)
-            if self.ws is not None:
-                self.ws.send("WARN " + msg)
+            self.send("WARN " + msg)
         def error(msg):
             evt = dict(message=str(msg), error=msg, preventDefault=lambda: None)
             on_error(evt)
@@ -208,8 +255,7 @@ class Flexx:
             # Handle error
             evt.preventDefault()  # Don't do the standard error 
             window.console.ori_error(msg)
-            if self.ws is not None:
-                self.ws.send("ERROR " + evt.message)
+            self.send("ERROR " + evt.message)
         on_error = on_error.bind(self)
         # Set new versions
         window.console.log = log
@@ -219,6 +265,31 @@ class Flexx:
         # Create error handler, so that JS errors get into Python
         window.addEventListener('error', on_error, False)
     
+    def send(self, msg):
+        """ Send a message to the server. Messages are collected and send
+        as a single frame once per animation frame.
+        """
+        if self.ws is None and self._reconnect_deadline is None:
+            return
+        self._outgoing.push(msg)
+        if len(self._outgoing) == 1:
+            # Animation frames are paused in hidden tabs
+            if window.requestAnimationFrame and not window.document.hidden:
+                window.requestAnimationFrame(self._flush_outgoing)
+            else:
+                window.setTimeout(self._flush_outgoing, 0)
+    
+    def _flush_outgoing(self):
+        if self.ws is None or self.ws.readyState != 1:
+            return  # not open yet; flushed when it is
+        messages, self._outgoing = self._outgoing, []
+        if len(messages) == 0:
+            return
+        elif len(messages) == 1:
+            self.ws.send(messages[0])
+        else:
+            self.ws.send('BATCH ' + JSON.stringify(messages))
+    
     def _process_commands(self):
         """ A less direct way to process commands, which gives the
         browser time to draw about every other JS asset. This is a
@@ -231,7 +302,7 @@ class Flexx:
             except Exception as err:
                 window.setTimeout(self._process_commands, 0)
                 raise err
-            if msg.startswith('DEFINE-'):
+            if isinstance(msg, str) and msg.startswith('DEFINE-'):
                 self._asset_count += 1
                 if (self._asset_count % 3) == 0:
                     if len(self._pending_commands):
@@ -239,47 +310,52 @@ class Flexx:
                     break
     
     def command(self, msg):
-        if msg.startswith('PING '):
-            self.ws.send('PONG ' + msg[5:])
+        """ Process a command from the server, and measure how long that takes.
+        """
+        t0 = self._now()
+        self._command(msg)
+        if not (isinstance(msg, str) and msg.startswith('BATCH ')):
+            name = self._get_command_type(msg)
+            stats = self._perf.commands[name]
+            if stats is undefined:
+                stats = self._perf.commands[name] = [0, 0, 0]
+            self._add_perf(stats, self._now() - t0)
+    
+    def _command(self, msg):
+        if self._held_commands is not None:
+            self._held_commands.push(msg)  # waiting for assets to load
+        elif isinstance(msg, list):
+            self._dispatch(msg)
+        elif not isinstance(msg, str):
+            self._receive_data(msg)
+        elif msg.startswith('PING '):
+            self._flush_outgoing()  # the pong must not overtake messages
+            self.ws.send('PONG ' + msg[5:] + ' ' + str(self._frames_received))
+        elif msg.startswith('BATCH '):
+            # Multiple commands combined in one message, process in order
+            for cmd in JSON.parse(msg[6:]):
+                self.command(cmd)
         elif msg == 'INIT-DONE':
             self.spin(None)
             while len(self._pending_commands):
                 self.command(self._pending_commands.pop(0))
             self._pending_commands = None
-            # print('init took', time() - self._init_time)
+            self._perf.init = self._now()  # i.e. since navigation start
         elif msg.startswith('PRINT '):
             window.console.ori_log(msg[6:])
         elif msg.startswith('EVAL '):
             window._ = eval(msg[5:])
-            self.ws.send('RET ' + window._)  # send back result
+            self.send('RET ' + window._)  # send back result
         elif msg.startswith('EXEC '):
             eval(msg[5:])  # like eval, but do not return result
         elif msg.startswith('DEFINE-JS ') or msg.startswith('DEFINE-JS-EVAL '):
-            self.spin()
             cmd, name, code = msg.split(' ', 2)
-            address = window.location.protocol + '//' + self.ws_url.split('/')[2]
-            code += '\n//# sourceURL=%s/flexx/assets/shared/%s\n' % (address, name)
-            if msg.startswith('DEFINE-JS-EVAL '):
-                eval(code)
-            else:
-                # With this method, sourceURL does not work on Firefox,
-                # but eval might not work for assets that don't "use strict"
-                # (e.g. Bokeh). Note, btw, that creating links to assets does
-                # not work because these won't be loaded on time.
-                el = window.document.createElement("script")
-                el.id = name
-                el.innerHTML = code
-                self._asset_node.appendChild(el)
+            self._define_asset(cmd[7:], name, code)
         elif msg.startswith('DEFINE-CSS '):
-            self.spin()
             cmd, name, code = msg.split(' ', 2)
-            address = window.location.protocol + '//' + self.ws_url.split('/')[2]
-            code += '\n/*# sourceURL=%s/flexx/assets/shared/%s*/\n' % (address, name)
-            el = window.document.createElement("style")
-            el.type = "text/css"
-            el.id = name
-            el.innerHTML = code
-            self._asset_node.appendChild(el)
+            self._define_asset('CSS', name, code)
+        elif msg.startswith('DEFINE-LINKS '):
+            self._load_assets(JSON.parse(msg[13:]))
         elif msg.startswith('TITLE '):
             window.document.title = msg[6:]
         elif msg.startswith('ICON '):
@@ -292,6 +368,178 @@ class Flexx:
             window.win1 = window.open(msg[5:], 'new', 'chrome')
         else:
             window.console.warn('Invalid command: "' + msg + '"')
+    
+    def _define_asset(self, kind, name, code):
+        """ Define an asset. The kind is "JS-EVAL", "JS" or "CSS".
+        """
+        t0 = self._now()
+        self._define_asset_now(kind, name, code)
+        self._add_perf(self._perf.assets, self._now() - t0)
+    
+    def _define_asset_now(self, kind, name, code):
+        self.spin()
+        address = window.location.protocol + '//' + self.ws_url.split('/')[2]
+        if kind == 'CSS':
+            code += '\n/*# sourceURL=%s/flexx/assets/shared/%s*/\n' % (address, name)
+            el = window.document.createElement("style")
+            el.type = "text/css"
+            el.id = name
+            el.innerHTML = code
+            self._asset_node.appendChild(el)
+            return
+        code += '\n//# sourceURL=%s/flexx/assets/shared/%s\n' % (address, name)
+        if kind == 'JS-EVAL':
+            eval(code)
+        else:
+            # With this method, sourceURL does not work on Firefox,
+            # but eval might not work for assets that don't "use strict"
+            # (e.g. Bokeh). Note, btw, that creating links to assets does
+            # not work because these won't be loaded on time.
+            el = window.document.createElement("script")
+            el.id = name
+            el.innerHTML = code
+            self._asset_node.appendChild(el)
+    
+    def _load_assets(self, links):
+        """ Load assets over HTTP, so that the browser can cache them. Each
+        link is [kind, name, url]. The assets are fetched in parallel, but
+        defined in the given order. Commands are held back until then.
+        """
+        self._held_commands = []
+        address = window.location.protocol + '//' + self.ws_url.split('/')[2]
+        sources = {}
+        
+        def fetch(i):
+            def on_load(code):
+                sources[i] = code
+                if len(sources.keys()) == len(links):
+                    on_all_loaded()
+            self._fetch_asset(address + links[i][2], on_load)
+        
+        def on_all_loaded():
+            for i in range(len(links)):
+                if sources[i] is not None:
+                    self._define_asset(links[i][0], links[i][1], sources[i])
+            # Process commands that came in meanwhile (these may load assets)
+            commands, self._held_commands = self._held_commands, None
+            for msg in commands:
+                self.command(msg)
+        
+        for i in range(len(links)):
+            fetch(i)
+    
+    def _fetch_asset(self, url, callback):
+        xhr = window.XMLHttpRequest()
+        def on_load():
+            if xhr.status == 200:
+                callback(xhr.responseText)
+            else:
+                on_error()
+        def on_error():
+            window.console.error('Could not load asset ' + url)
+            callback(None)
+        xhr.onload = on_load
+        xhr.onerror = on_error
+        xhr.open('GET', url, True)
+        xhr.send()
+    
+    def _dispatch(self, cmd):
+        """ Process a structured command: a list [opcode, id, name, payload].
+        """
+        func = self._ops[cmd[0]]
+        if func is undefined:
+            window.console.warn('Invalid opcode: "' + cmd[0] + '"')
+        else:
+            func(cmd[1], cmd[2], cmd[3])
+    
+    def _get_target(self, id):
+        if id == '@app':
+            id = self._app_id  # broadcasted command
+        ob = self.instances[id]
+        if ob is undefined:
+            window.console.warn('Command for unknown object ' + id)
+        return ob
+    
+    def _op_create(self, id, name, payload):
+        Cls = self.classes[name]
+        py_events, py_known_events = serializer.loads(payload)
+        self.instances[id] = Cls(id, py_events, py_known_events)
+    
+    def _op_set_prop(self, id, name, payload):
+        ob = self._get_target(id)
+        if ob is not undefined:
+            ob._set_prop_from_py(name, payload)
+    
+    def _op_emit(self, id, name, payload):
+        ob = self._get_target(id)
+        if ob is not undefined:
+            ob._emit_from_py(name, payload)
+    
+    def _op_call(self, id, name, payload):
+        ob = self._get_target(id)
+        if ob is not undefined:
+            args = serializer.loads(payload) if payload else []
+            ob[name](*args)
+    
+    def _op_app(self, id, name, payload):
+        self._app_id = id
+    
+    ## Performance stats
+    
+    def _now(self):
+        # Time in ms, since the start of navigation (if available)
+        if window.performance and window.performance.now:
+            return window.performance.now()
+        return (time() - self._init_time) * 1000
+    
+    def _new_perf_stats(self):
+        # Stats are [count, total, max] in ms
+        return {'commands': {}, 'assets': [0, 0, 0], 'handlers': [0, 0, 0],
+                'init': None}
+    
+    def _add_perf(self, stats, duration):
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] = max(stats[2], duration)
+    
+    def _get_command_type(self, msg):
+        if isinstance(msg, list):
+            return msg[0]
+        elif not isinstance(msg, str):
+            return 'DATA'
+        i = msg.find(' ')
+        return msg[:i] if i > 0 else msg
+    
+    def _perf_loop_iter(self, count, duration):
+        """ Called by the event loop after processing pending handlers.
+        """
+        if count > 0:
+            self._add_perf(self._perf.handlers, duration * 1000)
+    
+    def _send_perf(self):
+        """ Send the performance stats that were collected since the
+        previous call to the server, see Session._receive_perf().
+        """
+        perf = self._perf
+        if (len(perf.commands.keys()) or perf.assets[0] or perf.handlers[0] or
+                perf.init is not None):
+            self._perf = self._new_perf_stats()
+            self.send('PERF ' + JSON.stringify(perf))
+    
+    def _receive_data(self, buffer):
+        """ Process a binary frame (an ArrayBuffer) that contains data
+        for a model. See make_data_frame() in _session.py for the layout.
+        """
+        view = window.DataView(buffer)
+        header_size = view.getUint32(0, True)
+        data_size = view.getUint32(4, True)
+        i0 = 8 + header_size
+        header = JSON.parse(decodeUtf8(buffer.slice(8, i0)))
+        ob = self.instances[header.id]
+        if ob is undefined:
+            window.console.warn('Received data for unknown object ' + header.id)
+        else:
+            ob.receive_data(buffer.slice(i0, i0 + data_size), header.meta)
 
 
 def decodeUtf8(arrayBuffer):
@@ -130,6 +130,7 @@ class NoteBookHelper:
             self._session._ws = self
     
     def release(self):
+        self._session._flush_commands()  # commands are buffered per iteration
         if self._session._ws is self:
             self._session._ws = self._real_ws
         self._real_ws = None
@@ -190,7 +191,8 @@ def init_notebook():
     
     proto = 'wss' if server.protocol == 'https' else 'ws'
     
-    url = '%s://%s:%i/flexx/ws/%s' % (proto, host, port, session.app_name)
+    url = '%s://%s:%i/flexx/ws/%s?session_id=%s' % (proto, host, port,
+                                                    session.app_name, session.id)
 
     flexx_pre_init = """<script>window.flexx = {};
                                 window.flexx.app_name = "%s";
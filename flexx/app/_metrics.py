@@ -0,0 +1,340 @@
+"""
+Server metrics, exposed in the Prometheus text format at ``/flexx/metrics``.
+
+Counters and histograms are updated by the session and the server as
+things happen. Gauges (e.g. the number of sessions) are set by collector
+functions when the metrics are rendered, so that they cost nothing in
+between. The metrics are per process; with multiple workers, each worker
+has its own metrics (``/flexx/metrics/<worker_index>`` is forwarded to
+that worker).
+"""
+
+import time
+
+from ..event import loop
+
+
+# Buckets for histograms of durations, in seconds
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    table = {ord('\\'): '\\\\', ord('"'): '\\"', ord('\n'): '\\n'}
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).translate(table))
+                             for name, value in zip(names, values))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    elif isinstance(value, int) or value == int(value):
+        return '%i' % value
+    return repr(value)
+
+
+class Metric:
+    """ Base class for metrics. The values are stored per tuple of label
+    values, which must match the label names given at initialization.
+    """
+
+    TYPE = ''
+
+    def __init__(self, name, doc, labels=()):
+        self._name = name
+        self._doc = doc
+        self._labels = tuple(labels)
+        self._values = {}
+
+    def __repr__(self):
+        return '<%s %r at 0x%x>' % (self.__class__.__name__, self._name,
+                                    id(self))
+
+    @property
+    def name(self):
+        """ The name of this metric.
+        """
+        return self._name
+
+    def get(self, *labels):
+        """ Get the value for the given label values.
+        """
+        return self._values.get(labels, 0)
+
+    def clear(self):
+        """ Remove all values.
+        """
+        self._values = {}
+
+    def _render(self):
+        lines = ['# HELP %s %s' % (self._name, self._doc),
+                 '# TYPE %s %s' % (self._name, self.TYPE)]
+        for labels, value in sorted(self._values.items()):
+            lines.append('%s%s %s' % (self._name,
+                                      _format_labels(self._labels, labels),
+                                      _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    """ A value that only goes up, e.g. the number of bytes send.
+    """
+
+    TYPE = 'counter'
+
+    def inc(self, labels=(), value=1):
+        """ Increase the value for the given tuple of label values.
+        """
+        self._values[labels] = self._values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    """ A value that can go up and down, e.g. the number of sessions.
+    """
+
+    TYPE = 'gauge'
+
+    def set(self, labels=(), value=0):
+        """ Set the value for the given tuple of label values.
+        """
+        self._values[labels] = value
+
+
+class Histogram(Metric):
+    """ A distribution of observed values, e.g. durations, counted in
+    cumulative buckets.
+    """
+
+    TYPE = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, doc, labels)
+        self._buckets = tuple(sorted(buckets)) + (float('inf'), )
+
+    def observe(self, value, labels=()):
+        """ Add an observation for the given tuple of label values.
+        """
+        entry = self._values.get(labels, None)
+        if entry is None:
+            entry = self._values[labels] = [[0] * len(self._buckets), 0, 0.0]
+        counts = entry[0]
+        for i, upper in enumerate(self._buckets):
+            if value <= upper:
+                counts[i] += 1
+                break
+        entry[1] += 1
+        entry[2] += value
+
+    def get(self, *labels):
+        """ Get a dict with the count and sum for the given label values.
+        """
+        entry = self._values.get(labels, None)
+        if entry is None:
+            return dict(count=0, sum=0.0)
+        return dict(count=entry[1], sum=entry[2])
+
+    def _render(self):
+        lines = ['# HELP %s %s' % (self._name, self._doc),
+                 '# TYPE %s %s' % (self._name, self.TYPE)]
+        names = self._labels + ('le', )
+        for labels, (counts, count, total) in sorted(self._values.items()):
+            cumulative = 0
+            for upper, n in zip(self._buckets, counts):
+                cumulative += n
+                label_str = _format_labels(names,
+                                           labels + (_format_value(upper), ))
+                lines.append('%s_bucket%s %i' % (self._name, label_str,
+                                                  cumulative))
+            label_str = _format_labels(self._labels, labels)
+            lines.append('%s_sum%s %s' % (self._name, label_str, repr(total)))
+            lines.append('%s_count%s %i' % (self._name, label_str, count))
+        return lines
+
+
+class MetricsRegistry:
+    """ The collection of metrics of this process. There is one instance
+    in ``flexx.app.metrics``.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def _add(self, metric):
+        if metric.name in [m.name for m in self._metrics]:
+            raise ValueError('Metric %r already exists.' % metric.name)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, doc, labels=()):
+        """ Create and register a Counter.
+        """
+        return self._add(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=()):
+        """ Create and register a Gauge.
+        """
+        return self._add(Gauge(name, doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=TIME_BUCKETS):
+        """ Create and register a Histogram.
+        """
+        return self._add(Histogram(name, doc, labels, buckets))
+
+    def get_metric(self, name):
+        """ Get the metric with the given name, or None.
+        """
+        for metric in self._metrics:
+            if metric.name == name:
+                return metric
+
+    def add_collector(self, func):
+        """ Register a function that is called before the metrics are
+        rendered, e.g. to set gauges.
+        """
+        self._collectors.append(func)
+
+    def render(self):
+        """ Get all metrics as a string in the Prometheus text format.
+        """
+        for func in self._collectors:
+            func()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric._render())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+# Updated as things happen
+
+frames_sent = metrics.counter(
+    'flexx_frames_sent_total', 'Number of websocket frames send, by kind.',
+    ['kind'])
+bytes_sent = metrics.counter(
+    'flexx_bytes_sent_total', 'Number of bytes send over websockets, by kind.',
+    ['kind'])
+commands_sent = metrics.counter(
+    'flexx_commands_sent_total', 'Number of commands send, by command type.',
+    ['command'])
+command_bytes_sent = metrics.counter(
+    'flexx_command_bytes_sent_total', 'Number of bytes of commands send, '
+    'by command type.', ['command'])
+frames_received = metrics.counter(
+    'flexx_frames_received_total', 'Number of websocket frames received.')
+bytes_received = metrics.counter(
+    'flexx_bytes_received_total', 'Number of bytes received over websockets.')
+commands_received = metrics.counter(
+    'flexx_commands_received_total', 'Number of commands received, by '
+    'command type.', ['command'])
+command_bytes_received = metrics.counter(
+    'flexx_command_bytes_received_total', 'Number of bytes of commands '
+    'received, by command type.', ['command'])
+assets_served = metrics.counter(
+    'flexx_asset_bytes_served_total', 'Number of bytes of assets and data '
+    'served over http.', ['kind'])
+handler_time = metrics.histogram(
+    'flexx_handler_seconds', 'Time spent in event handlers (in Python).')
+roundtrip_time = metrics.histogram(
+    'flexx_roundtrip_seconds', 'Time between sending a PING to a client and '
+    'receiving its PONG.')
+loop_lag = metrics.histogram(
+    'flexx_ioloop_lag_seconds', 'How much later than scheduled a periodic '
+    'callback on the IOLoop is called.')
+client_commands = metrics.counter(
+    'flexx_client_commands_total', 'Number of commands processed by clients, '
+    'by command type.', ['command'])
+client_command_time = metrics.counter(
+    'flexx_client_command_seconds_total', 'Time that clients spent processing '
+    'commands, by command type.', ['command'])
+client_assets = metrics.counter(
+    'flexx_client_assets_total', 'Number of assets defined by clients.')
+client_asset_time = metrics.counter(
+    'flexx_client_asset_seconds_total', 'Time that clients spent defining '
+    '(evaluating) assets.')
+client_handler_time = metrics.counter(
+    'flexx_client_handler_seconds_total', 'Time that clients spent in event '
+    'handlers (in JS).')
+client_init_time = metrics.histogram(
+    'flexx_client_init_seconds', 'Time between a client starting to load '
+    'the page and it being initialized.')
+
+# Set by the collector
+
+sessions = metrics.gauge(
+    'flexx_sessions', 'Number of sessions, by app and status.',
+    ['app', 'status'])
+pool_ready = metrics.gauge(
+    'flexx_session_pool_ready', 'Number of pre-instantiated sessions, by app.',
+    ['app'])
+queue_depth = metrics.gauge(
+    'flexx_queue_commands', 'Number of commands and frames waiting to be '
+    'send, by app.', ['app'])
+queue_bytes = metrics.gauge(
+    'flexx_queue_bytes', 'Number of bytes waiting to be send or in flight, '
+    'by app.', ['app'])
+data_bytes = metrics.gauge(
+    'flexx_data_bytes', 'Number of bytes of session data kept available to '
+    'the client, by app.', ['app'])
+roundtrip_quantiles = metrics.gauge(
+    'flexx_roundtrip_quantile_seconds', 'Quantiles of the recent round-trip '
+    'times of connected sessions, by app.', ['app', 'quantile'])
+uptime = metrics.gauge(
+    'flexx_uptime_seconds', 'Number of seconds since this process imported '
+    'flexx.app.')
+
+IMPORT_TIME = time.time()
+
+
+def get_command_type(command):
+    """ Get the type of a command, as used for the labels of the metrics:
+    the opcode of a structured command, the first word of a string command,
+    or "DATA" for a binary data frame.
+    """
+    if isinstance(command, list):
+        return command[0]
+    elif isinstance(command, str):
+        return command.partition(' ')[0]
+    elif command.__class__ is bytes:
+        return 'DATA'
+    else:  # EncodedCommand
+        return command[:32].partition(b' ')[0].decode()
+
+
+def _collect_session_metrics():
+    from ._app import manager  # noqa - circular dependency
+    for metric in (sessions, pool_ready, queue_depth, queue_bytes, data_bytes,
+                   roundtrip_quantiles):
+        metric.clear()
+    for name, (app, pending, connected) in manager._appinfo.items():
+        nsuspended = len([s for s in connected.values()
+                          if s.status != s.STATUS.CONNECTED])
+        sessions.set((name, 'pending'), len(pending))
+        sessions.set((name, 'connected'), len(connected) - nsuspended)
+        sessions.set((name, 'suspended'), nsuspended)
+        pool_ready.set((name, ), len(manager._pools.get(name, ())))
+        depth = nbytes = ndata = 0
+        for session in list(pending.values()) + list(connected.values()):
+            depth += (len(session._pending_commands) +
+                      len(session._send_queue) + len(session._command_buffer))
+            nbytes += session._get_buffered_size()
+            # Blobs for send_data() are kept until the client retrieves them
+            for data in (session._data, session._data_volatile):
+                ndata += sum(len(d) for d in data.values())
+        queue_depth.set((name, ), depth)
+        queue_bytes.set((name, ), nbytes)
+        data_bytes.set((name, ), ndata)
+        stats = manager.get_latency_stats(name)
+        if stats['count']:
+            for quantile, key in (('0.5', 'p50'), ('0.95', 'p95'),
+                                  ('1', 'max')):
+                roundtrip_quantiles.set((name, quantile), stats[key])
+    uptime.set((), time.time() - IMPORT_TIME)
+
+
+metrics.add_collector(_collect_session_metrics)
+loop.add_handler_observer(lambda handler, duration:
+                          handler_time.observe(duration))
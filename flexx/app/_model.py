@@ -66,7 +66,6 @@ attributes and handlers can be created here.
 """
 
 import sys
-import json
 import threading
 
 from .. import event
@@ -90,8 +89,6 @@ from ._clientcore import serializer
 
 manager = None  # Set by __init__ to prevent circular dependencies
 
-reprs = json.dumps
-
 
 def get_model_classes():
     """ Get a list of all known Model subclasses.
@@ -144,6 +141,29 @@ def stub_emitter_func_py(self, *args):
     raise RuntimeError('This emitter can only be called from JavaScript')
 
 
+class LazyJSCode:
+    """ Descriptor for ``Model.JS.CODE``. Gets the JS code for the Model
+    class (with meta info) on first access, and then replaces itself with it.
+    """
+    
+    def __init__(self, cls):
+        self._cls = cls
+    
+    def __get__(self, ob, owner):
+        if owner is not self._cls.JS:
+            return self  # inherited by a JS class that is being set up
+        # Remove self during transpiling, so that we are not seen as a
+        # class attribute, and restore if transpiling fails.
+        del self._cls.JS.CODE
+        try:
+            code = self._cls._get_js()
+        except Exception:
+            self._cls.JS.CODE = self
+            raise
+        self._cls.JS.CODE = code
+        return code
+
+
 class ModelMeta(HasEventsMeta):
     """ Meta class for Model
     Set up proxy properties in Py/JS.
@@ -219,8 +239,10 @@ class ModelMeta(HasEventsMeta):
         # Write __jsmodule__; an optimization for our module/asset system
         cls.__jsmodule__ = get_mod_name(sys.modules[cls.__module__])
         
-        # Set JS, META, and CSS for this class
-        cls.JS.CODE = cls._get_js()
+        # Set JS, META, and CSS for this class. The JS is transpiled on
+        # first use, so that importing a module with many Model classes
+        # does not transpile those that are not used.
+        cls.JS.CODE = LazyJSCode(cls)
         cls.CSS = cls.__dict__.get('CSS', '')
     
     def _get_js(cls):
@@ -246,6 +268,7 @@ class ModelMeta(HasEventsMeta):
         if cls.mro()[1] is event.HasEvents:
             code.append('flexx.serializer.add_reviver("Flexx-Model",'
                         ' flexx.classes.Model.prototype.__from_json__);\n')
+            code.append('loop.add_iter_observer(flexx._perf_loop_iter);\n')
         # Return with meta info
         js = JSString('\n'.join(code))
         js.meta = meta
@@ -381,16 +404,10 @@ class Model(with_metaclass(ModelMeta, event.HasEvents)):
         
         # Further initialization of attributes
         self.__event_types_js = event_types_js
-        self.__pending_events_from_js = []
-        self.__pending_props_from_js = []
         
         # Instantiate JavaScript version of this class
-        clsname = 'flexx.classes.' + self.__class__.__name__
-        cmd = 'flexx.instances.%s = new %s(%s, %s, %s);' % (
-                self._id, clsname, reprs(self._id),
-                serializer.saves(event_types_py),
-                serializer.saves(known_event_types_py))
-        self._session._exec(cmd)
+        txt = serializer.saves([event_types_py, known_event_types_py])
+        self._session._send_op('CREATE', self._id, self.__class__.__name__, txt)
         
         # Init HasEvents, but delay initialization of handlers
         # We init after producing the JS command to create the corresponding
@@ -406,12 +423,12 @@ class Model(with_metaclass(ModelMeta, event.HasEvents)):
         # properties are initialized, but the handlers not yet.
         with self:
             self.init(*init_args)
-        self._session._exec('flexx.instances.%s.init();' % self._id)
+        self._session._send_op('CALL', self._id, 'init')
         
         # Initialize handlers for Python and for JS. Done after init()
         # so that they can connect to newly created sub Models.
         self._init_handlers()
-        self._session._exec('flexx.instances.%s._init_handlers();' % self._id)
+        self._session._send_op('CALL', self._id, '_init_handlers')
         self._session.keep_alive(self)
     
     def __repr__(self):
@@ -461,8 +478,7 @@ class Model(with_metaclass(ModelMeta, event.HasEvents)):
         """
         if self.session.status:
             try:
-                cmd = 'flexx.dispose_object("%s")' % self.id
-                self._session._exec(cmd)
+                self._session._send_op('DISPOSE', self.id)
             except Exception:
                 pass  # ws can be closed/gone if this gets invoked from __del__
         super().dispose()
@@ -487,7 +503,9 @@ class Model(with_metaclass(ModelMeta, event.HasEvents)):
         """
         # Use a direct approach to avoid event system here
         v = bool(v)
-        self.call_js('_sync_props = true' if v else '_sync_props = false')
+        if not self._disposed:
+            txt = serializer.saves(['_sync_props', v])
+            self._session._send_op('CALL', self._id, '_set_attr_from_py', txt)
         return v
     
     def __setattr__(self, name, value):
@@ -498,24 +516,15 @@ class Model(with_metaclass(ModelMeta, event.HasEvents)):
         if isinstance(value, Model) and not self._disposed:
             if not (name in self.__properties__ or
                     (name.endswith('_value') and name[1:-6] in self.__properties__)):
-                txt = serializer.saves(value)
-                cmd = 'flexx.instances.%s.%s = flexx.serializer.loads(%s);' % (
-                    self._id, name, reprs(txt))
-                self._session._exec(cmd)
+                txt = serializer.saves([name, value])
+                self._session._send_op('CALL', self._id, '_set_attr_from_py', txt)
     
     def _set_prop_from_js(self, name, text):
+        # Called from session.py. The client sends the messages that it
+        # produces in one animation frame as a batch, so that the resulting
+        # events are handled collectively in the next iteration.
         value = serializer.loads(text)
-        #self._set_prop(name, value, True)
-        if not self.__pending_props_from_js:
-            call_later(0.01, self.__set_prop_from_js_pending)
-        self.__pending_props_from_js.append((name, value))
-
-    def __set_prop_from_js_pending(self):
-        # Collect near-simultaneous prop settings in one handler call,
-        # see __emit_from_js_pending
-        pending, self.__pending_props_from_js = self.__pending_props_from_js, []
-        for name, value in pending:
-            self._set_prop(name, value, False, True)
+        self._set_prop(name, value, False, True)
     
     def _set_prop(self, name, value, _initial=False, fromjs=False):
         # This method differs from the JS version in that we *do
@@ -530,14 +539,14 @@ class Model(with_metaclass(ModelMeta, event.HasEvents)):
         if ischanged and issyncable and not fromjs and not self._disposed:
             value = getattr(self, name)  # use normalized value
             txt = serializer.saves(value)
-            cmd = 'flexx.instances.%s._set_prop_from_py(%s, %s);' % (
-                self._id, reprs(name), reprs(txt))
-            self._session._exec(cmd)
+            self._session._send_op('SET_PROP', self._id, name, txt)
     
     def _register_handler(self, *args):
         event_type = args[0].split(':')[0]
         if not self.get_event_handlers(event_type):
-            self.call_js('_new_event_type_hook("%s")' % event_type)
+            if not self._disposed:
+                txt = serializer.saves([event_type])
+                self._session._send_op('CALL', self._id, '_new_event_type_hook', txt)
         return super()._register_handler(*args)
     
     def _handlers_changed_hook(self):
@@ -545,37 +554,25 @@ class Model(with_metaclass(ModelMeta, event.HasEvents)):
             return
         handlers = self._HasEvents__handlers
         types = [name for name in handlers.keys() if handlers[name]]
-        txt = serializer.saves(types)
-        cmd = 'flexx.instances.%s._set_event_types_py(%s);' % (self._id, txt)
-        self._session._exec(cmd)
+        txt = serializer.saves([types])
+        self._session._send_op('CALL', self._id, '_set_event_types_py', txt)
     
     def _set_event_types_js(self, text):
         # Called from session.py
         self.__event_types_js = serializer.loads(text)
     
     def _emit_from_js(self, type, text):
+        # Called from session.py, see _set_prop_from_js
         ev = serializer.loads(text)
-        if not self.__pending_events_from_js:
-            call_later(0.01, self.__emit_from_js_pending)
-        self.__pending_events_from_js.append((type, ev))
-    
-    def __emit_from_js_pending(self):
-        # Tornado uses one new tornado-event to sends one JS event.
-        # This little mechanism is to collect JS events that were send
-        # together, so that we can make use of our ability to
-        # collectively handling events.
-        pending, self.__pending_events_from_js = self.__pending_events_from_js, []
-        for type, ev in pending:
-            self.emit(type, ev, True)
+        self.emit(type, ev, True)
     
     def emit(self, type, info=None, fromjs=False):
         ev = super().emit(type, info)
         isprop = type in self.__properties__ and type not in self.__local_properties__
         if not fromjs and not isprop and type in self.__event_types_js:
             if not self._disposed:
-                cmd = 'flexx.instances.%s._emit_from_py(%s, %r);' % (
-                    self._id, serializer.saves(type), serializer.saves(ev))
-                self._session._exec(cmd)
+                txt = serializer.saves(ev)
+                self._session._send_op('EMIT', self._id, type, txt)
     
     def call_js(self, call):
         if self._disposed:
@@ -585,12 +582,12 @@ class Model(with_metaclass(ModelMeta, event.HasEvents)):
         self._session._exec(cmd)
     
     def send_data(self, data, meta=None):
-        """ Send data to the JS side, where ``retreive_data()`` will be called,
-        which will eventually call ``receive_data()`` with the corresponding
-        data and meta data.
+        """ Send data to the JS side, where ``receive_data()`` will be called
+        with the corresponding data and meta data.
         
-        AJAX is used to retrieve the data. In the future we may want to use
-        a dedicated binary websocket for better performance.
+        A blob is pushed to the client in a binary websocket frame. URLs
+        (and blobs in exported apps) are retrieved by the client using AJAX,
+        via ``retrieve_data()``.
         
         Parameters:
             data (bytes, str): the data blob. Can also be a URL (a string
@@ -608,7 +605,21 @@ class Model(with_metaclass(ModelMeta, event.HasEvents)):
         meta = {} if meta is None else meta
         # call_later(0, self.session._send_data, self.id, data, meta)
         return self.session._send_data(self.id, data, meta)
-    
+
+    @classmethod
+    def broadcast(cls, type, info=None):
+        """ Emit an event on the JS side of all connected app instances of
+        this class (and subclasses). Useful to e.g. push a chat message
+        or system status to all clients. The event is serialized only once,
+        see ``app.manager.broadcast()``. Returns the number of sessions
+        that the event was send to.
+        """
+        count = 0
+        for name, (app, _, _) in list(manager._appinfo.items()):
+            if issubclass(app.cls, cls):
+                count += manager.broadcast(name, type, info)
+        return count
+
     class JS:
         
         def __json__(self):
@@ -682,6 +693,9 @@ class Model(with_metaclass(ModelMeta, event.HasEvents)):
             """
             pass
         
+        def _set_attr_from_py(self, name, value):
+            self[name] = value
+        
         def _set_prop_from_py(self, name, text):
             value = serializer.loads(text)
             # Trick for when value is e.g. x.children with disposed children,
@@ -706,14 +720,14 @@ class Model(with_metaclass(ModelMeta, event.HasEvents)):
             if ischanged and issyncable:
                 value = self[name]
                 txt = serializer.saves(value)
-                self._ws.send('SET_PROP ' + [self.id, name, txt].join(' '))
+                window.flexx.send('SET_PROP ' + [self.id, name, txt].join(' '))
         
         def _handlers_changed_hook(self):
             handlers = self.__handlers
             types = [name for name in handlers.keys() if len(handlers[name])]
             text = serializer.saves(types)
             if self._ws:
-                self._ws.send('SET_EVENT_TYPES ' + [self.id, text].join(' '))
+                window.flexx.send('SET_EVENT_TYPES ' + [self.id, text].join(' '))
         
         def _set_event_types_py(self, event_types):
             self.__event_types_py = event_types
@@ -731,7 +745,7 @@ class Model(with_metaclass(ModelMeta, event.HasEvents)):
             if not frompy and not isprop and type in self.__event_types_py:
                 txt = serializer.saves(ev)
                 if self._ws:
-                    self._ws.send('EVENT ' + [self.id, type, txt].join(' '))
+                    window.flexx.send('EVENT ' + [self.id, type, txt].join(' '))
         
         def retrieve_data(self, url, meta):
             """ Make an AJAX call to retrieve a blob of data. When the
@@ -766,5 +780,77 @@ class Model(with_metaclass(ModelMeta, event.HasEvents)):
             print(self.id, 'received data but did not handle it')
 
 
+class SharedModel(Model):
+    """ A Model whose state belongs to the application rather than to a
+    single session. There is one Python object, which can be subscribed
+    to any number of sessions; each of these gets a JS version of the
+    model. A property change is validated (and its handlers invoked) once
+    in Python, and the new value is serialized once and send to all
+    subscribed sessions. Property changes that originate from JS are
+    applied in Python and then also send to all sessions.
+
+    A SharedModel is not associated with a session, and can e.g. be
+    instantiated at the module level. Subscribe a session (typically in
+    the ``init()`` of the app) before referencing the shared model from
+    other models in that session.
+
+    Example:
+
+        .. code-block:: py
+
+            class ServerStatus(SharedModel):
+
+                class Both:
+
+                    @event.prop
+                    def load(self, v=0):
+                        return float(v)
+
+            status = ServerStatus()
+
+            class MyApp(ui.Widget):
+
+                def init(self):
+                    status.subscribe(self.session)
+                    self.status = status
+
+                class JS:
+
+                    @event.connect('status.load')
+                    def _show_load(self, *events):
+                        ...
+    """
+
+    def __init__(self, *init_args, **kwargs):
+        if kwargs.get('session', None) is not None:
+            raise ValueError('A SharedModel cannot be given a session.')
+        from ._session import SharedSession  # noqa - circular dependency
+        kwargs['session'] = SharedSession()
+        super().__init__(*init_args, **kwargs)
+
+    def subscribe(self, session):
+        """ Subscribe the given session to this model. This creates the
+        JS version of the model in the session's client. Subscribing
+        a session more than once has no effect.
+        """
+        if self._disposed:
+            raise RuntimeError('Cannot subscribe to a disposed SharedModel.')
+        self._session._subscribe(session)
+
+    def unsubscribe(self, session):
+        """ Unsubscribe the given session from this model. This removes the
+        JS version of the model from the session's client. Closed
+        sessions are unsubscribed automatically.
+        """
+        self._session._unsubscribe(session)
+
+    def send_data(self, data, meta=None):
+        raise RuntimeError('SharedModel does not support send_data().')
+
+    def _set_prop(self, name, value, _initial=False, fromjs=False):
+        # A change from one client is synced to all clients
+        super()._set_prop(name, value, _initial, False)
+
+
 # Make model objects de-serializable
 serializer.add_reviver('Flexx-Model', Model.__from_json__)
@@ -115,6 +115,7 @@ class JSModule:
         self._js_values = {}
         # Dependencies
         self._deps = {}  # mod_name -> [mod_as_name, *imports]
+        self._unresolved_classes = set()  # names of Model classes
         # Caches
         self._js_cache = None
         self._css_cache = None
@@ -150,6 +151,7 @@ class JSModule:
         """ The (unsorted) set of dependencies (names of other modules) for
         this module.
         """
+        self._collect_dependencies_from_model_classes()
         return set(self._deps.keys())
     
     @property
@@ -247,9 +249,9 @@ class JSModule:
                 # Define here
                 self._provided_names.add(name)
                 self._model_classes[name] = val
-                # Recurse
+                # Recurse (deps from the JS code are collected lazily)
                 self._collect_dependencies_from_bases(val)
-                self._collect_dependencies(**val.JS.CODE.meta)
+                self._unresolved_classes.add(name)
             else:
                 # Import from another module
                 # not needed per see; bound via window.flexx.classes
@@ -316,6 +318,18 @@ class JSModule:
         for name in reversed(sorted(vars_unknown)):
             self.add_variable(name, name in vars_global)
     
+    def _collect_dependencies_from_model_classes(self):
+        """
+        Collect dependencies corresponding to names used in the JS of the
+        Model classes defined in this module. This is done only when the
+        dependencies or the JS are needed, so that Model classes that are
+        not used are never transpiled.
+        """
+        while self._unresolved_classes:
+            name = self._unresolved_classes.pop()
+            cls = self._model_classes[name]
+            self._collect_dependencies(**cls.JS.CODE.meta)
+    
     def _collect_dependencies_from_bases(self, cls):
         """
         Collect dependencies based on the base classes of a class.
@@ -334,6 +348,7 @@ class JSModule:
     def get_js(self):
         """ Get the JS code for this module.
         """
+        self._collect_dependencies_from_model_classes()
         if self._js_cache is None:
             # Collect JS and sort by linenr
             js = [cls.JS.CODE for cls in self._model_classes.values()]
@@ -382,3 +397,94 @@ class JSModule:
                 css.append(cls.CSS)
             self._css_cache = '\n\n'.join(css)
         return self._css_cache
+
+
+class FrozenModule:
+    """
+    A FrozenModule represents a JSModule that was compiled ahead of time
+    using ``flexx build`` (see ``AssetStore.freeze()``). It provides the
+    same interface to the asset system as a JSModule, but its JS and CSS
+    are loaded from the build, so that no code is transpiled. Intended
+    for internal use only.
+    """
+    
+    def __init__(self, name, store, info, js, css):
+        if not isinstance(store, dict):
+            raise TypeError('FrozenModule needs a dict store.')
+        self._name = name
+        self._deps = set(info['deps'])
+        self._provided_names = set(info['variables'])
+        self._model_class_names = tuple(info['model_classes'])
+        self._js = js
+        self._css = css
+        # Self-register
+        self._store = store
+        if self.name in self._store:
+            raise RuntimeError('Module %s already exists!' % self.name)
+        self._store[self.name] = self
+    
+    def __repr__(self):
+        return '<%s %s with %i definitions>' % (self.__class__.__name__,
+                                                self.name,
+                                                len(self._provided_names))
+    
+    @property
+    def name(self):
+        """ The (qualified) name of this module.
+        """
+        return self._name
+    
+    @property
+    def filename(self):
+        """ The filename of the Python file that defines this module,
+        or the name of the module if it is not imported.
+        """
+        pymodule = sys.modules.get(self.name.replace('.__init__', ''), None)
+        return getattr(pymodule, '__file__', self.name)
+    
+    @property
+    def deps(self):
+        """ The (unsorted) set of dependencies (names of other modules) for
+        this module.
+        """
+        return set(self._deps)
+    
+    @property
+    def model_classes(self):
+        """ The Model classes defined in this module (that are imported).
+        """
+        pymodule = sys.modules.get(self.name.replace('.__init__', ''), None)
+        classes = [getattr(pymodule, name, None)
+                   for name in self._model_class_names]
+        return set([cls for cls in classes if cls is not None])
+    
+    @property
+    def variables(self):
+        """ The names of variables provided by this module.
+        """
+        return self._provided_names
+    
+    def add_variable(self, name, is_global=False):
+        """ Check that the variable with the given name is included in
+        the build. Raises a RuntimeError if the variable exists but is not
+        included, since the build is then out of date.
+        """
+        if name in self._provided_names:
+            return
+        pymodule = sys.modules.get(self.name.replace('.__init__', ''), None)
+        if not hasattr(pymodule, name):
+            logger.warn('JS in "%s" uses undefined variable %r.' %
+                        (self.filename, name))
+            return
+        raise RuntimeError('Variable %r of module %s is not in the frozen '
+                           'build; run "flexx build" again.' % (name, self.name))
+    
+    def get_js(self):
+        """ Get the JS code for this module.
+        """
+        return self._js
+    
+    def get_css(self):
+        """ Get the CSS code for this module.
+        """
+        return self._css
@@ -3,19 +3,25 @@ Definition of the Session class.
 """
 
 import re
+import math
 import time
 import json
+import struct
 import random
 import hashlib
 import weakref
 import datetime
+import collections
 from http.cookies import SimpleCookie
 
 from ._server import call_later
-from ._model import Model, new_type
-from ._asset import Asset, Bundle, solve_dependencies
-from ._assetstore import AssetStore, export_assets_and_data, INDEX
+from ._model import Model, SharedModel, new_type
+from ._asset import Asset, solve_dependencies
+from ._assetstore import AssetStore, EncodedCommand, export_assets_and_data, INDEX
+from ._assetstore import get_define_suffix
 from ._assetstore import assets as assetstore
+from ._clientcore import serializer
+from . import _metrics, _tracing
 from . import logger
 
 from .. import config
@@ -46,6 +52,98 @@ def get_random_string(length=24, allowed_chars=None):
     return ''.join(srandom.choice(allowed_chars) for i in range(length))
 
 
+# The index of this worker process, if the server uses multiple workers
+_worker_index = None
+
+
+def set_worker_index(index):
+    """ Set the index of the worker process that this process represents.
+    The server calls this when serving with multiple worker processes.
+    """
+    global _worker_index
+    _worker_index = None if index is None else int(index)
+
+
+def get_session_id():
+    """ Produce a new session id. When serving with multiple worker
+    processes, the id starts with the index of the worker that owns the
+    session (e.g. "3-xxx"), so that connections can be routed to it.
+    """
+    if _worker_index is None:
+        return get_random_string()
+    return '%i-%s' % (_worker_index, get_random_string())
+
+
+def get_session_worker(session_id):
+    """ Get the index of the worker process that owns the session with
+    the given id, or None if the id does not specify a worker.
+    """
+    head, sep, _ = session_id.partition('-')
+    if sep and head.isdigit():
+        return int(head)
+    return None
+
+
+def make_batch(commands):
+    """ Combine a list of commands into a single command that the client
+    unpacks and processes in order. Structured commands (lists) are always
+    send as part of a batch.
+    """
+    if len(commands) == 1 and isinstance(commands[0], str):
+        return commands[0]
+    return 'BATCH ' + reprs(commands)
+
+
+def make_data_frame(id, meta, data):
+    """ Create a binary frame to push a blob of data to a model. The
+    frame consists of the byte lengths of the header and the data (as
+    two little endian uint32's), a json header with the model id and the
+    meta data, and the data itself.
+    """
+    header = reprs({'id': id, 'meta': meta}).encode()
+    return struct.pack('<II', len(header), len(data)) + header + data
+
+
+def is_data_frame(command):
+    """ Get whether a command is a binary frame with data for a model.
+    """
+    return isinstance(command, bytes) and not isinstance(command, EncodedCommand)
+
+
+def command_size(command):
+    """ Get the (approximate) number of bytes that a command takes on the wire.
+    """
+    if isinstance(command, list):
+        return sum(len(x) + 3 for x in command if x) + 2
+    return len(command)
+
+
+def get_latency_stats(roundtrips):
+    """ Get a dict with the count, median (p50), 95th percentile (p95)
+    and maximum of the given round-trip times. The percentiles use the
+    nearest-rank method.
+    """
+    values = sorted(roundtrips)
+    n = len(values)
+    if not n:
+        return dict(count=0, p50=None, p95=None, max=None)
+    def rank(p):
+        return values[max(0, math.ceil(p * n) - 1)]
+    return dict(count=n, p50=rank(0.50), p95=rank(0.95), max=values[-1])
+
+
+CONGESTION_POLICIES = 'block', 'drop', 'disconnect'
+
+# The types of commands that the server sends to the client. The client
+# reports its time per type; other names are counted as "other", so that
+# a client cannot create arbitrary labels in the metrics.
+COMMAND_TYPES = frozenset(['CREATE', 'SET_PROP', 'EMIT', 'DISPOSE', 'CALL',
+                           'APP', 'DATA', 'PING', 'PRINT', 'EVAL', 'EXEC',
+                           'DEFINE-JS', 'DEFINE-JS-EVAL', 'DEFINE-CSS',
+                           'DEFINE-LINKS', 'INIT-DONE', 'TITLE', 'ICON',
+                           'OPEN'])
+
+
 class Session:
     """ A session between Python and the client runtime.
     This class is what holds together the app widget, the web runtime,
@@ -57,6 +155,7 @@ class Session:
     * Keep track of Model instances associated with the session.
     * Ensure that the client has all the module definitions it needs.
     * Allow the user to send data to the client.
+    * Limit the amount of data that is buffered for a slow client.
 
     """
 
@@ -70,7 +169,7 @@ class Session:
         self._creation_time = time.time()  # used by app manager
 
         # Id and name of the app
-        self._id = get_random_string()
+        self._id = get_session_id()
         self._app_name = app_name
 
         # To keep track of what modules are defined at the client
@@ -78,6 +177,8 @@ class Session:
         self._present_modules = set()  # module names that, plus deps
         self._present_assets = set()  # names of used associated assets
         self._assets_to_ignore = set()  # user settable
+        self._page_commands = []  # commands that are embedded in the page
+        self._link_assets = config.link_assets
 
         # Data for this session (in addition to the data provided by the store)
         self._data = {}
@@ -88,6 +189,9 @@ class Session:
         self._ws = None  # init websocket, will be set when a connection is made
         self._model = None  # Model instance, can be None if app_name is __default__
         self._closing = False  # Flag to help with shutdown
+        self._closed = False  # Set by close()
+        self._pooled = False  # Whether the app manager keeps it in a pool
+        self._shared_sessions = []  # SharedSession objects subscribed to
 
         # The session assigns model id's, keeps track of model objects and
         # sometimes keeps them alive for a short while.
@@ -100,13 +204,47 @@ class Session:
         # commands, which are send to the client as soon as it connects
         self._pending_commands = []
 
+        # Commands issued during one event loop iteration are collected
+        # and send to the client as a single websocket frame
+        self._command_buffer = []
+        self._flush_scheduled = False
+
+        # Property syncs in the current queue: (id, name) -> index
+        self._queued_props = {}
+        self._pending_size = 0
+
+        # Outgoing frames wait in a queue while too many bytes are in flight
+        # (written to the websocket, but not yet send over the network).
+        # Frames in the queue are [kind, payload, size].
+        self._send_queue = []
+        self._frames_in_flight = collections.deque()  # (future, size)
+        self._bytes_queued = 0
+        self._bytes_in_flight = 0
+        self._congested = False
+        self._high_water_mark = config.ws_high_water_mark
+        self._congestion_policy = config.ws_congestion_policy
+        if self._congestion_policy not in CONGESTION_POLICIES:
+            raise ValueError('Invalid congestion policy %r, must be one of %s.' %
+                             (self._congestion_policy, CONGESTION_POLICIES))
+
+        # Frames that are written to the websocket are numbered. If sessions
+        # can be resumed, the frames that the client has not acknowledged
+        # are kept, so they can be send again after a reconnect.
+        self._frame_seq = 0
+        self._replay_buffer = collections.deque()  # (seq, payload, size)
+        self._replay_size = 0
+        self._resumable = config.session_resume_timeout > 0
+        self._suspend_time = 0
+
+        # The round-trip times of recent pings, see latency_stats()
+        self._roundtrips = collections.deque(maxlen=config.session_latency_window)
+
+        # Time spent by the client, as reported in PERF commands
+        self._client_perf = {'commands': {}, 'assets': [0, 0.0, 0.0],
+                             'handlers': [0, 0.0, 0.0], 'init': None}
+
         # request related information
-        self._request = request
-        if request and request.cookies:
-            cookies = request.cookies
-        else:
-            cookies = {}
-        self._set_cookies(cookies)
+        self._set_request(request)
 
     def __repr__(self):
         t = '<%s for %r (%i) at 0x%x>'
@@ -151,13 +289,59 @@ class Session:
         * statys 2: connected
         * status 0: closed
         """
-        if self._ws is None:
+        if self._closed:
+            return self.STATUS.CLOSED  # closed by the server
+        elif self._ws is None:
             return self.STATUS.PENDING  # not connected yet
         elif self._ws.close_code is None:
             return self.STATUS.CONNECTED  # alive and kicking
         else:
             return self.STATUS.CLOSED  # connection closed
 
+    @property
+    def congested(self):
+        """ Whether more data is buffered for the client than the high
+        water mark (``config.ws_high_water_mark``) allows. When this happens,
+        superseded property updates are dropped, and the policy
+        (``config.ws_congestion_policy``) is applied: "block" keeps all
+        commands, "drop" discards queued data frames, and "disconnect"
+        closes the connection. Becomes False when the buffer is drained to
+        half the high water mark. Changes are emitted by
+        ``app.manager.congestion_changed``, so that producers can hold off.
+        """
+        return self._congested
+
+    def latency_stats(self):
+        """ Get a dict with statistics of the recent round-trip times (in
+        seconds) between the server and the client: the number of samples
+        (count), the median (p50), the 95th percentile (p95), the maximum
+        (max) and the most recent value (last). The client can only respond
+        to a ping when it is idle, so this is a direct measure of how busy
+        the client is (as well as of the network latency). The values are
+        None if no round-trips have been measured.
+        """
+        stats = get_latency_stats(self._roundtrips)
+        stats['last'] = self._roundtrips[-1] if self._roundtrips else None
+        return stats
+
+    def client_perf_stats(self):
+        """ Get a dict with the time that the client spent processing
+        commands, defining assets, and running handlers, as reported by
+        the client every ``config.client_perf_interval`` seconds. The
+        "commands" item maps each command type to a dict with the count,
+        and the total and max duration (in seconds), and "assets" and
+        "handlers" are such dicts too. "init" is the time between the start
+        of loading the page and the processing of INIT-DONE (or None).
+        """
+        def as_dict(stats):
+            return dict(count=stats[0], total=stats[1], max=stats[2])
+        perf = self._client_perf
+        return dict(commands=dict((name, as_dict(stats)) for name, stats
+                                  in perf['commands'].items()),
+                    assets=as_dict(perf['assets']),
+                    handlers=as_dict(perf['handlers']),
+                    init=perf['init'])
+
     @property
     def present_modules(self):
         """ The set of module names that is (currently) available at the client.
@@ -175,10 +359,22 @@ class Session:
     def close(self):
         """ Close the session: close websocket, close runtime, dispose app.
         """
+        self._closed = True
+        # Stop receiving the commands of shared models
+        for shared_session in list(self._shared_sessions):
+            shared_session._unsubscribe(self)
         # Stop guarding objects to break down any circular refs
         for id in list(self._instances_guarded.keys()):
             self._instances_guarded.pop(id)
         self._roundtrip_based_calllaters = []
+        self._command_buffer = []
+        self._pending_commands = []
+        self._pending_size = 0
+        self._queued_props = {}
+        self._send_queue = []
+        self._bytes_queued = 0
+        self._replay_buffer.clear()
+        self._replay_size = 0
         self._closing = True  # suppress warnings for session being closed.
         try:
 
@@ -214,10 +410,85 @@ class Session:
         # Set some app specifics
         # self._ws.command('ICON %s.ico' % self.id)
         # self._ws.command('TITLE %s' % self._config.title)
-        # Send pending commands
-        for command in self._pending_commands:
-            self._ws.command(command)
-        self._ws.command('INIT-DONE')
+        # Send pending commands (right away, export relies on that)
+        pending, self._pending_commands = self._pending_commands, []
+        self._pending_size = 0
+        self._command_buffer = pending + ['INIT-DONE'] + self._command_buffer
+        self._flush_commands()
+
+    def _set_pooled(self, pooled):
+        """ Called by the app manager when the session is put in the pool
+        of pre-instantiated sessions, and when it is handed out. Shared
+        models do not send their updates to pooled sessions, but send
+        their current state when the session is handed out.
+        """
+        self._pooled = bool(pooled)
+        if not self._pooled:
+            for shared_session in self._shared_sessions:
+                shared_session._resync(self)
+
+    def _suspend(self):
+        """ Called by the app manager when the websocket is lost, but the
+        client may reconnect (see ``config.session_resume_timeout``). The
+        session becomes pending, so that commands are queued meanwhile.
+        """
+        self._ws = None
+        self._suspend_time = time.time()
+        # Commands that were not yet turned into frames are kept
+        self._pending_commands = self._command_buffer + self._pending_commands
+        self._pending_size = sum(command_size(c) for c in self._pending_commands)
+        self._command_buffer = []
+        self._queued_props = {}
+        self._frames_in_flight.clear()
+        self._bytes_in_flight = 0
+
+    def _resume(self, ws, received):
+        """ Connect a suspended session to a new websocket. The received
+        arg is the number of frames that the client received. The frames
+        that it missed are send again, followed by the commands that were
+        queued while the session was suspended. Returns False if this is
+        not possible because the missed frames are no longer available.
+        """
+        if self._replay_buffer:
+            can_resume = self._replay_buffer[0][0] <= received + 1
+        else:
+            can_resume = received == self._frame_seq
+        if not can_resume or received > self._frame_seq:
+            return False
+        self._ws = ws
+        # Frames that are send again get the same sequence numbers
+        missed = [['replay', payload, size] for seq, payload, size in
+                  self._replay_buffer if seq > received]
+        self._frame_seq = received
+        self._replay_buffer.clear()
+        self._replay_size = 0
+        self._send_queue = missed + self._send_queue
+        self._bytes_queued += sum(frame[2] for frame in missed)
+        pending, self._pending_commands = self._pending_commands, []
+        self._pending_size = 0
+        self._command_buffer = pending + self._command_buffer
+        self._flush_commands()
+        self._send_frames()
+        return True
+
+    def _receive_ack(self, received):
+        """ Called when the client tells how many frames it has received;
+        these do not have to be kept for replay.
+        """
+        while self._replay_buffer and self._replay_buffer[0][0] <= received:
+            self._replay_size -= self._replay_buffer.popleft()[2]
+
+    def _set_request(self, request):
+        """ Set the request that this session originates from. For sessions
+        that are pre-instantiated (see ``App.serve()``), this is done when
+        the session is handed out.
+        """
+        self._request = request
+        if request and request.cookies:
+            cookies = request.cookies
+        else:
+            cookies = {}
+        self._set_cookies(cookies)
 
     def _set_cookies(self, cookies=None):
         """ To set cookies, must be an http.cookie.SimpleCookie object.
@@ -231,6 +502,9 @@ class Session:
         if self._model is not None:
             raise RuntimeError('Session already has an associated Model.')
         self._model = model
+        # Tell the client which model is the app, so that broadcasted
+        # commands can address it as "@app", see AppManager.broadcast()
+        self._send_op('APP', model.id)
 
     def _set_runtime(self, runtime):
         if self._runtime is not None:
@@ -338,9 +612,12 @@ class Session:
                 raise TypeError('session.send_data() got a string, but does '
                                 'not look like a URL: %r' % data)
         elif isinstance(data, bytes):
-            # Blob: store it, and tell client to retieve it with AJAX
-            # todo: have a second ws connection for pushing data
             meta['byteLength'] = len(data)
+            if self._can_push_binary():
+                # Blob: push it to the client in a binary frame
+                self._send_command(make_data_frame(id, meta, data))
+                return
+            # Blob: store it, and tell client to retieve it with AJAX
             data_name = 'blob-' + get_random_string()
             url = '/flexx/data/%s/%s' % (self.id, data_name)
             self._data_volatile[data_name] = data
@@ -351,8 +628,19 @@ class Session:
                             'not %s.' % data.__class__.__name__)
 
         # Tell JS to retrieve data
-        t = 'window.flexx.instances.%s.retrieve_data("%s", %s);'
-        self._exec(t % (id, url, reprs(meta)))
+        self._send_op('CALL', id, 'retrieve_data', reprs([url, meta]))
+
+    def _can_push_binary(self):
+        """ Get whether data (and encoded commands) can be pushed over the
+        websocket. Exported apps and the notebook replay commands as
+        JavaScript, so for these the client retrieves the data with AJAX
+        instead.
+        """
+        if self.id == self.app_name:
+            return False  # being exported
+        elif self._ws is None:
+            return True  # will connect to a websocket
+        return getattr(self._ws, 'accepts_binary', False)
 
     def add_data(self, name, data):
         """ Add data to serve to the client (e.g. images), specific to this
@@ -523,6 +811,7 @@ class Session:
         self._store.update_modules()  # Ensure up-to-date module definition
         mod = self._store.modules[mod_name]
         collect_module_and_deps(mod)
+        self._store.update_modules()  # Bundle modules found as dependencies
         f = lambda m: (m.name.startswith('__main__'), m.name)
         modules = solve_dependencies(sorted(modules, key=f))
 
@@ -553,36 +842,331 @@ class Session:
         # JS can be defined via eval() or by adding a <script> to the DOM.
         # The latter allows assets that do not use strict mode, but sourceURL
         # does not work on FF. So we only want to eval our own assets.
+        # Alternatively, we tell the client to load (non-remote) assets over
+        # HTTP, so that the browser can cache them. Subsequent assets are
+        # combined in one command, so that the client can load them in
+        # parallel; they are defined in order.
+        link = self._can_link_assets()
+        links = []
         for asset in assets:
             if asset.name in self._assets_to_ignore:
                 continue
             logger.debug('Loading asset %s' % asset.name)
-            # Determine command suffix. All our sources come in bundles,
-            # for which we use eval because it makes sourceURL work on FF.
-            suffix = asset.name.split('.')[-1].upper()
-            if suffix == 'JS' and isinstance(asset, Bundle):
-                suffix = 'JS-EVAL'
-            t = 'DEFINE-%s %s %s'
-            self._send_command(t % (suffix, asset.name, asset.to_string()))
+            suffix = get_define_suffix(asset)
+            if link and not asset.remote:
+                url = '/flexx/assets/shared/' + self._store.get_hashed_name(asset.name)
+                links.append([suffix, asset.name, url])
+                continue
+            if links:
+                self._send_command('DEFINE-LINKS ' + reprs(links))
+                links = []
+            if self._can_push_binary():
+                # The store keeps one encoded command that all sessions share
+                self._send_command(self._store.get_define_command(asset.name))
+            else:
+                t = 'DEFINE-%s %s %s'
+                self._send_command(t % (suffix, asset.name, asset.to_string()))
+        if links:
+            self._send_command('DEFINE-LINKS ' + reprs(links))
+
+    def _can_link_assets(self):
+        """ Get whether the client should load module assets over HTTP
+        (``config.link_assets``). This requires a server, so exported apps
+        and the notebook get the assets pushed.
+        """
+        return self._link_assets and self._can_push_binary()
 
     ## Communication with the client
 
+    def _pop_page_commands(self):
+        """ Take the pending commands, so that they can be embedded in the
+        page (see get_page()). Asset definitions are omitted, because the
+        page includes the assets of the present modules. Stops at the first
+        data frame, so that the commands that remain are send over the
+        websocket in the right order. Returns all commands taken so far,
+        so that the page can be served more than once.
+        """
+        if self.status != self.STATUS.PENDING:
+            return []
+        n = 0
+        for command in self._pending_commands:
+            if is_data_frame(command):
+                break
+            n += 1
+            if isinstance(command, EncodedCommand):
+                command = command.decode()
+            if not (isinstance(command, str) and command.startswith('DEFINE-')):
+                self._page_commands.append(command)
+        self._pending_commands = self._pending_commands[n:]
+        self._pending_size = sum(command_size(c) for c in self._pending_commands)
+        self._queued_props = {}
+        return list(self._page_commands)
+
     def _send_command(self, command):
         """ Send the command, add to pending queue.
         """
+        if _tracing._recorders:
+            _tracing.command_sent(self, command, command_size(command))
         if self._closing:
             pass
         elif self.status == self.STATUS.CONNECTED:
-            self._ws.command(command)
+            self._queue_command(self._command_buffer, command)
+            if not self._flush_scheduled:
+                self._flush_scheduled = True
+                call_later(0, self._flush_commands)
         elif self.status == self.STATUS.PENDING:
-            self._pending_commands.append(command)
+            self._pending_size += self._queue_command(self._pending_commands,
+                                                      command)
+            if self._pending_size > self._high_water_mark:
+                self._check_congestion()
         else:
             #raise RuntimeError('Cannot send commands; app is closed')
             logger.warn('Cannot send commands; app is closed')
 
+    def _queue_command(self, queue, command):
+        """ Add a command to the given queue. A property sync replaces an
+        earlier sync of the same property, so that only the last value
+        is send. This is only done if no other kinds of commands were
+        queued in between, to preserve ordering with e.g. events.
+        Returns the number of bytes by which the queue grew.
+        """
+        if isinstance(command, list) and command[0] == 'SET_PROP':
+            key = command[1], command[2]
+            index = self._queued_props.get(key, None)
+            if index is not None:
+                old_size = command_size(queue[index])
+                queue[index] = command
+                return command_size(command) - old_size
+            self._queued_props[key] = len(queue)
+        elif self._queued_props:
+            self._queued_props = {}
+        queue.append(command)
+        return command_size(command)
+
+    def _flush_commands(self):
+        """ Send the buffered commands to the client. Called once per
+        event loop iteration (if there are commands to send). Asset
+        definitions are large, and are send as separate frames, as are
+        binary data frames and pre-encoded (e.g. broadcasted) commands.
+        Other commands are combined into a single frame. Pre-encoded
+        commands that are not asset definitions are interactive.
+        """
+        self._flush_scheduled = False
+        self._queued_props = {}
+        commands, self._command_buffer = self._command_buffer, []
+        if not commands or self.status != self.STATUS.CONNECTED:
+            return
+        batch = []
+        for command in commands:
+            if isinstance(command, EncodedCommand):
+                kind = 'asset' if command.startswith(b'DEFINE-') else 'interactive'
+            elif isinstance(command, bytes):
+                kind = 'data'
+            elif isinstance(command, str) and command.startswith('DEFINE-'):
+                kind = 'asset'
+            else:
+                batch.append(command)
+                continue
+            if batch:
+                self._queue_frame('interactive', batch)
+                batch = []
+            self._queue_frame(kind, command)
+        if batch:
+            self._queue_frame('interactive', batch)
+        self._send_frames()
+
+    def _queue_frame(self, kind, payload):
+        """ Add a frame to the send queue. The kind is "interactive" for
+        a batch of commands (a list, or a pre-encoded command), or "asset"
+        or "data" for bulk frames.
+        """
+        if isinstance(payload, list):
+            size = sum(command_size(command) for command in payload)
+        else:
+            size = len(payload)
+        self._send_queue.append([kind, payload, size])
+        self._bytes_queued += size
+
+    def _pop_frame(self):
+        """ Pop the next frame to send from the queue. Interactive frames
+        have priority over bulk frames, but do not overtake asset frames,
+        because these may define the classes that they use, nor frames
+        that are send again after a reconnect.
+        """
+        for i, frame in enumerate(self._send_queue):
+            if frame[0] == 'interactive':
+                return self._send_queue.pop(i)
+            elif frame[0] in ('asset', 'replay'):
+                break
+        return self._send_queue.pop(0)
+
+    def _send_frames(self):
+        """ Write queued frames to the websocket, until the number of bytes
+        in flight reaches the high water mark.
+        """
+        while self._send_queue and self._bytes_in_flight < self._high_water_mark:
+            kind, payload, size = self._pop_frame()
+            self._bytes_queued -= size
+            self._count_sent_frame(kind, payload, size)
+            if isinstance(payload, list):
+                payload = make_batch(payload)
+            future = self._ws.command(payload)
+            self._frame_seq += 1
+            if self._resumable:
+                self._keep_for_replay(payload, size)
+            # The websocket may return a future that resolves when written
+            if future is not None and not future.done():
+                self._bytes_in_flight += size
+                self._frames_in_flight.append((future, size))
+                future.add_done_callback(self._on_frame_written)
+        self._check_congestion()
+
+    def _count_sent_frame(self, kind, payload, size):
+        """ Update the server metrics for a frame that is about to be
+        written. The payload of an interactive frame is a list of commands
+        (or a pre-encoded command).
+        """
+        _metrics.frames_sent.inc((kind, ), 1)
+        _metrics.bytes_sent.inc((kind, ), size)
+        if isinstance(payload, list):
+            for command in payload:
+                labels = _metrics.get_command_type(command),
+                _metrics.commands_sent.inc(labels, 1)
+                _metrics.command_bytes_sent.inc(labels, command_size(command))
+        elif kind != 'replay':  # replayed frames were counted before
+            labels = _metrics.get_command_type(payload),
+            _metrics.commands_sent.inc(labels, 1)
+            _metrics.command_bytes_sent.inc(labels, size)
+
+    def _keep_for_replay(self, payload, size):
+        """ Keep a frame that was written, until the client acknowledges
+        it. The buffer is limited to ``config.session_replay_size`` bytes;
+        if older frames have to be dropped, the session cannot be resumed.
+        """
+        self._replay_buffer.append((self._frame_seq, payload, size))
+        self._replay_size += size
+        while self._replay_size > config.session_replay_size:
+            self._replay_size -= self._replay_buffer.popleft()[2]
+
+    def _on_frame_written(self, future):
+        """ Called when a frame has been written to the network.
+        """
+        # Frames are written in order. With older Tornado versions, only
+        # the future of the most recent write resolves.
+        if not any(f is future for f, size in self._frames_in_flight):
+            return
+        while self._frames_in_flight:
+            f, size = self._frames_in_flight.popleft()
+            self._bytes_in_flight -= size
+            if f is future:
+                break
+        if self.status == self.STATUS.CONNECTED:
+            self._send_frames()
+
+    def _get_buffered_size(self):
+        return self._bytes_in_flight + self._bytes_queued + self._pending_size
+
+    def _check_congestion(self):
+        """ Apply the congestion policy if more bytes are buffered than
+        the high water mark allows, and update the congested property.
+        """
+        if self._get_buffered_size() <= self._high_water_mark:
+            if self._congested and (self._get_buffered_size() <=
+                                    self._high_water_mark // 2):
+                self._set_congested(False)
+            return
+        # Only the last value of a property matters
+        self._coalesce_queued_props()
+        if self._get_buffered_size() > self._high_water_mark:
+            if self._congestion_policy == 'drop':
+                self._drop_queued_data()
+            elif self._congestion_policy == 'disconnect':
+                logger.warn('Closing session %s, because the client cannot '
+                            'keep up.' % self.id)
+                if self._ws is not None:
+                    self._ws.close(1013, 'Client cannot keep up.')
+                else:
+                    self.close()
+                    self._pending_commands = []
+                    self._pending_size = 0
+        if self._get_buffered_size() > self._high_water_mark:
+            if not self._congested:
+                logger.warn('Session %s is congested; %i bytes buffered.' %
+                            (self.id, self._get_buffered_size()))
+                self._set_congested(True)
+
+    def _set_congested(self, congested):
+        from ._app import manager  # noqa - circular dependency
+        self._congested = congested
+        manager.congestion_changed(self, congested)
+
+    def _coalesce_queued_props(self):
+        """ Remove property syncs from the queues that are superseded by a
+        later sync of the same property.
+        """
+        seen = set()
+        def coalesce(commands):
+            result = []
+            for command in reversed(commands):
+                if isinstance(command, list) and command[0] == 'SET_PROP':
+                    key = command[1], command[2]
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                result.append(command)
+            result.reverse()
+            return result
+        # Pending commands, or queued frames (most recent first)
+        self._queued_props = {}
+        self._pending_commands = coalesce(self._pending_commands)
+        self._pending_size = sum(command_size(c) for c in self._pending_commands)
+        for frame in reversed(self._send_queue):
+            if isinstance(frame[1], list):
+                frame[1] = coalesce(frame[1])
+                frame[2] = sum(command_size(command) for command in frame[1])
+        self._send_queue = [frame for frame in self._send_queue if frame[1]]
+        self._bytes_queued = sum(frame[2] for frame in self._send_queue)
+
+    def _drop_queued_data(self):
+        """ Discard data frames that are waiting to be send.
+        """
+        n = len([f for f in self._send_queue if f[0] == 'data'])
+        n += len([c for c in self._pending_commands if is_data_frame(c)])
+        if n:
+            logger.warn('Session %s is congested; dropping %i data frames.' %
+                        (self.id, n))
+        self._send_queue = [f for f in self._send_queue if f[0] != 'data']
+        self._bytes_queued = sum(frame[2] for frame in self._send_queue)
+        self._pending_commands = [c for c in self._pending_commands
+                                  if not is_data_frame(c)]
+        self._pending_size = sum(command_size(c) for c in self._pending_commands)
+
+    def _send_op(self, opcode, id, name=None, payload=None):
+        """ Send a structured command ``[opcode, id, name, payload]``, which
+        the client dispatches without evaluating JavaScript. The opcode is
+        CREATE, SET_PROP, EMIT, DISPOSE, CALL or APP. The payload is serialized
+        JSON, which is deserialized on the client when the command is
+        processed (so that it can refer to models created earlier).
+        """
+        command = [opcode, id, name, payload]
+        while command[-1] is None:
+            command.pop(-1)
+        self._send_command(command)
+
     def _receive_command(self, command):
         """ Received a command from JS.
         """
+        if _tracing._recorders:
+            _tracing.command_received(self, command)
+        if command.startswith('BATCH '):
+            # Messages that the client produced in one animation frame.
+            # Only the inner commands are counted, as when sending.
+            for cmd in json.loads(command[6:]):
+                self._receive_command(cmd)
+            return
+        labels = command.partition(' ')[0],
+        _metrics.commands_received.inc(labels, 1)
+        _metrics.command_bytes_received.inc(labels, len(command))
         if command.startswith('RET '):
             print(command[4:])  # Return value
         elif command.startswith('ERROR '):
@@ -594,6 +1178,8 @@ class Session:
             print(command[5:].strip())
         elif command.startswith('INFO '):
             logger.info('JS - ' + command[5:].strip())
+        elif command.startswith('PERF '):
+            self._receive_perf(command[5:])
         elif command.startswith('SET_PROP '):
             _, id, name, txt = command.split(' ', 3)
             ob = self._model_instances.get(id, None)
@@ -612,11 +1198,54 @@ class Session:
         else:
             logger.warn('Unknown command received from JS:\n%s' % command)
 
-    def _receive_pong(self, count):
+    def _receive_perf(self, text):
+        """ Process the performance stats that the client collected since
+        its previous report. Times are reported in ms, as [count, total,
+        max] per command type, for assets and for handlers.
+        """
+        try:
+            perf = json.loads(text)
+            commands = [(name if name in COMMAND_TYPES else 'other',
+                         self._parse_perf_stats(stats))
+                        for name, stats in perf.get('commands', {}).items()]
+            assets = self._parse_perf_stats(perf.get('assets', [0, 0, 0]))
+            handlers = self._parse_perf_stats(perf.get('handlers', [0, 0, 0]))
+            init = perf.get('init', None)
+            init = None if init is None else float(init) / 1000
+        except Exception:
+            logger.warn('Invalid PERF command received from JS:\n%s' % text[:200])
+            return
+        for name, stats in commands:
+            totals = self._client_perf['commands'].setdefault(name, [0, 0.0, 0.0])
+            self._add_perf_stats(totals, stats)
+            _metrics.client_commands.inc((name, ), stats[0])
+            _metrics.client_command_time.inc((name, ), stats[1])
+        self._add_perf_stats(self._client_perf['assets'], assets)
+        _metrics.client_assets.inc((), assets[0])
+        _metrics.client_asset_time.inc((), assets[1])
+        self._add_perf_stats(self._client_perf['handlers'], handlers)
+        _metrics.client_handler_time.inc((), handlers[1])
+        if init is not None:
+            self._client_perf['init'] = init
+            _metrics.client_init_time.observe(init)
+
+    def _parse_perf_stats(self, stats):
+        count, total, max_ = stats
+        return int(count), float(total) / 1000, float(max_) / 1000
+
+    def _add_perf_stats(self, totals, stats):
+        totals[0] += stats[0]
+        totals[1] += stats[1]
+        totals[2] = max(totals[2], stats[2])
+
+    def _receive_pong(self, count, roundtrip=None):
         """ Called by ws when it gets a pong. Thus gets called about
         every sec. Clear the guarded Model instances for which the
-        "timeout counter" has expired.
+        "timeout counter" has expired. The roundtrip is the number of
+        seconds since the ping was send (if known).
         """
+        if roundtrip is not None:
+            self._roundtrips.append(roundtrip)
         objects_to_clear = [ob for c, ob in
                            self._instances_guarded.values() if c <= count]
         for ob in objects_to_clear:
@@ -644,68 +1273,258 @@ class Session:
         self._send_command('EVAL ' + code)
 
 
+_shared_model_counter = 0
+
+
+class SharedSession:
+    """ Stand-in for the session of a SharedModel. The commands for the
+    model are collected during an event loop iteration, and then
+    serialized and encoded once. The resulting frame is send to all
+    subscribed sessions.
+    """
+
+    STATUS = Session.STATUS
+
+    def __init__(self):
+        self._model = None
+        self._sessions = []  # subscribed sessions, in order of subscription
+        self._stale = []  # pooled sessions that missed updates
+        self._create_command = None
+        self._event_types_command = None
+        self._commands = []
+        self._queued_props = {}
+        self._flush_scheduled = False
+
+    def __repr__(self):
+        return '<SharedSession for %r with %i subscribers>' % (
+            self._model, len(self.sessions))
+
+    @property
+    def id(self):
+        """ The id of this shared session.
+        """
+        return 'shared'
+
+    @property
+    def status(self):
+        """ The status of this session. A shared session is always considered
+        connected; commands are dropped if there are no subscribers.
+        """
+        return self.STATUS.CONNECTED
+
+    @property
+    def sessions(self):
+        """ The list of (non-closed) sessions that are subscribed.
+        """
+        for session in list(self._sessions):
+            if not session.status:
+                self._unsubscribe(session)
+        return list(self._sessions)
+
+    def _register_model(self, model):
+        """ Called by Model to give it an id. Note that the id must be
+        unique in all the sessions that the model is subscribed to.
+        """
+        global _shared_model_counter
+        if not isinstance(model, SharedModel):
+            raise TypeError('Only SharedModel objects can be created '
+                            'in the context of a SharedModel.')
+        if self._model is not None:
+            raise RuntimeError('SharedSession already has an associated Model.')
+        _shared_model_counter += 1
+        model._id = '%s_s%i' % (model.__class__.__name__, _shared_model_counter)
+        self._model = weakref.ref(model)
+
+    def keep_alive(self, ob, iters=4):
+        pass  # the shared model is kept alive by the user
+
+    def _subscribe(self, session):
+        """ Create the JS side of the model in the given session, and send
+        the current state.
+        """
+        model = self._model()
+        if session in self._sessions:
+            return
+        elif not session.status:
+            raise RuntimeError('Cannot subscribe a closed session.')
+        session._register_model_class(model.__class__)
+        session._model_instances[model.id] = model  # for commands from JS
+        commands = [self._create_command] + self._get_state_commands()
+        commands.append(['CALL', model.id, 'init'])
+        commands.append(['CALL', model.id, '_init_handlers'])
+        if self._event_types_command:
+            commands.append(self._event_types_command)
+        for command in commands:
+            session._send_command(command)
+        self._sessions.append(session)
+        session._shared_sessions.append(self)
+
+    def _get_state_commands(self):
+        model = self._model()
+        commands = []
+        for name in model.__properties__:
+            if name not in model.__local_properties__:
+                txt = serializer.saves(getattr(model, name))
+                commands.append(['SET_PROP', model.id, name, txt])
+        return commands
+
+    def _resync(self, session):
+        """ Send the current state of the model to a session that was
+        skipped while it was pooled.
+        """
+        if session in self._stale:
+            self._stale.remove(session)
+            for command in self._get_state_commands():
+                session._send_command(command)
+
+    def _unsubscribe(self, session):
+        """ Remove the JS side of the model from the given session.
+        """
+        if session not in self._sessions:
+            return
+        self._sessions.remove(session)
+        while session in self._stale:
+            self._stale.remove(session)
+        while self in session._shared_sessions:
+            session._shared_sessions.remove(self)
+        model = self._model()
+        session._model_instances.pop(model.id, None)
+        if session.status:
+            session._send_op('DISPOSE', model.id)
+
+    def _send_op(self, opcode, id, name=None, payload=None):
+        """ Queue a structured command for all subscribed sessions. See
+        Session._send_op(). The commands that define the state of the
+        model on the client are stored, for sessions that subscribe later.
+        """
+        command = [opcode, id, name, payload]
+        while command[-1] is None:
+            command.pop(-1)
+        if opcode == 'CREATE':
+            self._create_command = command
+            return
+        elif opcode == 'CALL' and name == '_set_event_types_py':
+            self._event_types_command = command
+        if not self._sessions:
+            return
+        # Coalesce property syncs, like Session._queue_command()
+        if opcode == 'SET_PROP':
+            index = self._queued_props.get(name, None)
+            if index is not None:
+                self._commands[index] = command
+                return
+            self._queued_props[name] = len(self._commands)
+        elif self._queued_props:
+            self._queued_props = {}
+        self._commands.append(command)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            call_later(0, self._flush_commands)
+
+    def _flush_commands(self):
+        """ Encode the queued commands once, and send the result to all
+        subscribed sessions.
+        """
+        self._flush_scheduled = False
+        self._queued_props = {}
+        commands, self._commands = self._commands, []
+        sessions = self.sessions
+        if commands and sessions:
+            command = EncodedCommand(make_batch(commands).encode())
+            for session in sessions:
+                if not session._pooled:
+                    session._send_command(command)
+                elif session not in self._stale:
+                    self._stale.append(session)
+
+
 ## Functions to get page
 # These could be methods, but theses are only for internal use
 
 def get_page(session):
     """ Get the string for the HTML page to render this session's app.
+    The page includes the assets of the used modules and the commands
+    to instantiate the app, so that it can render while the websocket
+    is connecting.
     """
-    css_assets = [assetstore.get_asset('reset.css')]
-    js_assets = [assetstore.get_asset('flexx-core.js')]
-    return _get_page(session, js_assets, css_assets, 3, False)
+    css_assets = [session._store.get_asset('reset.css')]
+    js_assets = [session._store.get_asset('flexx-core.js')]
+    commands = session._pop_page_commands()
+    if commands:
+        _add_module_assets(session, js_assets, css_assets,
+                           session.assets_to_ignore)
+    return _get_page(session, js_assets, css_assets, 3, False, commands)
 
 
 def get_page_for_export(session, commands, link=0):
     """ Get the string for an exported HTML page (to run without a server).
     """
     # We start as a normal page ...
-    css_assets = [assetstore.get_asset('reset.css')]
-    js_assets = [assetstore.get_asset('flexx-core.js')]
+    css_assets = [session._store.get_asset('reset.css')]
+    js_assets = [session._store.get_asset('flexx-core.js')]
+    _add_module_assets(session, js_assets, css_assets)
+    # Create asset for launching the app (commands that normally get send
+    # over the websocket)
+    lines = []
+    lines.append('flexx.is_exported = true;\n')
+    lines.append('flexx.runExportedApp = function () {')
+    lines.extend(['    flexx.command(%s);' % reprs(c) for c in commands
+                  if not c.startswith('DEFINE-')])
+    lines.append('};\n')
+    # Create a session asset for it, "-export.js" is always embedded
+    export_asset = Asset('flexx-export.js', '\n'.join(lines))
+    js_assets.append(export_asset)
+
+    return _get_page(session, js_assets, css_assets, link, True)
+
+
+def _add_module_assets(session, js_assets, css_assets, ignore=()):
+    """ Add the assets for the modules that are used by the session, and
+    the assets associated with these modules, in the right order. Assets
+    whose name is in ignore are skipped.
+    """
+    store = session._store
     # Get all the used modules
-    modules = [assetstore.modules[name] for name in session.present_modules]
+    modules = [store.modules[name] for name in session.present_modules]
     f = lambda m: (m.name.startswith('__main__'), m.name)
     modules = solve_dependencies(sorted(modules, key=f))
     # First the associated assets
-    asset_names = set()
+    asset_names = set(ignore)
     for mod in modules:
-        for asset_name in assetstore.get_associated_assets(mod.name):
+        for asset_name in store.get_associated_assets(mod.name):
             if asset_name not in asset_names:
                 asset_names.add(asset_name)
-                asset = assetstore.get_asset(asset_name)
+                asset = store.get_asset(asset_name)
                 if asset.name.lower().endswith('.js'):
                     js_assets.append(asset)
                 else:
                     css_assets.append(asset)
     # Then the modules themselves
     for mod in modules:
-        if mod.get_css().strip():
-            css_assets.append(assetstore.get_asset(mod.name + '.css'))
+        if mod.get_css().strip() and mod.name + '.css' not in ignore:
+            css_assets.append(store.get_asset(mod.name + '.css'))
     for mod in modules:
-        js_assets.append(assetstore.get_asset(mod.name + '.js'))
-    # Create asset for launching the app (commands that normally get send
-    # over the websocket)
-    lines = []
-    lines.append('flexx.is_exported = true;\n')
-    lines.append('flexx.runExportedApp = function () {')
-    lines.extend(['    flexx.command(%s);' % reprs(c) for c in commands
-                  if not c.startswith('DEFINE-')])
-    lines.append('};\n')
-    # Create a session asset for it, "-export.js" is always embedded
-    export_asset = Asset('flexx-export.js', '\n'.join(lines))
-    js_assets.append(export_asset)
-
-    return _get_page(session, js_assets, css_assets, link, True)
+        if mod.name + '.js' not in ignore:
+            js_assets.append(store.get_asset(mod.name + '.js'))
 
 
-def _get_page(session, js_assets, css_assets, link, export):
+def _get_page(session, js_assets, css_assets, link, export, commands=None):
     """ Compose index page.
     """
     pre_path = '_assets' if export else '/flexx/assets'
 
     codes = []
 
-    t = 'var flexx = {app_name: "%s", session_id: "%s"};'
-    codes.append('<script>%s</script>\n' % t % (session.app_name, session.id))
+    t = 'var flexx = {app_name: "%s", session_id: "%s"'
+    t = t % (session.app_name, session.id)
+    if commands:
+        # The client runs these on load, see Flexx.init() in _clientcore.py
+        t += ', page_commands: ' + reprs(commands).replace('</', '<\\/')
+    if session._resumable and not export:
+        t += ', resume_timeout: %s' % config.session_resume_timeout
+    if config.client_perf_interval > 0 and not export:
+        t += ', perf_interval: %s' % config.client_perf_interval
+    codes.append('<script>%s};</script>\n' % t)
 
     for assets in [css_assets, js_assets]:
         for asset in assets:
@@ -714,8 +1533,12 @@ def _get_page(session, js_assets, css_assets, link, export):
             else:
                 if asset.name.endswith(('-info.js', '-export.js')):
                     html = asset.to_html('', 0)
-                else:
+                elif export or asset.remote:
                     html = asset.to_html(pre_path + '/shared/{}', link)
+                else:
+                    # Link using the content hash, so browsers can cache it
+                    hashed_name = session._store.get_hashed_name(asset.name)
+                    html = asset.to_html(pre_path + '/shared/' + hashed_name, link)
             codes.append(html)
             if export and assets is js_assets:
                 codes.append('<script>window.flexx.spin();</script>')
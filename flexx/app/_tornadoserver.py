@@ -15,13 +15,18 @@ import tornado
 from tornado import gen, netutil
 from tornado.web import Application, RequestHandler
 from tornado.ioloop import IOLoop
-from tornado.websocket import WebSocketHandler
+from tornado.process import fork_processes
+from tornado.websocket import (WebSocketHandler, WebSocketClosedError,
+                               websocket_connect)
 from tornado.httpserver import HTTPServer
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
 
 from ._app import manager
-from ._session import get_page
+from ._session import get_page, get_session_worker, set_worker_index
 from ._server import AbstractServer
-from ._assetstore import assets
+from ._assetstore import assets, split_hashed_name, EncodedCommand
+from ._metrics import metrics
+from . import _metrics, _tracing
 
 from . import logger
 from .. import config
@@ -29,7 +34,7 @@ from .. import config
 if tornado.version_info < (4, ):
     raise RuntimeError('Flexx requires Tornado v4.0 or higher.')
 
-# todo: threading, or even multi-process
+# todo: threading
 #executor = ThreadPoolExecutor(4)
 
 # Use a binary websocket or not?
@@ -43,16 +48,67 @@ def is_main_thread():
     return isinstance(threading.current_thread(), threading._MainThread)
 
 
+def get_worker_port(application, session_id):
+    """ Get the (private) port of the worker process that owns the session
+    with the given id, or None if the session is owned by this process.
+    """
+    ports = getattr(application, '_flexx_worker_ports', None)
+    worker = get_session_worker(session_id)
+    if ports and worker is not None and worker != application._flexx_worker:
+        if worker < len(ports):
+            return ports[worker]
+    return None
+
+
+@gen.coroutine
+def measure_loop_lag(server, interval=0.5):
+    """ Periodically measure how much later than scheduled the IOLoop
+    gets to us. A large lag means that something blocks the loop. Stops
+    when the server is closed.
+    """
+    while server.serving:
+        t0 = time.perf_counter()
+        yield gen.sleep(interval)
+        if server.serving:
+            lag = time.perf_counter() - t0 - interval
+            _metrics.loop_lag.observe(max(0.0, lag))
+
+
+@gen.coroutine
+def check_pending_sessions(server):
+    """ Periodically close the pending sessions that are not connected in
+    time, and the suspended sessions that are not resumed in time. Stops
+    when the server is closed.
+    """
+    while server.serving:
+        yield gen.sleep(manager._get_check_interval())
+        if server.serving:
+            manager._clear_old_pending_sessions()
+
+
 class TornadoServer(AbstractServer):
     """ Flexx Server implemented in Tornado.
+    
+    If ``workers`` (default ``flexx.config.workers``) is larger than one,
+    the server forks this number of worker processes that share the
+    listening socket. The parent process transpiles and caches all shared
+    assets before forking, and then supervises the workers (i.e. it does
+    not return). Each worker also listens on a private port on localhost.
+    Since session ids encode the worker that owns the session, a worker
+    that receives a websocket (or data request) for another worker's
+    session forwards it to that worker. Not available on Windows.
     """
 
-    def __init__(self, host, port, new_loop, **kwargs):
+    def __init__(self, host, port, new_loop, workers=None, **kwargs):
         self._new_loop = new_loop
+        self._workers = config.workers if workers is None else int(workers)
         self._app = None
         self._server = None
-        self._get_io_loop()
+        self._worker_server = None
+        self._loop = None
         super().__init__(host, port, **kwargs)
+        if self._loop is None:
+            self._get_io_loop()  # not serving
 
     def _get_io_loop(self):
         # Get a new ioloop or the current ioloop for this thread
@@ -84,36 +140,49 @@ class TornadoServer(AbstractServer):
             app_kwargs = dict(debug=True)
         else:
             app_kwargs = dict()
-        # Create tornado application
-        self._app = Application([(r"/flexx/ws/(.*)", WSHandler),
-                                 (r"/flexx/(.*)", MainHandler),
-                                 (r"/(.*)", AppHandler), ], **app_kwargs)
-        # Create tornado server, bound to our own ioloop
-        self._server = HTTPServer(self._app, io_loop=self._loop, **kwargs)
 
-        # Start server (find free port number if port not given)
+        # Bind sockets (find free port number if port not given)
         if port:
             # Turn port into int, use hashed port number if a string was given
             try:
                 port = int(port)
             except ValueError:
                 port = port_hash(port)
-            self._server.listen(port, host)
+            sockets = netutil.bind_sockets(port, host)
         else:
             # Try N ports in a repeatable range (easier, browser history, etc.)
             prefered_port = port_hash('Flexx')
             for i in range(8):
                 port = prefered_port + i
                 try:
-                    self._server.listen(port, host)
+                    sockets = netutil.bind_sockets(port, host)
                     break
                 except (OSError, IOError):
                     pass  # address already in use
             else:
                 # Ok, let Tornado figure out a port
-                [sock] = netutil.bind_sockets(None, host, family=socket.AF_INET)
-                self._server.add_sockets([sock])
-                port = sock.getsockname()[1]
+                sockets = netutil.bind_sockets(None, host, family=socket.AF_INET)
+                port = sockets[0].getsockname()[1]
+
+        # Maybe fork into worker processes; the parent does not return
+        if self._workers > 1:
+            worker, worker_ports, worker_socket = self._fork_workers()
+
+        # Create tornado application
+        self._get_io_loop()
+        self._app = Application([(r"/flexx/ws/(.*)", WSHandler),
+                                 (r"/flexx/(.*)", MainHandler),
+                                 (r"/(.*)", AppHandler), ], **app_kwargs)
+        # Create tornado server, bound to our own ioloop
+        self._server = HTTPServer(self._app, io_loop=self._loop, **kwargs)
+        self._server.add_sockets(sockets)
+
+        # Workers get connections from other workers via a private port
+        if self._workers > 1:
+            self._app._flexx_worker = worker
+            self._app._flexx_worker_ports = worker_ports
+            self._worker_server = HTTPServer(self._app, io_loop=self._loop)
+            self._worker_server.add_sockets([worker_socket])
 
         # Notify address, so its easy to e.g. copy and paste in the browser
         self._serving = self._app._flexx_serving = host, port
@@ -122,6 +191,28 @@ class TornadoServer(AbstractServer):
             proto = 'https'
         logger.info('Serving apps at %s://%s:%i/' % (proto, host, port))
 
+        # Measure the lag of the loop and expire sessions while serving
+        self._loop.spawn_callback(measure_loop_lag, self)
+        self._loop.spawn_callback(check_pending_sessions, self)
+
+    def _fork_workers(self):
+        """ Fork the worker processes. Returns the index of this worker,
+        the private ports of all workers, and the private socket of this
+        worker.
+        """
+        worker_sockets = [netutil.bind_sockets(0, '127.0.0.1', socket.AF_INET)[0]
+                          for i in range(self._workers)]
+        worker_ports = [sock.getsockname()[1] for sock in worker_sockets]
+        # Prepare shared assets so that all workers can use them
+        assets.warm_up()
+        logger.info('Forking %i worker processes.' % self._workers)
+        worker = fork_processes(self._workers)
+        set_worker_index(worker)  # session ids encode the worker
+        for i, sock in enumerate(worker_sockets):
+            if i != worker:
+                sock.close()
+        return worker, worker_ports, worker_sockets[worker]
+
     def _start(self):
         # Ensure that our loop is the current loop for this thread
         if self._new_loop:
@@ -142,6 +233,8 @@ class TornadoServer(AbstractServer):
 
     def _close(self):
         self._server.stop()
+        if self._worker_server is not None:
+            self._worker_server.stop()
 
     def call_later(self, delay, callback, *args, **kwargs):
         # We use a wrapper func so that exceptions are processed via our
@@ -334,6 +427,27 @@ class MainHandler(RequestHandler):
         if guess:
             self.set_header("Content-Type", guess)
 
+    def _get_accepted_encoding(self):
+        """ Get the compression to use ("gzip", "deflate" or None) based
+        on the Accept-Encoding header of the request.
+        """
+        accepted = {}
+        for part in self.request.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = part.strip().lower().partition(';')
+            q = 1.0
+            for param in params.split(';'):
+                key, _, val = param.strip().partition('=')
+                if key == 'q':
+                    try:
+                        q = float(val)
+                    except ValueError:
+                        q = 0.0
+            accepted[name.strip()] = q
+        for encoding in ('gzip', 'deflate'):
+            if accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return encoding
+        return None
+
     @gen.coroutine
     def get(self, full_path):
 
@@ -343,19 +457,56 @@ class MainHandler(RequestHandler):
         # Note: invalid app name can mean its a path relative to the main app
         parts = [p for p in full_path.split('/') if p]
         if not parts:
-            return self.write('Root url for flexx: assets, assetview, data, cmd')
+            return self.write('Root url for flexx: assets, assetview, data, '
+                              'info, metrics, cmd')
         selector = parts[0]
         path = '/'.join(parts[1:])
 
         if selector in ('assets', 'assetview', 'data'):
-            self._get_asset(selector, path)  # JS, CSS, or data
+            # Session data of another worker process is served by that worker
+            port = get_worker_port(self.application, path.partition('/')[0])
+            if port:
+                yield self._forward_to_worker(port)
+            else:
+                self._get_asset(selector, path)  # JS, CSS, or data
         elif selector == 'info':
             self._get_info(selector, path)
+        elif selector == 'metrics':
+            # Each worker process has its own metrics
+            port = self._get_worker_port_by_index(path)
+            if port:
+                yield self._forward_to_worker(port)
+            else:
+                self._get_metrics(selector, path)
         elif selector == 'cmd':
             self._get_cmd(selector, path)  # Execute (or ignore) command
         else:
             return self.write('Invalid url path "%s".' % full_path)
 
+    def _get_worker_port_by_index(self, index):
+        """ Get the (private) port of the worker process with the given
+        index, or None if that is us (or there are no workers).
+        """
+        ports = getattr(self.application, '_flexx_worker_ports', None)
+        if ports and index.isdigit() and int(index) < len(ports):
+            if int(index) != self.application._flexx_worker:
+                return ports[int(index)]
+        return None
+
+    @gen.coroutine
+    def _forward_to_worker(self, port):
+        """ Forward this request to the worker process at the given port.
+        """
+        url = 'http://127.0.0.1:%i%s' % (port, self.request.uri)
+        response = yield AsyncHTTPClient().fetch(url, raise_error=False)
+        if response.code == 599:  # could not connect
+            return self.send_error(502)
+        self.set_status(response.code)
+        if 'Content-Type' in response.headers:
+            self.set_header('Content-Type', response.headers['Content-Type'])
+        if response.body:
+            self.write(response.body)
+
     def _get_asset(self, selector, path):
 
         # Get session id and filename
@@ -383,14 +534,39 @@ class MainHandler(RequestHandler):
                 return self.redirect('/flexx/assetview/%s/%s#L%s' %
                     (session_id or 'shared', fname.replace('/:', ':'), where))
 
+            # Assets can be requested by their content-hashed name
+            name, hash = filename, None
+            if filename not in asset_provider.get_asset_names():
+                name, hash = split_hashed_name(filename)
+
             # Retrieve asset
             try:
-                res = asset_provider.get_asset(filename)
+                res = asset_provider.get_asset(name)
             except KeyError:
                 self.write('Could not load asset %r' % filename)
             else:
-                self._guess_mime_type(filename)
-                self.write(res.to_string())
+                current_hash = asset_provider.get_asset_hash(name)
+                if hash == current_hash:
+                    self.set_header('Cache-Control',
+                                    'public, max-age=31536000, immutable')
+                else:
+                    self.set_header('Cache-Control', 'no-cache')
+                # Precompressed variants are cached by the asset store
+                encoding = self._get_accepted_encoding()
+                self.set_header('Vary', 'Accept-Encoding')
+                if encoding:
+                    self.set_header('Etag', '"%s-%s"' % (current_hash, encoding))
+                else:
+                    self.set_header('Etag', '"%s"' % current_hash)
+                if self.check_etag_header():
+                    self.set_status(304)
+                    return
+                self._guess_mime_type(name)
+                if encoding:
+                    self.set_header('Content-Encoding', encoding)
+                res = asset_provider.get_asset_bytes(name, encoding)
+                _metrics.assets_served.inc(('asset', ), len(res))
+                self.write(res)
 
         elif selector == 'assetview':
 
@@ -424,6 +600,10 @@ class MainHandler(RequestHandler):
                 return self.send_error(404)
             else:
                 self._guess_mime_type(filename)  # so that images show up
+                _metrics.assets_served.inc(('data', ), len(res))
+                if _tracing._recorders:
+                    session = asset_provider if session_id else None
+                    _tracing.data_served(session, filename, len(res))
                 return self.write(res)
 
         else:
@@ -446,6 +626,13 @@ class MainHandler(RequestHandler):
         info = '\n'.join(['<li>%s</li>' % i for i in info])
         self.write('<ul>' + info + '</ul>')
 
+    def _get_metrics(self, selector, path):
+        """ Provide the server metrics in the Prometheus text format.
+        Note that this is publicly accesible.
+        """
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.render())
+
     def _get_cmd(self, selector, path):
         """ Allow control of the server using http, but only from localhost!
         """
@@ -514,6 +701,76 @@ class MessageCounter:
         self._stop = True
 
 
+class WorkerProxy:
+    """ Forwards the messages of a websocket to the worker process that
+    owns its session, and the messages from that worker back.
+    """
+
+    def __init__(self, handler, port):
+        self._handler = handler
+        self._conn = None
+        self._pending = []  # messages to send once connected
+        self._closed = False
+        self._close_args = ()  # code and reason to pass on to the worker
+        # Connect to the same url, with the cookies of the client
+        url = 'ws://127.0.0.1:%i%s' % (port, handler.request.uri)
+        headers = {}
+        if 'Cookie' in handler.request.headers:
+            headers['Cookie'] = handler.request.headers['Cookie']
+        IOLoop.current().spawn_callback(self._run, HTTPRequest(url, headers=headers))
+
+    def write_message(self, message):
+        """ Forward a message from the client to the worker.
+        """
+        if self._conn is None:
+            self._pending.append(message)
+        else:
+            try:
+                self._conn.write_message(message, binary=isinstance(message, bytes))
+            except WebSocketClosedError:
+                pass  # handled in _run()
+
+    def close(self, code=None, reason=None):
+        """ Close the connection to the worker, with the code and reason
+        of the close of the client, so that the worker can tell whether
+        the session may be resumed.
+        """
+        self._closed = True
+        self._close_args = code, reason
+        if self._conn is not None:
+            self._conn.close(*self._close_args)
+
+    @gen.coroutine
+    def _run(self, request):
+        try:
+            conn = yield websocket_connect(request)
+        except Exception as err:
+            logger.warn('Could not forward websocket to worker: %s' % err)
+            self._handler.close(1011, 'Could not connect to worker.')
+            return
+        if self._closed:
+            conn.close(*self._close_args)
+            return
+        self._conn = conn
+        for message in self._pending:
+            self.write_message(message)
+        self._pending = []
+        # Forward messages from the worker to the client
+        while True:
+            message = yield conn.read_message()
+            if message is None:
+                break
+            try:
+                self._handler.write_message(message,
+                                            binary=isinstance(message, bytes))
+            except WebSocketClosedError:
+                break
+        if not self._closed:
+            self._handler.close(getattr(conn, 'close_code', None) or 1000,
+                                getattr(conn, 'close_reason', None) or
+                                'closed by worker')
+
+
 class WSHandler(WebSocketHandler):
     """ Handler for websocket.
     """
@@ -525,6 +782,9 @@ class WSHandler(WebSocketHandler):
                      1003: 'could not accept data',
                      }
 
+    # Whether binary frames can be send, see Session._send_data()
+    accepts_binary = True
+
     # --- callbacks
 
     def open(self, path=None):
@@ -532,6 +792,7 @@ class WSHandler(WebSocketHandler):
         """
         if not hasattr(self, 'close_code'):  # old version of Tornado?
             self.close_code, self.close_reason = None, None
+        self._close_requested = False  # whether we closed the connection
 
         self._session = None
         self._mps_counter = MessageCounter()
@@ -543,6 +804,15 @@ class WSHandler(WebSocketHandler):
             path = path.decode()
         self.app_name = path.strip('/')
 
+        # Forward to the worker process that owns the session (if not us)
+        self._proxy = None
+        port = get_worker_port(self.application, self.get_argument('session_id', ''))
+        if port:
+            logger.debug('Forwarding websocket connection %s to worker' % path)
+            self._proxy = WorkerProxy(self, port)
+            IOLoop.current().spawn_callback(self.pinger1)  # the worker does PING
+            return
+
         logger.debug('New websocket connection %s' % path)
         if manager.has_app_name(self.app_name):
             IOLoop.current().spawn_callback(self.pinger1)
@@ -560,19 +830,30 @@ class WSHandler(WebSocketHandler):
         we should at some point define a real formalized protocol.
         """
         self._mps_counter.trigger()
+        _metrics.frames_received.inc((), 1)
+        _metrics.bytes_received.inc((), len(message))
+        if _tracing._recorders:
+            _tracing.frame_read(self._session, message)
 
         self._pongtime = time.time()
-        if self._session is None:
+        if self._proxy is not None:
+            self._proxy.write_message(message)
+        elif self._session is None:
             if message.startswith('hiflexx '):
-                session_id = message.split(' ', 1)[1].strip()
+                # The client sends the number of frames that it received
+                # before, in case it is resuming the session
+                parts = message.split(' ')
+                session_id = parts[1].strip()
+                received = int(parts[2]) if len(parts) > 2 else None
                 try:
                     self._session = manager.connect_client(self, self.app_name,
                                                            session_id,
-                                                           cookies=self.cookies)
+                                                           cookies=self.cookies,
+                                                           received=received)
                 except Exception as err:
                     self.close(1003, "Could not launch app: %r" % err)
                     raise
-                self.write_message("PRINT Flexx server says hi", binary=BINARY)
+                self._session._send_command('PRINT Flexx server says hi')
         elif message.startswith('PONG '):
             self.on_pong2(message[5:])
         else:
@@ -589,8 +870,14 @@ class WSHandler(WebSocketHandler):
         reason = self.close_reason or self.known_reasons.get(code, '')
         logger.debug('Websocket closed: %s (%i)' % (reason, code))
         self._mps_counter.stop()
+        if self._proxy is not None:
+            # A lost connection has no code, but the worker needs one
+            self._proxy.close(code or 1001, reason or 'connection lost')
         if self._session is not None:
-            manager.disconnect_client(self._session)
+            # A normal close by the client (e.g. page unload) is final, and
+            # so is a close by the server (e.g. the client cannot keep up)
+            resumable = code != 1000 and not self._close_requested
+            manager.disconnect_client(self._session, resumable=resumable)
             self._session = None  # Allow cleaning up
 
     @gen.coroutine
@@ -653,26 +940,42 @@ class WSHandler(WebSocketHandler):
         want in this case).
         """
         self._ping_counter = 0
+        self._ping_time = time.perf_counter()
         self._pong_counter = 0
         while self.close_code is None:
             if self._pong_counter >= self._ping_counter:
                 self._ping_counter += 1
+                self._ping_time = time.perf_counter()
                 self.command('PING %i' % self._ping_counter)
             yield gen.sleep(1.0)
 
     def on_pong2(self, data):
-        """ Called when our ping is returned by Flexx.
+        """ Called when our ping is returned by Flexx. The client also
+        sends the number of frames that it received.
         """
-        self._pong_counter = int(data)
+        parts = data.split(' ')
+        self._pong_counter = int(parts[0])
+        roundtrip = None
+        if self._pong_counter == self._ping_counter:
+            roundtrip = time.perf_counter() - self._ping_time
+            _metrics.roundtrip_time.observe(roundtrip)
         if self._session:
-            self._session._receive_pong(self._pong_counter)
+            self._session._receive_pong(self._pong_counter, roundtrip)
+            if len(parts) > 1:
+                self._session._receive_ack(int(parts[1]))
 
     # --- methods
 
     def command(self, cmd):
-        self.write_message(cmd, binary=BINARY)
+        # Commands are str or EncodedCommand, data frames are bytes. The
+        # returned future is used by the session to track the bytes in flight.
+        binary = isinstance(cmd, bytes) and not isinstance(cmd, EncodedCommand)
+        if _tracing._recorders:
+            _tracing.frame_written(self._session, cmd, binary)
+        return self.write_message(cmd, binary=binary)
 
     def close(self, *args):
+        self._close_requested = True
         try:
             WebSocketHandler.close(self, *args)
         except TypeError:
@@ -0,0 +1,230 @@
+"""
+Recording of timelines in the Chrome trace event format, which can be
+loaded in ``chrome://tracing`` or Perfetto (https://ui.perfetto.dev).
+"""
+
+import os
+import json
+from time import perf_counter
+
+from ..event import loop
+from ._metrics import get_command_type
+from . import logger
+
+
+_recorders = []  # the recorders that are currently recording
+
+LOOP_TID = 1  # thread id in the trace for the event loop
+
+
+class TraceRecorder:
+    """ Record a timeline of what happens in this process, or for a
+    single session, and save it in the Chrome trace event format. The
+    timeline includes the iterations of the flexx.event loop, handler
+    calls, the commands that are send and received (by type, with their
+    size), module and asset definitions, data transfers, and the frames
+    that are written to and read from the websocket.
+
+    Usage:
+
+    .. code-block:: py
+
+        with TraceRecorder(session) as recorder:
+            ...  # or call start() and stop()
+        recorder.save('trace.json')
+
+    Parameters:
+        session (Session, optional): the session to record the commands
+            and handler calls of. If not given, all sessions are recorded.
+            Loop iterations are always recorded, because these are shared
+            by all sessions.
+        max_events (int): the maximum number of events to record, to limit
+            memory usage. Later events are dropped. Default 1000000.
+    """
+
+    def __init__(self, session=None, max_events=1000000):
+        self._session = session
+        self._max_events = int(max_events)
+        self._events = []
+        self._tids = {}  # session id -> thread id in the trace
+        self._t0 = perf_counter()
+        self._dropped = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    @property
+    def session(self):
+        """ The session that is recorded, or None for the whole process.
+        """
+        return self._session
+
+    @property
+    def recording(self):
+        """ Whether this recorder is currently recording.
+        """
+        return self in _recorders
+
+    def start(self):
+        """ Start (or resume) recording.
+        """
+        if self not in _recorders:
+            _recorders.append(self)
+
+    def stop(self):
+        """ Stop recording.
+        """
+        while self in _recorders:
+            _recorders.remove(self)
+        if self._dropped:
+            logger.warn('Trace recorder dropped %i events.' % self._dropped)
+
+    def clear(self):
+        """ Remove all recorded events.
+        """
+        self._events = []
+        self._dropped = 0
+
+    def get_trace(self):
+        """ Get the trace as a dict in the Chrome trace event format.
+        """
+        pid = os.getpid()
+        meta = [dict(name='process_name', ph='M', pid=pid, tid=0,
+                     args=dict(name='flexx')),
+                dict(name='thread_name', ph='M', pid=pid, tid=LOOP_TID,
+                     args=dict(name='event loop'))]
+        for id, tid in self._tids.items():
+            meta.append(dict(name='thread_name', ph='M', pid=pid, tid=tid,
+                             args=dict(name='session %s' % id)))
+        events = []
+        for e in self._events:
+            e = dict(e)
+            e['pid'] = pid
+            events.append(e)
+        return dict(traceEvents=meta + events, displayTimeUnit='ms')
+
+    def save(self, filename):
+        """ Write the trace to a JSON file.
+        """
+        with open(filename, 'wb') as f:
+            f.write(json.dumps(self.get_trace()).encode())
+
+    # Recording
+
+    def _ts(self, t=None):
+        # Timestamp in microseconds since the recorder was created
+        return ((perf_counter() if t is None else t) - self._t0) * 1e6
+
+    def _tid(self, session):
+        if session is None:
+            return LOOP_TID
+        tid = self._tids.get(session.id, None)
+        if tid is None:
+            tid = self._tids[session.id] = LOOP_TID + 1 + len(self._tids)
+        return tid
+
+    def _add(self, event):
+        if len(self._events) < self._max_events:
+            self._events.append(event)
+        else:
+            self._dropped += 1
+
+    def _wants(self, session):
+        return self._session is None or session is self._session
+
+    def _record_span(self, name, cat, t_end, duration, args=None):
+        # Spans are in the lane of the event loop, so that handler calls
+        # nest inside loop iterations.
+        self._add(dict(name=name, cat=cat, ph='X', ts=self._ts(t_end - duration),
+                       dur=duration * 1e6, tid=LOOP_TID, args=args or {}))
+
+    def _record_instant(self, name, cat, session=None, args=None):
+        self._add(dict(name=name, cat=cat, ph='i', s='t', ts=self._ts(),
+                       tid=self._tid(session), args=args or {}))
+
+
+def _get_command_name(command):
+    name = get_command_type(command)
+    if name == 'DATA':
+        return name, 'data'
+    elif name.startswith('DEFINE'):
+        return name, 'asset'
+    return name, 'command'
+
+
+# Hooks; the session and websocket handler only call these while recording
+
+def _on_loop_iter(count, duration):
+    if _recorders and count:
+        t = perf_counter()
+        for recorder in _recorders:
+            recorder._record_span('Loop.iter', 'loop', t, duration,
+                                  args=dict(calls=count))
+
+
+def _on_handler_done(handler, duration):
+    if _recorders:
+        t = perf_counter()
+        ob = handler._ob1()
+        session = getattr(ob, '_session', None)
+        name = '%s.%s' % (ob.__class__.__name__, handler.get_name())
+        args = dict(session=session.id) if session is not None else {}
+        for recorder in _recorders:
+            if recorder._wants(session):
+                recorder._record_span(name, 'handler', t, duration, args=args)
+
+
+def command_sent(session, command, size):
+    """ Record a command that the session sends to the client.
+    """
+    name, cat = _get_command_name(command)
+    for recorder in _recorders:
+        if recorder._wants(session):
+            recorder._record_instant('send ' + name, cat, session,
+                                     dict(size=size))
+
+
+def command_received(session, command):
+    """ Record a command that the session received from the client.
+    """
+    name, cat = _get_command_name(command)
+    for recorder in _recorders:
+        if recorder._wants(session):
+            recorder._record_instant('receive ' + name, cat, session,
+                                     dict(size=len(command)))
+
+
+def frame_written(session, frame, binary):
+    """ Record a frame that the websocket handler writes.
+    """
+    for recorder in _recorders:
+        if recorder._wants(session):
+            recorder._record_instant('ws write', 'websocket', session,
+                                     dict(size=len(frame), binary=binary))
+
+
+def frame_read(session, frame):
+    """ Record a frame that the websocket handler reads.
+    """
+    for recorder in _recorders:
+        if recorder._wants(session):
+            recorder._record_instant('ws read', 'websocket', session,
+                                     dict(size=len(frame)))
+
+
+def data_served(session, name, size):
+    """ Record data that is served over http (session is None for
+    shared data).
+    """
+    for recorder in _recorders:
+        if recorder._wants(session):
+            recorder._record_instant('http data', 'data', session,
+                                     dict(name=name, size=size))
+
+
+loop.add_iter_observer(_on_loop_iter)
+loop.add_handler_observer(_on_handler_done)
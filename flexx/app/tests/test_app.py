@@ -37,4 +37,201 @@ def test_launching_with_init_args():
     m.session.close()
 
 
+class WebSocketDummy:
+    close_code = None
+    ping_counter = 0
+    def command(self, cmd):
+        pass
+    def close_this(self):
+        self.close_code = 1000
+
+
+def test_app_manager_sessions():
+    
+    from flexx import config
+    from flexx.app._app import AppManager
+    
+    m = AppManager()
+    m.register_app(app.App(MyPropClass1))
+    assert m.has_app_name('mypropclass1') == 'MyPropClass1'
+    assert m.has_app_name('foo') is None
+    assert m.get_app_names() == ['MyPropClass1']
+    
+    s1 = m.create_session('MyPropClass1')
+    s2 = m.create_session('MyPropClass1')
+    assert m.get_session_by_id(s1.id) is s1
+    assert m.get_connections('MyPropClass1') == []
+    
+    with raises(RuntimeError):
+        m.connect_client(WebSocketDummy(), 'MyPropClass1', 'notanid')
+    assert m.connect_client(WebSocketDummy(), 'MyPropClass1', s1.id) is s1
+    assert m.get_connections('MyPropClass1') == [s1]
+    
+    # Pending sessions expire
+    m._clear_old_pending_sessions()
+    assert m.get_session_by_id(s2.id) is s2
+    s2._creation_time -= config.session_pending_ttl + 1
+    m._clear_old_pending_sessions()
+    assert m.get_session_by_id(s2.id) is None
+    assert s2.app is None  # disposed
+    with raises(RuntimeError):
+        m.connect_client(WebSocketDummy(), 'MyPropClass1', s2.id)
+    
+    # Connected sessions do not expire
+    s1._creation_time -= config.session_pending_ttl + 1
+    m._clear_old_pending_sessions()
+    assert m.get_connections('MyPropClass1') == [s1]
+    
+    # Latency stats are aggregated over the connected sessions
+    s1._receive_pong(1, 0.1)
+    s2._receive_pong(1, 9.0)  # not connected
+    assert m.get_latency_stats('MyPropClass1')['max'] == 0.1
+    assert m.get_latency_stats()['count'] == 1
+    
+    m.disconnect_client(s1)
+    assert m.get_connections('MyPropClass1') == []
+    assert s1.app is None
+    assert m.get_latency_stats()['count'] == 0
+
+
+def test_app_manager_resume():
+    
+    from flexx import config
+    from flexx.app._app import AppManager
+    
+    ori = config.session_resume_timeout
+    config.session_resume_timeout = 10.0
+    try:
+        _test_app_manager_resume(AppManager())
+    finally:
+        config.session_resume_timeout = ori
+
+
+def _test_app_manager_resume(m):
+    
+    m.register_app(app.App(MyPropClass1))
+    s1 = m.create_session('MyPropClass1')
+    s2 = m.create_session('MyPropClass1')
+    m.connect_client(WebSocketDummy(), 'MyPropClass1', s1.id)
+    m.connect_client(WebSocketDummy(), 'MyPropClass1', s2.id)
+    
+    # A lost connection suspends the session
+    s1._receive_pong(1, 0.1)
+    assert m.get_latency_stats('MyPropClass1')['count'] == 1
+    m.disconnect_client(s1, resumable=True)
+    assert s1.app is not None and s1.status == s1.STATUS.PENDING
+    assert m.get_connections('MyPropClass1') == [s1, s2]
+    assert m.get_latency_stats('MyPropClass1')['count'] == 0  # suspended
+    
+    # The client can reconnect
+    assert m.connect_client(WebSocketDummy(), 'MyPropClass1', s1.id,
+                            received=s1._frame_seq) is s1
+    assert s1.status == s1.STATUS.CONNECTED
+    
+    # ... but not if it missed frames that are not available
+    m.disconnect_client(s1, resumable=True)
+    with raises(RuntimeError):
+        m.connect_client(WebSocketDummy(), 'MyPropClass1', s1.id,
+                         received=s1._frame_seq + 1)
+    assert s1.app is None
+    assert m.get_connections('MyPropClass1') == [s2]
+    
+    # Suspended sessions expire
+    m.disconnect_client(s2, resumable=True)
+    m._clear_old_pending_sessions()
+    assert s2.app is not None
+    s2._suspend_time -= 11
+    m._clear_old_pending_sessions()
+    assert s2.app is None
+    assert m.get_connections('MyPropClass1') == []
+
+
+def test_app_manager_pool():
+
+    from flexx.app._app import AppManager
+
+    a = app.App(MyPropClass1)
+    a._pool_size = 2
+    m = AppManager()
+    m.register_app(a)
+    m.register_app(app.App(MyPropClass2))
+
+    # The pool is filled in the background, starting at the first request
+    s1 = m.create_session('MyPropClass1')
+    assert m.get_pool_stats('MyPropClass1') == dict(size=2, ready=0, hits=0,
+                                                    misses=1, fills=0,
+                                                    fill_time=0.0)
+    m._fill_pool('MyPropClass1')
+    m._fill_pool('MyPropClass1')
+    m._fill_pool('MyPropClass1')  # pool is full
+    stats = m.get_pool_stats('MyPropClass1')
+    assert stats['ready'] == 2 and stats['fills'] == 2
+    assert stats['fill_time'] > 0
+    pooled = list(m._pools['MyPropClass1'])
+    assert all(s._pooled for s in pooled)
+    assert m.get_connections('MyPropClass1') == []
+    assert m.get_session_by_id(pooled[0].id) is None
+
+    # A request takes a session from the pool
+    s2 = m.create_session('MyPropClass1')
+    assert s2 is pooled[0] and not s2._pooled
+    assert s2.app is not None and s2.status == s2.STATUS.PENDING
+    assert m.get_session_by_id(s2.id) is s2
+    stats = m.get_pool_stats('MyPropClass1')
+    assert stats['hits'] == 1 and stats['ready'] == 1
+    assert m.connect_client(WebSocketDummy(), 'MyPropClass1', s2.id) is s2
+
+    # Sessions created with an id (e.g. for export) do not use the pool
+    s3 = m.create_session('MyPropClass1', id='foo')
+    assert s3.id == 'foo' and s3 is not pooled[1]
+
+    # Apps have no pool by default
+    m.create_session('MyPropClass2')
+    assert m.get_pool_stats('MyPropClass2')['misses'] == 0
+    assert 'MyPropClass2' not in m._pools_filling
+
+    # Re-registering an app clears the pool
+    m.register_app(a)
+    assert m.get_pool_stats('MyPropClass1')['ready'] == 0
+    assert pooled[1].app is None  # closed
+    assert pooled[1].status == pooled[1].STATUS.CLOSED
+
+
+def test_app_manager_broadcast():
+
+    from flexx.app import _model
+    from flexx.app._app import AppManager
+    from flexx.app._assetstore import EncodedCommand
+
+    m = AppManager()
+    m.register_app(app.App(MyPropClass1))
+    m.register_app(app.App(MyPropClass2))
+    sessions = [m.create_session('MyPropClass1') for i in range(3)]
+    sessions.append(m.create_session('MyPropClass2'))
+    for s in sessions[1:]:
+        m.connect_client(WebSocketDummy(), s.app_name, s.id)
+
+    commands = []
+    for s in sessions:
+        s._send_command = lambda cmd, s=s: commands.append((s, cmd))
+
+    # The command is encoded once, and the pending session is skipped
+    assert m.broadcast('MyPropClass1', 'new_message', dict(msg='hi')) == 2
+    assert [c[0] for c in commands] == sessions[1:3]
+    assert commands[0][1] is commands[1][1]
+    assert isinstance(commands[0][1], EncodedCommand)
+    assert b'"@app"' in commands[0][1] and b'new_message' in commands[0][1]
+
+    # Via the Model class, which includes subclasses
+    commands[:] = []
+    ori_manager, _model.manager = _model.manager, m
+    try:
+        assert MyPropClass2.broadcast('foo') == 1
+        assert MyPropClass1.broadcast('foo') == 3
+    finally:
+        _model.manager = ori_manager
+    assert len(commands) == 4
+    assert set(c[0] for c in commands) == set(sessions[1:])
+
+
 run_tests_if_main()
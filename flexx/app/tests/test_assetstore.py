@@ -8,12 +8,14 @@ import os
 import sys
 import tempfile
 import shutil
+import subprocess
 
 from flexx.util.testing import run_tests_if_main, raises
 
 from flexx.app._assetstore import assets, AssetStore as _AssetStore
 from flexx.app._session import Session
 
+import flexx
 from flexx import ui, app
 
 
@@ -67,6 +69,200 @@ def test_asset_store_adding_assets():
         s.get_asset('foo-not-exists.js')  # does not exist
 
 
+def test_asset_store_hashes():
+    
+    from flexx.app._asset import Asset
+    from flexx.app._assetstore import split_hashed_name
+    
+    s = AssetStore()
+    s.add_shared_asset('foo.js', 'XXX')
+    s.add_shared_asset('spam/bar.css', 'YYY')
+    
+    # Hashes are based on the content
+    h1 = s.get_asset_hash('foo.js')
+    h2 = s.get_asset_hash('spam/bar.css')
+    assert len(h1) == 12 and h1 != h2
+    assert s.get_hashed_name('foo.js') == 'foo.%s.js' % h1
+    assert s.get_hashed_name('spam/bar.css') == 'spam/bar.%s.css' % h2
+    with raises(KeyError):
+        s.get_asset_hash('nope.js')
+    
+    # Hashed names can be resolved
+    assert split_hashed_name('foo.%s.js' % h1) == ('foo.js', h1)
+    assert split_hashed_name('spam/bar.%s.css' % h2) == ('spam/bar.css', h2)
+    assert split_hashed_name('foo.js') == ('foo.js', None)
+    assert split_hashed_name('foo.bar.js') == ('foo.bar.js', None)
+    
+    # Bundle hashes are updated when their content changes
+    s.update_modules()
+    h3 = s.get_asset_hash('flexx.app.js')
+    s.get_asset('flexx.app.js').add_asset(Asset('xx.js', 'XXX'))
+    h4 = s.get_asset_hash('flexx.app.js')
+    assert h4 != h3
+    
+    class HashTestModel(app.Model):
+        pass
+    
+    s.update_modules()
+    assert s.get_asset_hash('flexx.app.js') not in (h3, h4)
+    assert s.get_asset_hash('foo.js') == h1
+
+
+def test_asset_store_compressed_variants():
+    
+    import gzip
+    import zlib
+    from flexx.app._asset import Asset
+    
+    s = AssetStore()
+    s.add_shared_asset('foo.js', 'XXX' * 100)
+    
+    raw = s.get_asset_bytes('foo.js')
+    assert raw == b'XXX' * 100
+    assert gzip.decompress(s.get_asset_bytes('foo.js', 'gzip')) == raw
+    assert zlib.decompress(s.get_asset_bytes('foo.js', 'deflate')) == raw
+    assert len(s.get_asset_bytes('foo.js', 'gzip')) < len(raw)
+    with raises(ValueError):
+        s.get_asset_bytes('foo.js', 'br')
+    
+    # Variants are cached
+    assert s.get_asset_bytes('foo.js', 'gzip') is s.get_asset_bytes('foo.js', 'gzip')
+    
+    # Variants of bundles are rebuilt when their content changes
+    s.update_modules()
+    b1 = s.get_asset_bytes('flexx.app.js', 'gzip')
+    c1 = s.get_define_command('flexx.app.js')
+    h1 = s.get_asset_hash('flexx.app.js')
+    s.get_asset('flexx.app.js').add_asset(Asset('xx.js', 'var compress_test;'))
+    b2 = s.get_asset_bytes('flexx.app.js', 'gzip')
+    assert b2 != b1
+    assert b'compress_test' in gzip.decompress(b2)
+    assert b'compress_test' in s.get_asset_bytes('flexx.app.js')
+    assert b'compress_test' in s.get_define_command('flexx.app.js')
+    assert b'compress_test' not in c1
+    assert s.get_asset_hash('flexx.app.js') != h1
+
+
+def test_asset_store_define_commands():
+    
+    from flexx.app._asset import Asset
+    from flexx.app._assetstore import EncodedCommand
+    
+    s = AssetStore()
+    s.add_shared_asset('foo.js', 'XXX')
+    s.add_shared_asset('foo.css', 'YYY')
+    
+    c1 = s.get_define_command('foo.js')
+    assert isinstance(c1, EncodedCommand)
+    assert c1 == b'DEFINE-JS foo.js XXX'
+    assert s.get_define_command('foo.css') == b'DEFINE-CSS foo.css YYY'
+    
+    # One command is shared for each version of the asset
+    assert s.get_define_command('foo.js') is c1
+    
+    s.update_modules()
+    c2 = s.get_define_command('flexx.app.js')
+    assert c2.startswith(b'DEFINE-JS-EVAL flexx.app.js ')
+    s.get_asset('flexx.app.js').add_asset(Asset('xx.js', 'var define_test;'))
+    c3 = s.get_define_command('flexx.app.js')
+    assert c3 is not c2
+    assert b'define_test' in c3
+    
+    class DefineCommandTestModel(app.Model):
+        pass
+    
+    s.update_modules()
+    assert s.get_define_command('flexx.app.js') is not c3
+
+
+def test_asset_store_frozen_build():
+    
+    from flexx import config
+    from flexx.app._asset import get_mod_name
+    from flexx.app._modules import FrozenModule
+    
+    dirname = os.path.join(tempfile.gettempdir(), 'flexx_frozen_build_test')
+    s1 = _AssetStore()
+    s1.freeze(dirname)
+    assert os.path.isfile(os.path.join(dirname, 'manifest.json'))
+    assert os.path.isfile(os.path.join(dirname, 'assets', 'flexx-core.js'))
+    assert os.path.isfile(os.path.join(dirname, 'modules', 'flexx.ui._widget.js'))
+    assert os.path.isfile(os.path.join(dirname, 'hasevents.js'))
+    
+    config.frozen_build = dirname
+    try:
+        s2 = _AssetStore()
+        with raises(RuntimeError):
+            s2.freeze(dirname)
+        s2.update_modules()
+        # All modules are loaded from the build, and produce the same assets
+        assert set(s2.modules) == set(s1.modules)
+        assert all(isinstance(m, FrozenModule) for m in s2.modules.values())
+        for name in ('pyscript-std.js', 'flexx-core.js', 'flexx.ui.js',
+                     'flexx.ui.css'):
+            assert s2.get_asset(name).to_string() == s1.get_asset(name).to_string()
+            assert s2.get_asset_hash(name) == s1.get_asset_hash(name)
+        assert s2.modules['flexx.ui._widget'].deps == s1.modules['flexx.ui._widget'].deps
+        assert ui.Widget in s2.modules['flexx.ui._widget'].model_classes
+        
+        # Variables that are not in the build cannot be used
+        mod_name = get_mod_name(sys.modules[__name__])
+        with raises(RuntimeError):
+            s2.modules[mod_name].add_variable('N_STANDARD_ASSETS')
+    finally:
+        config.frozen_build = ''
+        shutil.rmtree(dirname)
+
+
+FROZEN_SERVE_CODE = """
+from flexx.pyscript import functions
+def fail(*args, **kwargs):
+    raise RuntimeError('The PyScript parser was used')
+functions.Parser = fail
+
+from flexx import app, ui
+from flexx.app._session import get_page
+app.App(ui.Label, text='hi').serve('Label')
+session = app.manager.create_session('Label')
+assert 'flexx.ui._widget.js' in get_page(session)
+print(len(app.assets.get_asset('flexx-core.js').to_string()))
+"""
+
+
+def test_asset_store_frozen_build_without_parser():
+    
+    # A server that uses a frozen build does not transpile anything, not
+    # even on import
+    project_dir = os.path.dirname(os.path.dirname(flexx.__file__))
+    dirname = os.path.join(tempfile.gettempdir(), 'flexx_frozen_build_test2')
+    _AssetStore().freeze(dirname)
+    env = os.environ.copy()
+    env.update(FLEXX_FROZEN_BUILD=dirname, FLEXX_PYSCRIPT_CACHE='0')
+    try:
+        out = subprocess.check_output([sys.executable, '-c', FROZEN_SERVE_CODE],
+                                      cwd=project_dir, env=env,
+                                      stderr=subprocess.STDOUT).decode()
+    except subprocess.CalledProcessError as err:
+        raise AssertionError(err.output.decode())
+    finally:
+        shutil.rmtree(dirname)
+    size = len(_AssetStore().get_asset('flexx-core.js').to_string())
+    assert out.strip().splitlines()[-1] == str(size)
+
+
+def test_asset_store_warm_up():
+    
+    s = _AssetStore()
+    s.warm_up()
+    
+    # The bundles are transpiled and cached
+    assert s.get_asset('flexx.ui.js').modules
+    for key in [('flexx.ui.js', None), ('flexx.ui.js', 'gzip'),
+                ('flexx-core.js', 'deflate')]:
+        assert key in s._asset_bytes
+    assert 'flexx.ui.js' in s._asset_commands
+
+
 def test_associate_asset():
     
     s = AssetStore()
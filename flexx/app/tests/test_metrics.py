@@ -0,0 +1,124 @@
+from flexx.util.testing import run_tests_if_main, raises
+
+from flexx import app, event
+from flexx.app import Session
+from flexx.app import _metrics
+from flexx.app._metrics import MetricsRegistry
+
+
+class MyMetricsModel(app.Model):
+    pass
+
+
+class WebSocketDummy:
+    close_code = None
+    ping_counter = 0
+    def __init__(self):
+        self.commands = []
+    def command(self, cmd):
+        self.commands.append(cmd)
+    def close_this(self):
+        self.close_code = 1000
+
+
+def test_metrics_registry():
+
+    m = MetricsRegistry()
+    c = m.counter('foo_total', 'Number of foos.', ['kind'])
+    g = m.gauge('bar', 'The bar.')
+    h = m.histogram('spam_seconds', 'Spam time.', buckets=(0.1, 1.0))
+    with raises(ValueError):
+        m.counter('foo_total', 'Again.')
+    assert m.get_metric('bar') is g
+
+    c.inc(('a', ))
+    c.inc(('a', ), 2)
+    c.inc(('b"', ), 1.5)
+    m.add_collector(lambda: g.set((), 7))
+    h.observe(0.05)
+    h.observe(0.5)
+    h.observe(5)
+    assert c.get('a') == 3
+    assert h.get() == dict(count=3, sum=5.55)
+
+    lines = m.render().splitlines()
+    assert '# TYPE foo_total counter' in lines
+    assert 'foo_total{kind="a"} 3' in lines
+    assert 'foo_total{kind="b\\""} 1.5' in lines
+    assert 'bar 7' in lines
+    assert '# TYPE spam_seconds histogram' in lines
+    assert 'spam_seconds_bucket{le="0.1"} 1' in lines
+    assert 'spam_seconds_bucket{le="1"} 2' in lines
+    assert 'spam_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'spam_seconds_count 3' in lines
+
+
+def test_metrics_session_traffic():
+
+    s = Session('xx')
+    s._set_ws(WebSocketDummy())
+    commands_sent = _metrics.commands_sent.get('SET_PROP')
+    frames_sent = _metrics.frames_sent.get('interactive')
+    data_sent = _metrics.bytes_sent.get('data')
+
+    s._send_op('SET_PROP', 'x1', 'foo', '3')
+    s._send_op('SET_PROP', 'x2', 'foo', '4')
+    s._send_command(b'\x00' * 100)
+    s._flush_commands()
+    assert _metrics.commands_sent.get('SET_PROP') == commands_sent + 2
+    assert _metrics.frames_sent.get('interactive') == frames_sent + 1
+    assert _metrics.bytes_sent.get('data') == data_sent + 100
+
+    received = _metrics.commands_received.get('PRINT')
+    nbytes = _metrics.command_bytes_received.get('PRINT')
+    batches = _metrics.commands_received.get('BATCH')
+    s._receive_command('BATCH ["PRINT hi", "PRINT there"]')
+    assert _metrics.commands_received.get('PRINT') == received + 2
+    assert _metrics.command_bytes_received.get('PRINT') == nbytes + 19
+    # The batch itself is not a command; the frame is counted by the server
+    assert _metrics.commands_received.get('BATCH') == batches
+    s.close()
+
+
+def test_metrics_handler_time():
+
+    class Foo(event.HasEvents):
+        @event.prop
+        def foo(self, v=0):
+            return v
+        @event.connect('foo')
+        def handle_foo(self, *events):
+            pass
+
+    count = _metrics.handler_time.get()['count']
+    ob = Foo()
+    ob.foo = 3
+    event.loop.iter()
+    assert _metrics.handler_time.get()['count'] > count
+
+
+def test_metrics_sessions():
+
+    from flexx.app._app import AppManager
+
+    m = AppManager()
+    m.register_app(app.App(MyMetricsModel))
+    ori_manager, app._app.manager = app._app.manager, m
+    try:
+        s1 = m.create_session('MyMetricsModel')
+        s2 = m.create_session('MyMetricsModel')
+        m.connect_client(WebSocketDummy(), 'MyMetricsModel', s1.id)
+        s2.add_data('blob', b'x' * 10)
+        s1.app.send_data(b'y' * 5)  # kept until retrieved with AJAX
+        s1._receive_pong(1, 0.25)
+        text = app.metrics.render()
+    finally:
+        app._app.manager = ori_manager
+    assert 'flexx_sessions{app="MyMetricsModel",status="pending"} 1' in text
+    assert 'flexx_sessions{app="MyMetricsModel",status="connected"} 1' in text
+    assert 'flexx_data_bytes{app="MyMetricsModel"} 15' in text
+    assert ('flexx_roundtrip_quantile_seconds{app="MyMetricsModel",'
+            'quantile="0.95"} 0.25') in text
+
+
+run_tests_if_main()
@@ -211,6 +211,38 @@ def test_no_duplicate_code():
     assert '.red.' in Foo4.JS.CODE
 
 
+def test_lazy_js_code():
+    
+    class Foo8(Model):
+        
+        @event.prop
+        def size(self, v=0):
+            return v
+        
+        class JS:
+            
+            def spam(self):
+                return 42
+    
+    class Foo9(Foo8):
+        pass
+    
+    # The classes are set up, but the JS is not transpiled yet
+    assert 'size' in Foo8.__properties__
+    assert 'size' in Foo9.__properties__
+    assert 'CODE' in Foo8.JS.__dict__
+    assert not isinstance(Foo8.JS.__dict__['CODE'], str)
+    
+    # Transpiled on first use, and stored
+    code = Foo8.JS.CODE
+    assert 'spam' in code
+    assert code.meta['vars_unknown'] is not None
+    assert Foo8.JS.__dict__['CODE'] is code
+    assert Foo8.JS.CODE is code
+    assert not isinstance(Foo9.JS.__dict__['CODE'], str)
+    assert Foo9.JS.CODE is not code
+
+
 def test_active_models():
     
     ioloop = app.create_server(port=0, new_loop=True).loop
@@ -183,12 +183,17 @@ def test_modules():
     
     assert len(store) == 1
     
-    # Add Foo, this will bring everything else in
+    # Add Foo, this will bring everything else in, but only once the
+    # dependencies are needed, because the JS is transpiled lazily
     m.add_variable('Foo')
     
     assert len(m.model_classes) == 1
     assert m.model_classes.pop().__name__ == 'Foo'
     
+    assert len(store) == 2  # flexx.app._model via the base class
+    assert 'flxtest.lib3' in m.deps
+    assert 'flexx.app._clientcore' in store['flexx.app._model'].deps
+    
     # Modules exists
     assert len(store) == 7
     assert 'flxtest.foo' in store
@@ -285,6 +290,7 @@ def test_add_variable():
     assert not m.variables
     m.add_variable('Foo')
     assert 'Foo' in m.variables
+    m.get_js()  # collect deps
     
     # add_variable is ignored for pyscript mods
     assert not store['flxtest.lib1'].deps
@@ -338,6 +344,7 @@ def test_subclasses():
     # Using a class CC > BB > AA > object
     store = {}
     JSModule('flxtest.foo', store).add_variable('Foo')
+    store['flxtest.foo'].get_js()  # collect deps
     m = JSModule('flxtest.bar', store)
     #
     assert 'CC' not in m.get_js()
@@ -2,7 +2,7 @@ from flexx.util.testing import run_tests_if_main, raises
 
 import sys
 
-from flexx import app
+from flexx import app, event
 from flexx.app import Session
 from flexx.app._assetstore import assets, AssetStore as _AssetStore
 
@@ -22,6 +22,25 @@ def test_session_basics():
     assert 'xx' in repr(s)
 
 
+def test_session_worker_ids():
+    from flexx.app._session import set_worker_index, get_session_worker
+    
+    s = Session('xx')
+    assert get_session_worker(s.id) is None
+    
+    set_worker_index(3)
+    try:
+        s = Session('xx')
+        assert s.id.startswith('3-')
+        assert get_session_worker(s.id) == 3
+    finally:
+        set_worker_index(None)
+    
+    assert get_session_worker('12-abc') == 12
+    assert get_session_worker('abc-12') is None
+    assert get_session_worker('') is None
+
+
 def test_get_model_instance_by_id():
     # is really a test for the session, but historically, the test is done here
     
@@ -88,6 +107,227 @@ def test_session_assets_data():
     assert s.get_data('bla') is None
 
 
+def test_session_command_batching():
+    
+    from flexx.app._app import ExporterWebSocketDummy
+    
+    s = Session('', AssetStore())
+    s._send_command('EXEC pending1')
+    s._send_command('EXEC pending2')
+    assert s._pending_commands == ['EXEC pending1', 'EXEC pending2']
+    
+    # Pending commands are send right away on connect, as one frame
+    ws = ExporterWebSocketDummy()
+    s._set_ws(ws)
+    assert not s._pending_commands
+    assert ws.commands == ['BATCH ["EXEC pending1", "EXEC pending2", "INIT-DONE"]']
+    
+    # Commands are buffered until the next iteration
+    ws.commands = []
+    s._send_command('EXEC foo')
+    s._send_command('EXEC bar')
+    assert ws.commands == []
+    s._flush_commands()
+    assert ws.commands == ['BATCH ["EXEC foo", "EXEC bar"]']
+    
+    # A single command is send as-is, assets are send in separate frames
+    ws.commands = []
+    s._send_command('EXEC foo')
+    s._flush_commands()
+    s._send_command('EXEC foo')
+    s._send_command('DEFINE-JS foo.js xx')
+    s._send_command('EXEC bar')
+    s._send_command('EXEC spam')
+    s._flush_commands()
+    s._flush_commands()
+    assert ws.commands == ['EXEC foo', 'EXEC foo', 'DEFINE-JS foo.js xx',
+                           'BATCH ["EXEC bar", "EXEC spam"]']
+
+
+def test_session_page_commands():
+    from flexx.app._app import ExporterWebSocketDummy
+    from flexx.app._session import get_page, make_data_frame
+    
+    s = Session('xx')
+    frame = make_data_frame('foo', {}, b'xx')
+    s._send_command('DEFINE-JS foo.js var x = 3;')
+    s._send_command(['CALL', 'foo', 'init'])
+    s._send_command('EXEC x = "</script>";')
+    s._send_command(frame)
+    s._send_command('EXEC after data')
+    
+    # Commands up to the first data frame are embedded, except defines
+    page = get_page(s)
+    assert 'page_commands: [["CALL", "foo", "init"], "EXEC x = \\"<\\/script>' in page
+    assert 'var x = 3' not in page
+    assert s._pending_commands == [frame, 'EXEC after data']
+    
+    # The page can be served again
+    assert get_page(s) == page
+    
+    # Connected sessions do not embed commands
+    s = Session('xx')
+    s._send_command('EXEC foo')
+    s._set_ws(ExporterWebSocketDummy())
+    assert 'page_commands' not in get_page(s)
+
+
+def test_session_page_assets():
+    from flexx.app._session import get_page
+    
+    # The page embeds the assets of the session's store, except the
+    # assets that the session ignores
+    store = _AssetStore()
+    store.associate_asset(Fooo1.__jsmodule__, 'page-test.js', 'var x;')
+    store.associate_asset(Fooo1.__jsmodule__, 'page-ignore.js', 'var y;')
+    s = Session('xx', store)
+    s.assets_to_ignore.add('page-ignore.js')
+    Fooo1(session=s)
+    page = get_page(s)
+    assert 'page_commands' in page
+    assert store.get_hashed_name('page-test.js') in page
+    assert store.get_hashed_name(Fooo1.__jsmodule__ + '.js') in page
+    assert 'page-ignore' not in page
+
+
+def test_session_structured_commands():
+    
+    import json
+    from flexx.app._app import ExporterWebSocketDummy
+    
+    s = Session('', AssetStore())
+    ws = ExporterWebSocketDummy()
+    s._set_ws(ws)
+    ws.commands = []
+    
+    # Trailing None elements are omitted, lists are always batched
+    s._send_op('DISPOSE', 'foo')
+    s._flush_commands()
+    s._send_op('CALL', 'foo', 'bar')
+    s._send_op('SET_PROP', 'foo', 'bar', '[3]')
+    s._flush_commands()
+    assert ws.commands == ['BATCH [["DISPOSE", "foo"]]',
+                           'BATCH [["CALL", "foo", "bar"], '
+                           '["SET_PROP", "foo", "bar", "[3]"]]']
+    
+    # Models talk to the client using structured commands, not JS code
+    ws.commands = []
+    m = Fooo1(session=s)
+    m.dispose()
+    s._flush_commands()
+    commands = [c for c in ws.commands if c.startswith('BATCH ')]
+    commands = json.loads(commands[-1][6:])
+    assert not [c for c in commands if not isinstance(c, list)]
+    create = commands[0]
+    assert create[:3] == ['CREATE', m.id, 'Fooo1']
+    assert json.loads(create[3]) == [[], ['sync_props']]
+    assert ['CALL', m.id, 'init'] in commands
+    assert commands[-1] == ['DISPOSE', m.id]
+
+
+def test_session_prop_coalescing():
+    
+    from flexx.app._app import ExporterWebSocketDummy
+    
+    s = Session('', AssetStore())
+    s._send_op('SET_PROP', 'foo', 'x', '1')
+    s._send_op('SET_PROP', 'foo', 'x', '2')
+    assert s._pending_commands == [['SET_PROP', 'foo', 'x', '2']]
+    ws = ExporterWebSocketDummy()
+    s._set_ws(ws)
+    ws.commands = []
+    
+    # Only the last value per property and tick is send
+    for i in range(10):
+        s._send_op('SET_PROP', 'foo', 'x', str(i))
+        s._send_op('SET_PROP', 'foo', 'y', str(i))
+        s._send_op('SET_PROP', 'bar', 'x', str(i))
+    assert s._command_buffer == [['SET_PROP', 'foo', 'x', '9'],
+                                 ['SET_PROP', 'foo', 'y', '9'],
+                                 ['SET_PROP', 'bar', 'x', '9']]
+    s._flush_commands()
+    s._send_op('SET_PROP', 'foo', 'x', '10')
+    assert s._command_buffer == [['SET_PROP', 'foo', 'x', '10']]
+    
+    # Order with respect to other commands is preserved
+    s._send_op('EMIT', 'foo', 'bar', '{}')
+    s._send_op('SET_PROP', 'foo', 'x', '11')
+    s._send_op('SET_PROP', 'foo', 'x', '12')
+    assert s._command_buffer == [['SET_PROP', 'foo', 'x', '10'],
+                                 ['EMIT', 'foo', 'bar', '{}'],
+                                 ['SET_PROP', 'foo', 'x', '12']]
+
+
+def test_session_receive_batch():
+    
+    class FakeModel:
+        def __init__(self):
+            self.log = []
+        def _set_prop_from_js(self, name, txt):
+            self.log.append(('prop', name, txt))
+        def _emit_from_js(self, name, txt):
+            self.log.append(('event', name, txt))
+    
+    m = FakeModel()
+    s = Session('', AssetStore())
+    s._model_instances['foo'] = m
+    
+    # A batch is applied in one pass, in order
+    s._receive_command('BATCH ["SET_PROP foo x 3", "EVENT foo bar {}", '
+                       '"SET_PROP spam x 4", "SET_PROP foo y [1, 2]"]')
+    assert m.log == [('prop', 'x', '3'), ('event', 'bar', '{}'),
+                     ('prop', 'y', '[1, 2]')]
+
+
+def test_session_send_data():
+    
+    import struct
+    import json
+    from flexx.app._app import ExporterWebSocketDummy
+    
+    class FakeModel:
+        pass
+    
+    class BinaryWebSocketDummy(ExporterWebSocketDummy):
+        accepts_binary = True
+    
+    m = FakeModel()
+    s = Session('', AssetStore())
+    s._model_instances['foo'] = m
+    ws = BinaryWebSocketDummy()
+    s._set_ws(ws)
+    ws.commands = []
+    
+    # Blobs are pushed in a binary frame (after interactive commands)
+    s._send_data('foo', b'xxxx', {'bar': 3})
+    s._send_command('EXEC spam')
+    s._flush_commands()
+    assert len(ws.commands) == 2
+    assert ws.commands[0] == 'EXEC spam'
+    frame = ws.commands[1]
+    assert isinstance(frame, bytes) and frame.endswith(b'xxxx')
+    n1, n2 = struct.unpack('<II', frame[:8])
+    assert n2 == 4 and len(frame) == 8 + n1 + n2
+    header = json.loads(frame[8:8+n1].decode())
+    assert header == {'id': 'foo', 'meta': {'bar': 3, 'byteLength': 4}}
+    assert not s._data_volatile
+    
+    # Unless the client replays commands, as with export
+    s = Session('', AssetStore())
+    s._model_instances['foo'] = m
+    s._set_ws(ExporterWebSocketDummy())
+    s._ws.commands = []
+    s._send_data('foo', b'xxxx', {})
+    s._flush_commands()
+    assert 'retrieve_data' in s._ws.commands[0]
+    assert list(s._data_volatile.values()) == [b'xxxx']
+    
+    with raises(ValueError):
+        s._send_data('bar', b'xxxx', {})  # no such model
+    with raises(TypeError):
+        s._send_data('foo', b'xxxx', 3)  # meta must be a dict
+
+
 def test_session_registering_model_classes():
     
     from flexx import ui
@@ -118,6 +358,8 @@ def test_session_registering_model_classes():
 
 ## Prepare module loading tests
 
+import json
+
 from flexx.app._model import new_type
 
 
@@ -165,14 +407,19 @@ class SessionTester(Session):
         super().__init__(*args, **kwargs)
         self.assets_js = []
         self.assets_css = []
+        self.links = []
     
     def _send_command(self, command):
+        if isinstance(command, bytes):
+            command = command.decode()  # an EncodedCommand from the store
         if command.startswith('DEFINE-JS'):
             _, name, _ = command.split(' ', 2)
             self.assets_js.append(name)
         elif command.startswith('DEFINE-CSS'):
             _, name, _ = command.split(' ', 2)
             self.assets_css.append(name)
+        elif command.startswith('DEFINE-LINKS'):
+            self.links.append(json.loads(command.split(' ', 1)[1]))
 
 
 class FakeModule:
@@ -328,8 +575,314 @@ def test_module_loading5():
     assert s.assets_css == add_prefix(['foo.m1.css', 'bla.css', 'foo.m2.css', 'foo.m3.css'])
 
 
+def test_module_loading_links():
+    """ Assets loaded over HTTP """
+    clear_test_classes()
+    
+    store = AssetStore()
+    s = SessionTester('', store)
+    s._link_assets = True
+    
+    m1 = FakeModule(store, 'foo.m1')
+    m2 = FakeModule(store, 'foo.m2')
+    
+    store.associate_asset(add_prefix('foo.m2'), 'eggs.js', 'YY')
+    
+    Ma = m1.make_model_class('Ma')
+    Mb = m2.make_model_class('Mb')
+    m2.deps = add_prefix(['foo.m1'])
+    
+    s._register_model(Mb(s))
+    s._register_model(Ma(s))
+    
+    # Assets are linked by their hashed name, in one command, in order
+    assert s.assets_js == []
+    assert s.assets_css == []
+    assert len(s.links) == 1
+    assert s.links[0][0] == ['JS', 'eggs.js', '/flexx/assets/shared/' +
+                             store.get_hashed_name('eggs.js')]
+    names = [link[1] for link in s.links[0][1:]]
+    assert names == add_prefix(['foo.m1.css', 'foo.m2.css', 'foo.m1.js', 'foo.m2.js'])
+    assert [link[0] for link in s.links[0]] == ['JS', 'CSS', 'CSS', 'JS-EVAL', 'JS-EVAL']
+    
+    # Not for exported apps
+    s = SessionTester('', store)
+    s._link_assets = True
+    s._id = s.app_name
+    s._register_model(Mb(s))
+    assert not s.links
+
+
 # clear_test_classes()
 # test_module_loading5()
 # clear_test_classes()
 
+
+def test_session_send_queue():
+    
+    from flexx.app._app import ExporterWebSocketDummy
+    from flexx.app._assetstore import EncodedCommand
+    
+    class FakeFuture:
+        def __init__(self):
+            self._callbacks = []
+        def done(self):
+            return False
+        def add_done_callback(self, cb):
+            self._callbacks.append(cb)
+        def set_result(self, result):
+            for cb in self._callbacks:
+                cb(self)
+    
+    class SlowWebSocketDummy(ExporterWebSocketDummy):
+        def command(self, cmd):
+            super().command(cmd)
+            self.futures.append(FakeFuture())
+            return self.futures[-1]
+        def close(self, code, reason):
+            self.close_code = code
+    
+    s = Session('', AssetStore())
+    s._high_water_mark = 100
+    ws = SlowWebSocketDummy()
+    ws.futures = []
+    s._set_ws(ws)
+    ws.futures[-1].set_result(None)
+    ws.commands = []
+    events = []
+    handler = app.manager.connect(lambda *evs: events.extend(evs),
+                                  'congestion_changed')
+    
+    # Frames are written until the high water mark is reached
+    s._send_command('DEFINE-JS foo.js ' + 'x' * 90)
+    s._send_command(b'y' * 50)
+    s._send_command('EXEC foo')
+    s._flush_commands()
+    assert ws.commands == ['DEFINE-JS foo.js ' + 'x' * 90]
+    assert s.congested
+    
+    # Superseded props are dropped on congestion
+    for i in range(30):
+        s._send_op('SET_PROP', 'foo', 'x', str(i))
+        s._send_op('EMIT', 'foo', 'bar', '{}')
+    s._flush_commands()
+    assert len(s._send_queue) == 3
+    assert len(s._send_queue[2][1]) == 31
+    assert s._send_queue[2][1][-2:] == [['SET_PROP', 'foo', 'x', '29'],
+                                         ['EMIT', 'foo', 'bar', '{}']]
+    
+    # Interactive frames go first
+    ws.futures[-1].set_result(None)
+    assert len(ws.commands) == 3
+    assert ws.commands[1] == 'EXEC foo'
+    assert ws.commands[2].startswith('BATCH [["EMIT"')
+    assert ws.commands[2].count('SET_PROP') == 1
+    ws.futures[-1].set_result(None)
+    assert ws.commands[3] == b'y' * 50
+    ws.futures[-1].set_result(None)
+    assert not s._send_queue and not s._frames_in_flight
+    assert s._bytes_in_flight == 0
+    assert not s.congested
+    event.loop.iter()
+    assert [(ev.session, ev.congested) for ev in events] == [(s, True),
+                                                          (s, False)]
+    handler.dispose()
+    
+    # Policy drop: discard data frames, but not encoded commands
+    s._congestion_policy = 'drop'
+    s._send_command(b'y' * 150)
+    s._send_command(b'z' * 150)
+    s._send_command(EncodedCommand(b'DEFINE-JS foo.js xx'))
+    s._flush_commands()
+    assert ws.commands[-1] == b'y' * 150
+    assert [frame[0] for frame in s._send_queue] == ['asset']
+    ws.futures[-1].set_result(None)
+    assert ws.commands[-1] == b'DEFINE-JS foo.js xx'
+    assert not s._send_queue
+    ws.futures[-1].set_result(None)
+    
+    # Policy disconnect: close the connection
+    s._congestion_policy = 'disconnect'
+    s._send_command(b'y' * 150)
+    s._send_command(b'z' * 150)
+    s._flush_commands()
+    assert ws.close_code == 1013
+    assert s.status == s.STATUS.CLOSED
+    
+    # The pending queue is bounded too
+    s = Session('', AssetStore())
+    s._high_water_mark = 100
+    s._congestion_policy = 'drop'
+    s._send_command('EXEC foo')
+    s._send_command(b'y' * 150)
+    assert s._pending_commands == ['EXEC foo']
+    assert s.congested is False
+
+
+def test_session_send_queue_encoded():
+    
+    from flexx.app import _metrics
+    from flexx.app._app import ExporterWebSocketDummy
+    from flexx.app._assetstore import EncodedCommand
+    from flexx.app._session import make_batch
+    
+    class StuckWebSocketDummy(ExporterWebSocketDummy):
+        def command(self, cmd):
+            super().command(cmd)
+            return FutureDummy()
+    
+    class FutureDummy:
+        def done(self):
+            return False
+        def add_done_callback(self, cb):
+            pass
+    
+    s = Session('', AssetStore())
+    ws = StuckWebSocketDummy()
+    s._set_ws(ws)
+    s._high_water_mark = 0  # nothing is written anymore
+    
+    # Pre-encoded commands (e.g. of shared models) are interactive,
+    # unless they define an asset
+    update = EncodedCommand(make_batch([['SET_PROP', 'x1', 'foo', '3']]).encode())
+    define = EncodedCommand(b'DEFINE-JS foo.js xx')
+    s._send_command(b'y' * 50)
+    s._send_command(update)
+    s._flush_commands()
+    s._send_command(define)
+    s._flush_commands()
+    assert [frame[0] for frame in s._send_queue] == ['data', 'interactive',
+                                                     'asset']
+    
+    # So they overtake data frames, and are counted as interactive
+    frames_sent = _metrics.frames_sent.get('interactive')
+    s._high_water_mark = 10**6
+    ws.commands = []
+    s._send_frames()
+    assert ws.commands == [update, b'y' * 50, define]
+    assert _metrics.frames_sent.get('interactive') == frames_sent + 1
+
+
+def test_session_resume():
+    
+    from flexx import config
+    from flexx.app._app import ExporterWebSocketDummy
+    
+    s = Session('', AssetStore())
+    s._resumable = True
+    ws1 = ExporterWebSocketDummy()
+    s._set_ws(ws1)
+    s._send_command('EXEC one')
+    s._flush_commands()
+    s._send_command('EXEC two')
+    s._flush_commands()
+    s._send_command(b'data')
+    s._flush_commands()
+    assert ws1.commands == ['INIT-DONE', 'EXEC one', 'EXEC two', b'data']
+    assert s._frame_seq == 4
+    
+    # The client acknowledges the frames it received
+    s._receive_ack(2)
+    assert [f[0] for f in s._replay_buffer] == [3, 4]
+    
+    # While suspended, commands are queued
+    s._send_command('EXEC three')  # not yet flushed
+    s._suspend()
+    assert s.status == s.STATUS.PENDING
+    s._send_command('EXEC four')
+    
+    # The client missed frames 4 and up
+    ws2 = ExporterWebSocketDummy()
+    assert s._resume(ws2, 3)
+    assert s.status == s.STATUS.CONNECTED
+    assert ws2.commands == [b'data', 'BATCH ["EXEC three", "EXEC four"]']
+    assert s._frame_seq == 5
+    
+    # Cannot resume if the missed frames are no longer available
+    s._suspend()
+    assert not s._resume(ExporterWebSocketDummy(), 2)
+    assert not s._resume(ExporterWebSocketDummy(), 6)
+    assert s._resume(ExporterWebSocketDummy(), 5)
+    
+    # The replay buffer is limited in size
+    ori = config.session_replay_size
+    config.session_replay_size = 10
+    try:
+        s._send_command(b'x' * 8)
+        s._flush_commands()
+        s._send_command(b'y' * 8)
+        s._flush_commands()
+    finally:
+        config.session_replay_size = ori
+    assert [f[1] for f in s._replay_buffer] == [b'y' * 8]
+    s._suspend()
+    assert not s._resume(ExporterWebSocketDummy(), 5)
+    assert s._resume(ExporterWebSocketDummy(), 6)
+
+
+def test_session_latency_stats():
+    
+    from flexx.app._session import get_latency_stats
+    
+    s = Session('xx')
+    assert s.latency_stats() == dict(count=0, p50=None, p95=None, max=None,
+                                     last=None)
+    
+    # Pongs without a round-trip time (e.g. a missed ping) are not counted
+    s._receive_pong(1)
+    s._receive_pong(2, 0.5)
+    assert s.latency_stats() == dict(count=1, p50=0.5, p95=0.5, max=0.5,
+                                     last=0.5)
+    
+    for i in range(3, 103):
+        s._receive_pong(i, 0.01 * (i % 20))
+    stats = s.latency_stats()
+    assert stats['count'] == s._roundtrips.maxlen == 60
+    assert stats['last'] == 0.02
+    assert stats['max'] == 0.19
+    assert abs(stats['p50'] - 0.09) < 1e-9
+    assert abs(stats['p95'] - 0.18) < 1e-9
+    
+    assert get_latency_stats([3, 1, 2]) == dict(count=3, p50=2, p95=3, max=3)
+
+
+def test_session_client_perf():
+    
+    from flexx.app import _metrics
+    
+    s = Session('xx')
+    stats = s.client_perf_stats()
+    assert stats['commands'] == {} and stats['init'] is None
+    assert stats['handlers'] == dict(count=0, total=0.0, max=0.0)
+    
+    n_init = _metrics.client_init_time.get()['count']
+    n_create = _metrics.client_commands.get('CREATE')
+    s._receive_command('PERF {"commands": {"CREATE": [2, 30, 20], "EXEC": [1, 1, 1]},'
+                       ' "assets": [1, 100, 100], "handlers": [5, 10, 4],'
+                       ' "init": 2000}')
+    s._receive_command('BATCH ["PERF {\\"commands\\": {\\"CREATE\\": [1, 40, 40]},'
+                       ' \\"assets\\": [0, 0, 0], \\"handlers\\": [0, 0, 0],'
+                       ' \\"init\\": null}"]')
+    stats = s.client_perf_stats()
+    assert stats['commands']['CREATE'] == dict(count=3, total=0.07, max=0.04)
+    assert stats['commands']['EXEC'] == dict(count=1, total=0.001, max=0.001)
+    assert stats['assets'] == dict(count=1, total=0.1, max=0.1)
+    assert stats['handlers'] == dict(count=5, total=0.01, max=0.004)
+    assert stats['init'] == 2.0
+    assert _metrics.client_init_time.get()['count'] == n_init + 1
+    assert _metrics.client_commands.get('CREATE') == n_create + 3
+    
+    # Invalid reports are ignored
+    s._receive_command('PERF {"commands": {"CREATE": [1]}}')
+    s._receive_command('PERF not json')
+    assert s.client_perf_stats()['commands']['CREATE']['count'] == 3
+    
+    # Unknown command types are grouped, so clients cannot add labels
+    n_other = _metrics.client_commands.get('other')
+    s._receive_command('PERF {"commands": {"X1": [1, 1, 1], "X2": [2, 1, 1]},'
+                       ' "assets": [0, 0, 0], "handlers": [0, 0, 0]}')
+    assert _metrics.client_commands.get('other') == n_other + 3
+    assert ('X1', ) not in _metrics.client_commands._values
+    assert s.client_perf_stats()['commands']['other']['count'] == 3
+
 run_tests_if_main()
@@ -0,0 +1,179 @@
+from flexx.util.testing import run_tests_if_main, raises
+
+from flexx import app, event
+from flexx.app import Session, SharedModel
+from flexx.app._assetstore import EncodedCommand
+
+
+validations = []
+
+
+class SharedFoo(SharedModel):
+
+    class Both:
+
+        @event.prop
+        def count(self, v=0):
+            validations.append(v)
+            return int(v)
+
+
+class WebSocketDummy:
+    close_code = None
+    ping_counter = 0
+    def command(self, cmd):
+        pass
+    def close_this(self):
+        self.close_code = 1000
+
+
+def make_sessions(n):
+    sessions = []
+    for i in range(n):
+        s = Session('xx')
+        s._set_ws(WebSocketDummy())
+        s.commands = []
+        s._send_command = s.commands.append
+        sessions.append(s)
+    return sessions
+
+
+def test_shared_model_basics():
+
+    m = SharedFoo()
+    assert m.session.id == 'shared'
+    assert m.id.startswith('SharedFoo_s')
+    assert m.session.sessions == []
+
+    with raises(ValueError):
+        SharedFoo(session=Session('xx'))
+
+    # Changes without subscribers are fine
+    m.count = 2
+    m.session._flush_commands()
+    assert m.count == 2
+
+
+def test_shared_model_subscribe():
+
+    m = SharedFoo(count=3)
+    s1, s2, s3 = make_sessions(3)
+
+    m.subscribe(s1)
+    m.subscribe(s2)
+    m.subscribe(s2)  # no-op
+    assert m.session.sessions == [s1, s2]
+
+    # Subscribing defines the class, creates the object and sends the state
+    ops = [c for c in s1.commands if isinstance(c, list)]
+    assert ops[0][:3] == ['CREATE', m.id, 'SharedFoo']
+    assert ['SET_PROP', m.id, 'count', '3'] in ops
+    assert ['CALL', m.id, 'init'] in ops
+    assert s1.get_model_instance_by_id(m.id) is m
+    assert ops == [c for c in s2.commands if isinstance(c, list)]
+
+    # A change is validated once, and encoded once for all sessions
+    s1.commands[:], s2.commands[:] = [], []
+    validations[:] = []
+    m.count = 4
+    m.count = 5  # coalesced
+    m.session._flush_commands()
+    assert validations == [4, 5]
+    assert len(s1.commands) == 1 and len(s2.commands) == 1
+    assert s1.commands[0] is s2.commands[0]
+    assert isinstance(s1.commands[0], EncodedCommand)
+    assert b'"count"' in s1.commands[0] and b'"5"' in s1.commands[0]
+    assert b'"4"' not in s1.commands[0]
+
+    # A change from one client is send to all clients
+    s1.commands[:], s2.commands[:] = [], []
+    m._set_prop_from_js('count', '6')
+    m.session._flush_commands()
+    assert m.count == 6
+    assert s1.commands[0] is s2.commands[0]
+
+    # Late subscribers get the current state
+    m.subscribe(s3)
+    assert ['SET_PROP', m.id, 'count', '6'] in s3.commands
+
+    # Unsubscribe
+    s2.commands[:] = []
+    m.unsubscribe(s2)
+    assert s2.commands == [['DISPOSE', m.id]]
+    assert s2.get_model_instance_by_id(m.id) is None
+
+    # Closed sessions are dropped
+    s3.close()
+    assert m.session.sessions == [s1]
+
+    # Only shared models can live in a shared session
+    with raises(TypeError):
+        with m:
+            app.Model()
+
+
+def test_shared_model_closed_sessions():
+
+    m = SharedFoo()
+    s1, s2 = Session('xx'), Session('xx')  # pending
+    m.subscribe(s1)
+    m.subscribe(s2)
+    assert s1.status == s1.STATUS.PENDING
+
+    # A pending session that is closed (e.g. expired) is unsubscribed
+    s1.close()
+    assert s1.status == s1.STATUS.CLOSED
+    assert m.session.sessions == [s2]
+    assert s1._shared_sessions == []
+    with raises(RuntimeError):
+        m.subscribe(s1)
+
+    # A suspended session that times out too
+    s2._set_ws(WebSocketDummy())
+    s2._suspend()
+    assert s2.status == s2.STATUS.PENDING
+    m.count = 1
+    m.session._flush_commands()
+    n = len(s2._pending_commands)
+    s2.close()
+    assert s2.status == s2.STATUS.CLOSED
+    assert m.session.sessions == []
+
+    # No more commands are queued for closed sessions
+    for i in range(3):
+        m.count = i + 10
+        m.session._flush_commands()
+    assert len(s1._pending_commands) == 0  # cleared on close
+    assert len(s2._pending_commands) <= n
+
+
+def test_shared_model_pooled_sessions():
+
+    m = SharedFoo(count=1)
+    s = Session('xx')
+    m.subscribe(s)
+    s._set_pooled(True)
+    n = len(s._pending_commands)
+
+    # Updates are not queued for pooled sessions ...
+    for i in range(3):
+        m.count = i + 2
+        m.session._flush_commands()
+    assert len(s._pending_commands) == n
+
+    # ... but the state is send when the session is handed out
+    s._set_pooled(False)
+    assert s._pending_commands[-1] == ['SET_PROP', m.id, 'count', '4']
+    m.count = 5
+    m.session._flush_commands()
+    assert isinstance(s._pending_commands[-1], EncodedCommand)
+
+    # Pooled sessions that are closed (e.g. the app is re-registered)
+    s2 = Session('xx')
+    m.subscribe(s2)
+    s2._set_pooled(True)
+    s2.close()
+    assert m.session.sessions == [s]
+
+
+run_tests_if_main()
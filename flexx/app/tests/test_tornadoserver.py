@@ -0,0 +1,237 @@
+from flexx.util.testing import run_tests_if_main, raises
+
+import time
+
+from tornado import gen, netutil
+from tornado.web import Application, RequestHandler
+from tornado.ioloop import IOLoop
+from tornado.httpserver import HTTPServer
+from tornado.httpclient import AsyncHTTPClient
+from tornado.websocket import WebSocketHandler, websocket_connect
+
+from flexx.app import _tornadoserver
+from flexx.app._tornadoserver import (WSHandler, MainHandler, WorkerProxy,
+                                      get_worker_port, measure_loop_lag,
+                                      check_pending_sessions)
+
+
+class ManagerDummy:
+    def __init__(self):
+        self.disconnects = []
+        self.checks = 0
+    def disconnect_client(self, session, resumable=False):
+        self.disconnects.append((session, resumable))
+    def _get_check_interval(self):
+        return 0.01
+    def _clear_old_pending_sessions(self):
+        self.checks += 1
+
+
+class CounterDummy:
+    def stop(self):
+        pass
+
+
+class ConnectionDummy:
+    def __init__(self):
+        self.close_args = None
+    def close(self, code=None, reason=None):
+        self.close_args = code, reason
+
+
+class ProxyDummy:
+    def __init__(self):
+        self.close_args = None
+    def close(self, code=None, reason=None):
+        self.close_args = code, reason
+
+
+def make_handler(close_code, close_requested=False, proxy=None):
+    # A handler without a connection, in the state that on_close() needs
+    handler = WSHandler.__new__(WSHandler)
+    handler.close_code = close_code
+    handler.close_reason = None
+    handler._close_requested = close_requested
+    handler._mps_counter = CounterDummy()
+    handler._proxy = proxy
+    handler._session = None if proxy else 'session'
+    return handler
+
+
+def test_ws_close_resumable():
+
+    ori_manager, _tornadoserver.manager = _tornadoserver.manager, ManagerDummy()
+    try:
+        make_handler(None).on_close()  # connection lost
+        make_handler(1001).on_close()  # client went away
+        make_handler(1000).on_close()  # client closed the page
+        make_handler(1013, True).on_close()  # server closed the connection
+        make_handler(1000, True).on_close()
+        disconnects = _tornadoserver.manager.disconnects
+    finally:
+        _tornadoserver.manager = ori_manager
+
+    assert [resumable for s, resumable in disconnects] == [True, True, False,
+                                                          False, False]
+
+
+def test_ws_close_forwarded_to_worker():
+
+    # The close code and reason of the client are passed to the worker
+    proxy = ProxyDummy()
+    handler = make_handler(1000, proxy=proxy)
+    handler.close_reason = 'bye'
+    handler.on_close()
+    assert proxy.close_args == (1000, 'bye')
+
+    # A lost connection lets the worker keep the session
+    proxy = ProxyDummy()
+    make_handler(None, proxy=proxy).on_close()
+    assert proxy.close_args == (1001, 'connection lost')
+
+    # The proxy closes the connection to the worker with that code
+    proxy = WorkerProxy.__new__(WorkerProxy)
+    proxy._conn = conn = ConnectionDummy()
+    proxy.close(1000, 'client done')
+    assert proxy._closed
+    assert conn.close_args == (1000, 'client done')
+
+
+class ApplicationDummy:
+    _flexx_worker = 0
+    _flexx_worker_ports = [8001, 8002, 8003]
+
+
+class ServerDummy:
+    serving = ('localhost', 8000)
+
+
+def test_worker_port():
+
+    # Sessions are routed to the worker whose index is in the session id
+    a = ApplicationDummy()
+    assert get_worker_port(a, '1-xyz') == 8002
+    assert get_worker_port(a, '2-xyz') == 8003
+    assert get_worker_port(a, '0-xyz') is None  # that's us
+    assert get_worker_port(a, '3-xyz') is None  # no such worker
+    assert get_worker_port(a, 'xyz') is None
+    assert get_worker_port(a, '') is None
+    assert get_worker_port(object(), '1-xyz') is None  # single process
+
+    # And so are requests for the metrics of a worker
+    handler = MainHandler.__new__(MainHandler)
+    handler.application = a
+    assert handler._get_worker_port_by_index('2') == 8003
+    assert handler._get_worker_port_by_index('0') is None
+    assert handler._get_worker_port_by_index('3') is None
+    assert handler._get_worker_port_by_index('') is None
+    handler.application = object()
+    assert handler._get_worker_port_by_index('1') is None
+
+
+def test_measure_loop_lag_stops():
+
+    server = ServerDummy()
+    loop = IOLoop()
+    loop.call_later(0.1, lambda: setattr(server, 'serving', None))
+    t0 = time.time()
+    try:
+        loop.run_sync(lambda: measure_loop_lag(server, 0.01), timeout=5)
+    finally:
+        loop.close()
+    assert time.time() - t0 < 1
+
+
+def test_check_pending_sessions_stops():
+
+    # The server checks for expired sessions while it is serving
+    server = ServerDummy()
+    loop = IOLoop()
+    loop.call_later(0.1, lambda: setattr(server, 'serving', None))
+    ori_manager, _tornadoserver.manager = _tornadoserver.manager, ManagerDummy()
+    t0 = time.time()
+    try:
+        loop.run_sync(lambda: check_pending_sessions(server), timeout=5)
+        checks = _tornadoserver.manager.checks
+    finally:
+        _tornadoserver.manager = ori_manager
+        loop.close()
+    assert time.time() - t0 < 1
+    assert 2 <= checks <= 10
+
+
+class WorkerWSHandler(WebSocketHandler):
+    # Stand-in for the websocket of the worker that owns the session
+    closes = []
+    def on_message(self, message):
+        self.write_message('echo ' + message)
+    def on_close(self):
+        self.closes.append((self.close_code, self.close_reason))
+
+
+class WorkerMetricsHandler(RequestHandler):
+    def get(self, path):
+        self.set_header('Content-Type', 'text/plain')
+        self.write('metrics of worker 1')
+
+
+def test_worker_forwarding():
+
+    loop = IOLoop()
+    loop.make_current()
+    servers = []
+    try:
+        # Worker 1 is a stand-in, worker 0 is a real flexx application
+        sock1 = netutil.bind_sockets(0, '127.0.0.1')[0]
+        sock0 = netutil.bind_sockets(0, '127.0.0.1')[0]
+        port1, port0 = sock1.getsockname()[1], sock0.getsockname()[1]
+        app1 = Application([(r"/flexx/ws/(.*)", WorkerWSHandler),
+                            (r"/flexx/(.*)", WorkerMetricsHandler)])
+        app0 = Application([(r"/flexx/ws/(.*)", WSHandler),
+                            (r"/flexx/(.*)", MainHandler)])
+        app0._flexx_worker = 0
+        app0._flexx_worker_ports = [port0, port1]
+        for app, sock in [(app1, sock1), (app0, sock0)]:
+            servers.append(HTTPServer(app))
+            servers[-1].add_sockets([sock])
+        url = '127.0.0.1:%i/flexx/' % port0
+
+        @gen.coroutine
+        def connect_and_close(code, reason):
+            ws_url = 'ws://%sws/foo?session_id=1-xyz' % url
+            conn = yield websocket_connect(ws_url)
+            conn.write_message('hiflexx 1-xyz')
+            message = yield conn.read_message()
+            conn.close(code, reason)
+            for i in range(100):
+                if len(WorkerWSHandler.closes) == n_closes + 1:
+                    break
+                yield gen.sleep(0.01)
+            return message
+
+        # Websocket messages are forwarded in both directions
+        n_closes = len(WorkerWSHandler.closes)
+        message = loop.run_sync(lambda: connect_and_close(1000, 'client done'),
+                                timeout=5)
+        assert message == 'echo hiflexx 1-xyz'
+        # The close code is forwarded too, so the worker can tell that
+        # the session cannot be resumed
+        assert WorkerWSHandler.closes[-1] == (1000, 'client done')
+
+        n_closes = len(WorkerWSHandler.closes)
+        loop.run_sync(lambda: connect_and_close(1001, 'going away'), timeout=5)
+        assert WorkerWSHandler.closes[-1] == (1001, 'going away')
+
+        # Http requests for the metrics of a worker are forwarded
+        response = loop.run_sync(lambda: AsyncHTTPClient().fetch(
+            'http://%smetrics/1' % url), timeout=5)
+        assert response.body == b'metrics of worker 1'
+
+    finally:
+        for server in servers:
+            server.stop()
+        loop.clear_current()
+        loop.close(all_fds=True)
+
+
+run_tests_if_main()
@@ -0,0 +1,115 @@
+from flexx.util.testing import run_tests_if_main, raises
+
+import os
+import json
+import tempfile
+
+from flexx import app, event
+from flexx.app import Session, TraceRecorder
+
+
+class MyTracedModel(app.Model):
+
+    @event.prop
+    def foo(self, v=0):
+        return v
+
+    @event.connect('foo')
+    def on_foo(self, *events):
+        pass
+
+
+class WebSocketDummy:
+    close_code = None
+    ping_counter = 0
+    def command(self, cmd):
+        pass
+    def close_this(self):
+        self.close_code = 1000
+
+
+def make_session():
+    s = Session('xx')
+    s._set_ws(WebSocketDummy())
+    return s
+
+
+def test_trace_recorder():
+
+    s1, s2 = make_session(), make_session()
+    m1 = MyTracedModel(session=s1)
+    m2 = MyTracedModel(session=s2)
+    event.loop.iter()
+
+    r1 = TraceRecorder(s1)
+    r2 = TraceRecorder()
+    assert not r1.recording
+    with r1:
+        r2.start()
+        assert r1.recording and r2.recording
+        m1.foo = 3
+        m2.foo = 4
+        event.loop.iter()
+        s1._send_op('SET_PROP', m1.id, 'foo', '3')
+        s1._send_command(b'x' * 10)
+        s1._send_command('DEFINE-JS-EVAL foo')
+        s2._receive_command('BATCH ["INFO hi"]')
+    r2.stop()
+    assert not r1.recording and not r2.recording
+
+    # Nothing is recorded after stopping
+    n1, n2 = len(r1._events), len(r2._events)
+    m1.foo = 5
+    event.loop.iter()
+    assert len(r1._events) == n1 and len(r2._events) == n2
+
+    trace = r1.get_trace()
+    events = trace['traceEvents']
+    names = [e['name'] for e in events]
+    assert 'Loop.iter' in names
+    assert 'MyTracedModel.on_foo' in names
+    assert 'send SET_PROP' in names
+    assert 'send DATA' in names and 'send DEFINE-JS-EVAL' in names
+    assert 'receive BATCH' not in names  # other session
+
+    by_name = dict((e['name'], e) for e in events)
+    assert by_name['send DATA']['cat'] == 'data'
+    assert by_name['send DATA']['args'] == dict(size=10)
+    assert by_name['send DEFINE-JS-EVAL']['cat'] == 'asset'
+    assert by_name['MyTracedModel.on_foo']['ph'] == 'X'
+    assert by_name['MyTracedModel.on_foo']['args'] == dict(session=s1.id)
+    for e in events:
+        assert e['pid'] == os.getpid()
+    handler_calls = [e for e in events if e['name'] == 'MyTracedModel.on_foo']
+    assert len(handler_calls) == 1
+
+    # The process-wide recorder records all sessions
+    names = [e['name'] for e in r2.get_trace()['traceEvents']]
+    assert names.count('MyTracedModel.on_foo') == 2
+    assert 'receive BATCH' in names and 'receive INFO' in names
+    thread_names = [e['args']['name'] for e in r2.get_trace()['traceEvents']
+                    if e['name'] == 'thread_name']
+    assert 'session %s' % s2.id in thread_names
+
+    # Save as JSON
+    filename = os.path.join(tempfile.gettempdir(), 'flexx_trace_test.json')
+    r1.save(filename)
+    with open(filename, 'rb') as f:
+        assert json.loads(f.read().decode()) == trace
+    os.remove(filename)
+
+    r1.clear()
+    assert r1.get_trace()['traceEvents'][-1]['ph'] == 'M'
+
+
+def test_trace_recorder_max_events():
+
+    s = make_session()
+    with TraceRecorder(s, max_events=3) as r:
+        for i in range(5):
+            s._send_command('PRINT %i' % i)
+    assert len(r._events) == 3
+    assert r._dropped == 2
+
+
+run_tests_if_main()
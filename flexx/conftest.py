@@ -0,0 +1,22 @@
+"""
+Configuration of pytest for the flexx test suite.
+"""
+
+import shutil
+import tempfile
+
+from flexx.pyscript import cache
+
+_pyscript_cache_dir = None
+
+
+def pytest_configure(config):
+    # Do not write to the PyScript cache in the user's appdata dir
+    global _pyscript_cache_dir
+    _pyscript_cache_dir = tempfile.mkdtemp(prefix='flexx_pyscript_cache_')
+    cache.set_cache_dir(_pyscript_cache_dir)
+
+
+def pytest_unconfigure(config):
+    cache.set_cache_dir(None)
+    shutil.rmtree(_pyscript_cache_dir, ignore_errors=True)
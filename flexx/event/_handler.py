@@ -4,6 +4,7 @@ Implementation of handler class and corresponding descriptor.
 
 import weakref
 import inspect
+from time import perf_counter
 
 from ._dict import Dict
 from ._loop import loop
@@ -317,6 +318,7 @@ class Handler:
             if not this_is_js():
                 logger.debug('Handler %s is processing %i events' %
                             (self._name, len(events)))
+                t0 = perf_counter()
             try:
                 self(*events)
             except Exception as err:
@@ -325,6 +327,8 @@ class Handler:
                 else:
                     err.skip_tb = 2
                     logger.exception(err)
+            if not this_is_js():
+                loop._handler_done(self, perf_counter() - t0)
 
     def _collect(self):
         """ Get list of events and reconnect-events from list of pending events.
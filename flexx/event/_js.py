@@ -5,7 +5,7 @@ Implementation of flexx.event in JS via PyScript.
 import sys
 import json
 
-from flexx.pyscript import JSString, py2js as py2js_
+from flexx.pyscript import JSString, RawJS, py2js as py2js_
 from flexx.pyscript.parser2 import get_class_definition
 
 from flexx.event._emitters import BaseEmitter, Property
@@ -32,7 +32,8 @@ class HasEventsJS:
     implementation of this event system have the same API and behavior.
     
     The Python version of this class has a ``JSCODE`` attribute that
-    contains the auto-generated JavaScript for this class.
+    contains the auto-generated JavaScript for this class (transpiled
+    on first use).
     """
     
     _HANDLER_COUNT = 0
@@ -166,6 +167,7 @@ class Loop:
     def __init__(self):
         self._pending_calls = []
         self._scheduled = False
+        self._iter_observers = []
     
     def call_later(self, func):
         """ Call the given function in the next iteration of the "event loop".
@@ -179,12 +181,30 @@ class Loop:
         """ Do one event loop iteration; process all pending function calls.
         """
         self._scheduled = False
+        t0 = self._now()
+        count = 0
         while len(self._pending_calls):
             func = self._pending_calls.pop(0)
+            count += 1
             try:
                 func()
             except Exception as err:
                 console.log(err)
+        if len(self._iter_observers):
+            duration = (self._now() - t0) / 1000
+            for func in self._iter_observers:
+                func(count, duration)
+    
+    def add_iter_observer(self, func):
+        """ Register a function that is called as ``func(count, duration)``
+        after each iteration, like the Python Loop.
+        """
+        self._iter_observers.append(func)
+    
+    def _now(self):
+        # Time in ms, with sub-ms resolution if available
+        return RawJS('typeof performance === "undefined" ? '
+                     'Date.now() : performance.now()')
 
 
 def get_HasEvents_js():
@@ -214,7 +234,19 @@ def get_HasEvents_js():
     return jscode
 
 
-HasEventsJS.JSCODE = get_HasEvents_js()
+class LazyHasEventsJS:
+    """ Descriptor for ``HasEventsJS.JSCODE``. Gets the JS code on first
+    access, and then replaces itself with it. A server that uses a frozen
+    build sets the code from the build instead.
+    """
+    
+    def __get__(self, ob, owner):
+        code = get_HasEvents_js()
+        HasEventsJS.JSCODE = code
+        return code
+
+
+HasEventsJS.JSCODE = LazyHasEventsJS()
 
 
 def create_js_hasevents_class(cls, cls_name, base_class='HasEvents.prototype'):
@@ -4,6 +4,7 @@ event loop such as tornado or Qt.
 """
 
 import sys
+from time import perf_counter
 
 from . import logger
 
@@ -26,6 +27,8 @@ class Loop:
         self._pending_calls = []
         self._calllaterfunc = lambda x: None
         self._scheduled_update = False
+        self._handler_observers = []
+        self._iter_observers = []
     
     def call_later(self, func):
         """ Call the given function in the next iteration of the event loop.
@@ -39,12 +42,41 @@ class Loop:
         """ Do one event loop iteration; process all pending function calls.
         """
         self._scheduled_update = False
+        t0 = perf_counter()
+        count = 0
         while self._pending_calls:
             func = self._pending_calls.pop(0)
+            count += 1
             try:
                 func()
             except Exception as err:
                 logger.exception(err)
+        if self._iter_observers:
+            self._notify(self._iter_observers, count, perf_counter() - t0)
+    
+    def add_handler_observer(self, func):
+        """ Register a function that is called as ``func(handler, duration)``
+        each time that a handler has processed its pending events, with
+        the duration in seconds. This can be used for profiling.
+        """
+        self._handler_observers.append(func)
+    
+    def add_iter_observer(self, func):
+        """ Register a function that is called as ``func(count, duration)``
+        after each iteration, with the number of function calls that were
+        processed and the duration in seconds.
+        """
+        self._iter_observers.append(func)
+    
+    def _handler_done(self, handler, duration):
+        self._notify(self._handler_observers, handler, duration)
+    
+    def _notify(self, observers, *args):
+        for func in observers:
+            try:
+                func(*args)
+            except Exception as err:
+                logger.exception(err)
     
     def __enter__(self):
         return self
@@ -0,0 +1,108 @@
+"""
+Implementation of a profiler for event handlers.
+"""
+
+import json
+
+from .. import config
+from ._loop import loop
+from . import logger
+
+
+class HandlerProfiler:
+    """ Collects timing statistics of event handlers (in Python). There
+    is one instance in ``flexx.event.profiler``.
+
+    Profiling is opt-in: call ``enable()`` to start collecting, and
+    ``get_stats()`` or ``dump()`` to get the results. The statistics are
+    kept per handler name and the class of the object that owns the
+    handler, so that all instances of a class are combined.
+
+    Independent of profiling, a warning is logged for each handler call
+    that blocks the event loop for longer than ``warn_threshold`` seconds
+    (default ``flexx.config.handler_warn_threshold``, zero disables this).
+    """
+
+    def __init__(self):
+        self._enabled = False
+        self._warn_threshold = None
+        self._stats = {}  # key -> [count, total, max, last]
+
+    @property
+    def enabled(self):
+        """ Whether handler calls are being recorded.
+        """
+        return self._enabled
+
+    @property
+    def warn_threshold(self):
+        """ The duration in seconds above which a handler call is reported
+        as slow. Set to None to use ``flexx.config.handler_warn_threshold``.
+        """
+        if self._warn_threshold is None:
+            return config.handler_warn_threshold
+        return self._warn_threshold
+
+    @warn_threshold.setter
+    def warn_threshold(self, value):
+        self._warn_threshold = None if value is None else float(value)
+
+    def enable(self):
+        """ Start recording handler calls.
+        """
+        self._enabled = True
+
+    def disable(self):
+        """ Stop recording handler calls. The statistics are kept.
+        """
+        self._enabled = False
+
+    def clear(self):
+        """ Remove all statistics.
+        """
+        self._stats = {}
+
+    def get_stats(self):
+        """ Get a dict that maps "ClassName.handler_name" to a dict with
+        the number of calls (count), and the total, maximum and last
+        duration in seconds.
+        """
+        return dict((key, dict(count=s[0], total=s[1], max=s[2], last=s[3]))
+                    for key, s in self._stats.items())
+
+    def dump(self, filename=None):
+        """ Get the statistics as a JSON string, with the handlers sorted
+        by total duration (most expensive first). If a filename is given,
+        the JSON is also written to that file.
+        """
+        stats = sorted(self.get_stats().items(), key=lambda x: -x[1]['total'])
+        text = json.dumps([dict(handler=key, **s) for key, s in stats], indent=2)
+        if filename:
+            with open(filename, 'wb') as f:
+                f.write(text.encode())
+        return text
+
+    def _get_key(self, handler):
+        ob = handler._ob1()
+        cls_name = ob.__class__.__name__ if ob is not None else '?'
+        return cls_name + '.' + handler.get_name()
+
+    def _handler_done(self, handler, duration):
+        if self._enabled:
+            key = self._get_key(handler)
+            s = self._stats.get(key, None)
+            if s is None:
+                self._stats[key] = [1, duration, duration, duration]
+            else:
+                s[0] += 1
+                s[1] += duration
+                s[2] = max(s[2], duration)
+                s[3] = duration
+        threshold = self.warn_threshold
+        if threshold > 0 and duration > threshold:
+            logger.warn('Handler %s blocked the event loop for %1.3f s.' %
+                        (self._get_key(handler), duration))
+
+
+profiler = HandlerProfiler()
+loop.add_handler_observer(profiler._handler_done)
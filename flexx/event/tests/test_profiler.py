@@ -0,0 +1,89 @@
+from flexx.util.testing import run_tests_if_main, raises
+
+import json
+import time
+import logging
+
+from flexx import event
+from flexx.event import profiler
+
+
+class Foo(event.HasEvents):
+
+    @event.prop
+    def foo(self, v=0):
+        return v
+
+    @event.connect('foo')
+    def on_foo(self, *events):
+        if self.foo > 10:
+            time.sleep(0.03)
+
+
+class MyHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_profiler_stats():
+
+    profiler.clear()
+    foo = Foo()
+    event.loop.iter()
+    assert profiler.get_stats() == {}  # not enabled
+
+    profiler.enable()
+    try:
+        assert profiler.enabled
+        foo.foo = 1
+        event.loop.iter()
+        foo.foo = 2
+        bar = Foo()
+        bar.foo = 3
+        event.loop.iter()
+    finally:
+        profiler.disable()
+    foo.foo = 4
+    event.loop.iter()
+
+    stats = profiler.get_stats()
+    assert list(stats.keys()) == ['Foo.on_foo']
+    s = stats['Foo.on_foo']
+    assert s['count'] == 3  # instances of a class are combined
+    assert 0 < s['max'] <= s['total']
+    assert s['last'] <= s['max']
+
+    d = json.loads(profiler.dump())
+    assert d[0]['handler'] == 'Foo.on_foo' and d[0]['count'] == 3
+
+    profiler.clear()
+    assert profiler.get_stats() == {}
+
+
+def test_profiler_warn_threshold():
+
+    from flexx import config
+
+    handler = MyHandler()
+    event.logger.addHandler(handler)
+    foo = Foo()
+    try:
+        assert profiler.warn_threshold == config.handler_warn_threshold
+        profiler.warn_threshold = 0.02
+        foo.foo = 1
+        event.loop.iter()
+        assert not handler.messages
+        foo.foo = 11
+        event.loop.iter()
+        assert len(handler.messages) == 1
+        assert 'Foo.on_foo' in handler.messages[0]
+    finally:
+        event.logger.removeHandler(handler)
+        profiler.warn_threshold = None
+    assert profiler.warn_threshold == config.handler_warn_threshold
+
+
+run_tests_if_main()
@@ -0,0 +1,180 @@
+"""
+Persistent on-disk cache for transpiled code. Transpiling is relatively
+expensive, and the same code is transpiled again in every process that
+uses it. Therefore ``py2js()`` stores the resulting JS and its meta info
+in the flexx appdata dir, keyed by a hash of the Python code, the version
+of the parser, and the parser options.
+
+Entries are stored as one JSON file each, which are written atomically,
+so that multiple processes can safely use the same cache. Corrupt
+entries are ignored (and removed). When the cache grows beyond
+``flexx.config.pyscript_cache_size`` MiB, the oldest entries are removed.
+Set ``flexx.config.pyscript_cache`` to False to disable the cache.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import tempfile
+
+from .. import config
+from ..util.config import appdata_dir
+from . import logger
+
+# Increase this when the layout of the cache entries changes
+CACHE_FORMAT = 1
+
+# The modules that determine what JS the parser produces
+PARSER_MODULES = ('commonast', 'parser0', 'parser1', 'parser2', 'parser3',
+                  'stdlib')
+
+_cache_dir = None  # set on first use, or via set_cache_dir()
+_parser_version = None
+_save_count = 0
+
+
+def get_parser_version():
+    """ Get a hash that represents the version of the parser, based on
+    its source code. Returns an empty string if this cannot be determined
+    (e.g. in a frozen app), in which case the cache is not used.
+    """
+    global _parser_version
+    if _parser_version is None:
+        h = hashlib.sha1(sys.version.split(' ')[0].encode())  # ast can differ
+        try:
+            for name in PARSER_MODULES:
+                filename = os.path.join(os.path.dirname(__file__), name + '.py')
+                with open(filename, 'rb') as f:
+                    h.update(f.read())
+        except (IOError, OSError):
+            _parser_version = ''
+        else:
+            _parser_version = h.hexdigest()
+    return _parser_version
+
+
+def get_cache_dir():
+    """ Get the directory of the cache, or None if the cache is disabled.
+    """
+    global _cache_dir
+    if _cache_dir is None:
+        _cache_dir = ''
+        if config.pyscript_cache and get_parser_version():
+            try:
+                dirname = os.path.join(appdata_dir(), 'flexx', 'pyscript_cache',
+                                       'v%i' % CACHE_FORMAT)
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                _cache_dir = dirname
+            except (IOError, OSError) as err:
+                logger.warn('Cannot use PyScript cache: %s' % err)
+    return _cache_dir or None
+
+
+def set_cache_dir(dirname):
+    """ Set the directory to store the cache in. Set to None to use the
+    default directory (or disable the cache if ``config.pyscript_cache``
+    is False), or to '' to disable the cache.
+    """
+    global _cache_dir
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    _cache_dir = dirname
+
+
+def get_key(pyhash, pysource, parser_options):
+    """ Get the key for an entry in the cache, or None if the cache is
+    disabled. The pysource is the (filename, linenr) tuple or None that
+    is passed to the parser.
+    """
+    if not get_cache_dir():
+        return None
+    h = hashlib.sha1(get_parser_version().encode())
+    h.update(pyhash)
+    # The parser only uses the filename for errors, and whether the line
+    # number is zero to detect module mode.
+    module_mode = pysource is not None and pysource[1] == 0
+    h.update(repr((pysource is not None, module_mode)).encode())
+    h.update(repr(sorted(parser_options.items())).encode())
+    return h.hexdigest()
+
+
+def load(key):
+    """ Get the (jscode, meta) tuple for the given key, or None if the
+    cache has no (valid) entry for it.
+    """
+    filename = os.path.join(get_cache_dir(), key + '.json')
+    try:
+        with open(filename, 'rb') as f:
+            d = json.loads(f.read().decode())
+        if d['key'] != key:
+            raise ValueError('key mismatch')
+        meta = dict((name, set(d['meta'][name])) for name in
+                    ('vars_defined', 'vars_unknown', 'vars_global',
+                     'std_functions', 'std_methods'))
+        return d['jscode'], meta
+    except (IOError, OSError):
+        return None  # not in the cache
+    except Exception as err:
+        logger.warn('Removing corrupt PyScript cache entry %s: %s' % (key, err))
+        try:
+            os.remove(filename)
+        except (IOError, OSError):
+            pass
+        return None
+
+
+def save(key, jscode, meta):
+    """ Store the JS code and meta info (a dict of sets) for the given key.
+    """
+    global _save_count
+    dirname = get_cache_dir()
+    d = dict(key=key, jscode=jscode,
+             meta=dict((name, sorted(val)) for name, val in meta.items()))
+    # Write to a temporary file and rename, so readers never see a partial file
+    try:
+        fd, tempname = tempfile.mkstemp('.tmp', 'entry', dirname)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps(d).encode())
+        os.replace(tempname, os.path.join(dirname, key + '.json'))
+    except (IOError, OSError) as err:
+        logger.warn('Could not write PyScript cache entry: %s' % err)
+        return
+    # Check the size now and then
+    _save_count += 1
+    if _save_count % 100 == 1:
+        evict(config.pyscript_cache_size * 2**20)
+
+
+def evict(max_size):
+    """ Remove the oldest entries until the cache is smaller than max_size
+    bytes (or half of that, so that we do not need to evict on each call).
+    """
+    dirname = get_cache_dir()
+    entries = []
+    for fname in os.listdir(dirname):
+        try:
+            st = os.stat(os.path.join(dirname, fname))
+        except (IOError, OSError):
+            continue  # removed by another process
+        entries.append((st.st_mtime, st.st_size, fname))
+    total_size = sum(e[1] for e in entries)
+    if total_size <= max_size:
+        return
+    entries.sort()
+    for mtime, size, fname in entries:
+        if total_size <= max_size // 2:
+            break
+        try:
+            os.remove(os.path.join(dirname, fname))
+        except (IOError, OSError):
+            pass
+        total_size -= size
+
+
+def clear():
+    """ Remove all entries from the cache.
+    """
+    if get_cache_dir():
+        evict(-1)
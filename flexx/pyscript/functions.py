@@ -7,6 +7,7 @@ import tempfile
 import subprocess
 
 from . import Parser
+from . import cache
 from .stdlib import get_full_std_lib  # noqa
 from .modules import create_js_module
 
@@ -48,6 +49,9 @@ def py2js(ob=None, new_name=None, **parser_options):
         multiple classes with the same name are defined. This is a
         consequence of classes not having a corresponding code object (in
         contrast to functions).
+        
+        The resulting JS is cached on disk (see ``flexx.pyscript.cache``),
+        so that the same code is not transpiled again in other processes.
     
     """
     
@@ -95,17 +99,28 @@ def py2js(ob=None, new_name=None, **parser_options):
             raise ValueError('py2js() only accepts non-builtin modules, '
                              'classes and functions.')
         
-        # Get hash, in case we ever want to cache JS accross sessions
+        # Get hash, used to cache JS accross processes
         h = hashlib.sha256('pyscript version 1'.encode())
         h.update(pycode.encode())
         hash = h.digest()
         
-        # Get JS code
-        if filename:
-            p = Parser(pycode, (filename, linenr), **parser_options)
+        # Get JS code, from the cache if we can
+        pysource = (filename, linenr) if filename else None
+        key = cache.get_key(hash, pysource, parser_options)
+        cached = cache.load(key) if key else None
+        if cached is None:
+            p = Parser(pycode, pysource, **parser_options)
+            jscode = p.dump()
+            meta = {}
+            meta['vars_defined'] = set(n for n in p.vars if p.vars[n])
+            meta['vars_unknown'] = set(n for n in p.vars if not p.vars[n])
+            meta['vars_global'] = set(n for n in p.vars if p.vars[n] is False)
+            meta['std_functions'] = p._std_functions
+            meta['std_methods'] = p._std_methods
+            if key:
+                cache.save(key, jscode, meta)
         else:
-            p = Parser(pycode, **parser_options)
-        jscode = p.dump()
+            jscode, meta = cached
         if new_name and thetype in ('class', 'def'):
             jscode = js_rename(jscode, ob.__name__, new_name)
         
@@ -119,11 +134,7 @@ def py2js(ob=None, new_name=None, **parser_options):
         jscode.meta['linenr'] = linenr
         jscode.meta['pycode'] = pycode
         jscode.meta['pyhash'] = hash
-        jscode.meta['vars_defined'] = set(n for n in p.vars if p.vars[n])
-        jscode.meta['vars_unknown'] = set(n for n in p.vars if not p.vars[n])
-        jscode.meta['vars_global'] = set(n for n in p.vars if p.vars[n] is False)
-        jscode.meta['std_functions'] = p._std_functions
-        jscode.meta['std_methods'] = p._std_methods
+        jscode.meta.update(meta)
         
         return jscode
     
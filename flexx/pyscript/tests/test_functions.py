@@ -154,6 +154,46 @@ f2 = function () {
 #     assert code.count('var bar =') == 2
 
 
+def test_py2js_cache():
+    
+    from flexx.pyscript import cache
+    
+    ori_dirname = cache.get_cache_dir() or ''
+    dirname = os.path.join(tempfile.gettempdir(), 'flexx_pyscript_cache_test')
+    cache.set_cache_dir(dirname)
+    try:
+        cache.clear()
+        code = 'def foo():\n    """ docs """\n    return len(bar)\n'
+        
+        js1 = py2js(code)
+        assert len(os.listdir(dirname)) == 1
+        js2 = py2js(code)
+        assert js2 == js1
+        assert js2.meta['vars_defined'] == set(['foo'])
+        assert 'bar' in js2.meta['vars_unknown']
+        
+        # Parser options are part of the key
+        js3 = py2js(code, docstrings=False)
+        assert js3 != js1
+        assert len(os.listdir(dirname)) == 2
+        js4 = py2js(code, docstrings=False)
+        assert js4 == js3 and js4.meta == js3.meta
+        
+        # Corrupt entries are ignored and removed
+        for fname in os.listdir(dirname):
+            with open(os.path.join(dirname, fname), 'wb') as f:
+                f.write(b'{not json')
+        assert py2js(code) == js1
+        assert py2js(code, docstrings=False) == js3
+        
+        # Eviction
+        cache.evict(1)
+        assert len(os.listdir(dirname)) == 0
+    finally:
+        cache.clear()
+        cache.set_cache_dir(ori_dirname)
+
+
 def test_scripts():
     # Prepare
     pycode = 'foo = 42; print(foo)'
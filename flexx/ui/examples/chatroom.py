@@ -7,14 +7,6 @@ This app might be running at the demo server: http://flexx1.zoof.io
 from flexx import app, ui, event
 
 
-class Relay(event.HasEvents):
-    """ Global object to relay messages to all participants.
-    """
-    @event.emitter
-    def new_message(self, msg):
-        return dict(msg=msg + '<br />')
-
-
 class MessageBox(ui.Label):
     CSS = """
     .flx-MessageBox {
@@ -26,10 +18,6 @@ class MessageBox(ui.Label):
     """
 
 
-# Create global relay
-relay = Relay()
-
-
 class ChatRoom(ui.Widget):
     """ Despite the name, this represents one connection to the chat room.
     """
@@ -49,11 +37,6 @@ class ChatRoom(ui.Widget):
         
         self._update_participants()
     
-    @relay.connect('new_message')  # note that we connect to relay
-    def _push_info(self, *events):
-        for ev in events:
-            self.emit('new_message', ev)
-    
     def _update_participants(self):
         if not self.session.status:
             return  # and dont't invoke a new call
@@ -70,7 +53,8 @@ class ChatRoom(ui.Widget):
         text = self.message.text
         if text:
             name = self.name.text or 'anonymous'
-            relay.new_message('<i>%s</i>: %s' % (name, text))
+            msg = '<i>%s</i>: %s<br />' % (name, text)
+            ChatRoom.broadcast('new_message', dict(msg=msg))  # to all participants
             self.message.text = ''
     
     @event.connect('name.text')
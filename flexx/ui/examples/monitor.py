@@ -13,10 +13,30 @@ from flexx import app, ui, event
 nsamples = 16
 
 
-class Relay(event.HasEvents):
+class SystemInfo(app.SharedModel):
+    """ The state of the server. There is one instance, which is shared
+    by all connected sessions.
+    """
     
-    def __init__(self):
-        super().__init__()
+    class Both:
+        
+        @event.prop
+        def cpu(self, v=0):
+            return float(v)
+        
+        @event.prop
+        def mem(self, v=0):
+            return float(v)
+        
+        @event.prop
+        def sessions(self, v=(0, 0)):
+            return tuple(v)
+        
+        @event.prop
+        def timestamp(self, v=0):
+            return float(v)
+    
+    def init(self):
         app.manager.connect(self._set_n_connections, 'connections_changed')
         self._set_n_connections()
         self.refresh()
@@ -26,29 +46,24 @@ class Relay(event.HasEvents):
         for name in app.manager.get_app_names():
             proxies = app.manager.get_connections(name)
             n += len(proxies)
-        self._n_connections = n
-        self.system_info()
+        self.sessions = n, app.manager.total_sessions
     
-    @event.emitter
-    def system_info(self):
-        return dict(cpu=psutil.cpu_percent(),
-                    mem=psutil.virtual_memory().percent,
-                    sessions=self._n_connections,
-                    total_sessions=app.manager.total_sessions,
-                    )
-        
     def refresh(self):
-        self.system_info()
+        self.cpu = psutil.cpu_percent()
+        self.mem = psutil.virtual_memory().percent
+        self.timestamp = time()
         app.call_later(1, self.refresh)
 
 
-# Create global relay
-relay = Relay()
+# Create global system info object
+system_info = SystemInfo()
 
 
 class Monitor(ui.Widget):
     
     def init(self):
+        system_info.subscribe(self.session)
+        self.system_info = system_info
         with ui.HBox():
             with ui.VBox():
                 ui.Label(text='<h3>Server monitor</h3>')
@@ -69,13 +84,6 @@ class Monitor(ui.Widget):
                                               sync_props=False)
                 ui.Widget(flex=1)
     
-    @relay.connect('system_info')  # note that we connect to relay
-    def _push_info(self, *events):
-        if not self.session.status:
-            return relay.disconnect('system_info:' + self.id)
-        self.emit('system_info', events[-1])
-    
-    
     def _do_work(self, *events):
         etime = time() + len(events)
         while time() < etime:
@@ -89,14 +97,15 @@ class Monitor(ui.Widget):
             super().init()
             self.start_time = time()
         
-        @event.connect('!system_info')
-        def _update_info(self, *events):
-            ev = events[-1]
-            
-            # Set connections
-            n = ev.sessions, ev.total_sessions
+        @event.connect('system_info.sessions')
+        def _update_sessions(self, *events):
+            n = self.system_info.sessions
             self.info.text = ('There are %i connected clients.<br />' % n[0] +
                               'And in total we served %i connections.<br />' % n[1])
+        
+        @event.connect('system_info.timestamp')
+        def _update_info(self, *events):
+            info = self.system_info
             
             # Prepare plots
             times = self.cpu_plot.xdata.copy()
@@ -107,13 +116,13 @@ class Monitor(ui.Widget):
             
             # cpu data
             usage = self.cpu_plot.ydata
-            usage.append(ev.cpu)
+            usage.append(info.cpu)
             usage = usage[-self.nsamples:]
             self.cpu_plot.ydata = usage
             
             # mem data
             usage = self.mem_plot.ydata
-            usage.append(ev.mem)
+            usage.append(info.mem)
             usage = usage[-self.nsamples:]
             self.mem_plot.ydata = usage
 